@@ -1,7 +1,12 @@
 import atexit
+import os
+import pickle
+import shutil
 from concurrent.futures import ThreadPoolExecutor
-from math import log, ceil
-from tempfile import TemporaryFile
+from math import log
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from os.path import join
 
 import numpy as np
 import scipy
@@ -11,13 +16,146 @@ from sklearn.utils import check_array, check_random_state, gen_batches
 from sklearn.utils.validation import check_is_fitted
 
 from modl.utils import get_sub_slice
+from modl.utils.profiling import check_profiler
 from modl.utils.randomkit import RandomState
 from modl.utils.randomkit import Sampler
+from modl.utils.storage import ChunkedStorage
 from .dict_fact_fast import _enet_regression_multi_gram, \
-    _enet_regression_single_gram, _update_G_average, _batch_weight
-from ..utils.math.enet import enet_norm, enet_projection, enet_scale
+    _enet_regression_single_gram, _update_G_average, _batch_weight, \
+    _single_batch_fit_fused, _enet_regression_multi_gram_packed, \
+    _update_G_average_packed, _update_dict_subset
+from ..utils.math.enet import enet_scale_rows, enet_norm_rows
 
 MAX_INT = np.iinfo(np.int64).max
+# Minimum growth of per-sample state when growable
+GROWTH_FACTOR = 1.5
+# Lazy B_ scale below which B_ is renormalized
+MIN_B_SCALE = 1e-3
+# Arrays of the optimisation state, stored as .npy files in checkpoints
+CHECKPOINT_ARRAYS = ['components_', 'B_', 'C_', 'gradient_', 'G_', 'code_',
+                     'Dx_average_', 'sample_n_iter_', 'comp_norm_', 'labels_']
+# Per-sample state, whose storage depends on sample_storage
+SAMPLE_STATS = ['code_', 'Dx_average_', 'sample_n_iter_', 'labels_']
+# Number of bytes copied at once when writing checkpoint arrays
+CHECKPOINT_BLOCK_SIZE = 2 ** 26
+
+
+def _enet_regression_fista(G, Dx, code, l1_ratio, alpha, positive, tol,
+                           max_iter):
+    """
+    Elastic-net regression of a whole batch using accelerated proximal
+    gradient (FISTA): find code s.t code.dot(G) = Dx, minimizing
+        1 / 2 code^T G code - Dx^T code + alpha (l1_ratio ||code||_1
+        + (1 - l1_ratio) / 2 ||code||_2^2)
+    for each row. Gradients are computed for all rows at once with a
+    matrix-matrix product, and momentum is restarted row-wise when it
+    points against the gradient step. Rows stop being updated when their
+    proximal gradient step falls below tol times their largest coordinate.
+
+    Parameters
+    ----------
+    G: array, shape (n_components, n_components)
+    Dx: array, shape (batch_size, n_components)
+    code: array, shape (batch_size, n_components), initial value,
+        modified inplace
+    l1_ratio: float, enet-regression parameter
+    alpha: float, enet-regression parameter
+    positive: bool, enet-regression parameter
+
+    Returns
+    -------
+    code: array, shape (batch_size, n_components)
+    """
+    n_components = G.shape[0]
+    beta = alpha * (1 - l1_ratio)
+    lipschitz = scipy.linalg.eigh(G, eigvals_only=True,
+                                  subset_by_index=[n_components - 1,
+                                                   n_components - 1])[0]
+    lipschitz += beta
+    if lipschitz <= 0:
+        return code
+    step = 1 / lipschitz
+    threshold = alpha * l1_ratio / lipschitz
+    active = np.arange(code.shape[0])
+    momentum = code.copy()
+    t = np.ones(code.shape[0])
+    for _ in range(max_iter):
+        this_code = code[active]
+        this_momentum = momentum[active]
+        # Gradient step, for all active samples at once
+        new_code = this_momentum.dot(G)
+        new_code -= Dx[active]
+        new_code *= - step
+        new_code += (1 - step * beta) * this_momentum
+        # Proximal step
+        if positive:
+            new_code -= threshold
+            np.maximum(new_code, 0, out=new_code)
+        else:
+            new_code -= np.clip(new_code, -threshold, threshold)
+        gradient_step = new_code - this_momentum
+        diff = new_code - this_code
+        this_t = t[active]
+        t_new = (1 + np.sqrt(1 + 4 * this_t ** 2)) / 2
+        coef = (this_t - 1) / t_new
+        # Adaptive restart
+        restart = np.sum(gradient_step * diff, axis=1) < 0
+        t_new[restart] = 1
+        coef[restart] = 0
+        code[active] = new_code
+        momentum[active] = new_code + coef[:, np.newaxis] * diff
+        t[active] = t_new
+        converged = (np.max(np.abs(gradient_step), axis=1)
+                     <= tol * np.max(np.abs(new_code), axis=1))
+        active = active[~converged]
+        if active.shape[0] == 0:
+            break
+    return code
+
+
+def _squared_norm(X):
+    """Squared Frobenius norm of X, accumulated in float64 without
+    copying X"""
+    X = np.asarray(X)
+    return float(np.einsum('ij,ij->', X, X, dtype=np.float64))
+
+
+def _iter_chunks(X, chunk_size):
+    """Split X, an array or an iterable of arrays, in chunks of at most
+    chunk_size rows. Chunks of memory-mapped arrays are only read when
+    requested"""
+    if hasattr(X, 'shape') or (isinstance(X, list) and len(X) > 0
+                               and not hasattr(X[0], 'shape')):
+        X = [X]
+    for this_X in X:
+        if not hasattr(this_X, 'shape'):
+            this_X = np.asarray(this_X)
+        n_samples = this_X.shape[0]
+        if chunk_size is None or chunk_size >= n_samples:
+            yield this_X
+        else:
+            for batch in gen_batches(n_samples, chunk_size):
+                yield this_X[batch]
+
+
+def _enet_regression(G, Dx, X, code, sample_indices, code_solver, l1_ratio,
+                     alpha, positive, tol, max_iter, n_threads, screening,
+                     n_iter=None):
+    """Elastic-net regression of the samples X, updating
+    code[sample_indices], with a single Gram matrix G and the solver
+    code_solver"""
+    if code_solver not in ['cd', 'fista', 'lars']:
+        raise ValueError("code_solver should be 'cd', 'fista' or 'lars'")
+    if code_solver == 'fista' and l1_ratio != 0:
+        this_code = code[sample_indices]
+        _enet_regression_fista(G, Dx, this_code, l1_ratio, alpha, positive,
+                               tol, max_iter)
+        code[sample_indices] = this_code
+    else:
+        _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                     l1_ratio, alpha, positive, tol,
+                                     max_iter, n_threads, screening,
+                                     code_solver == 'lars', n_iter)
 
 
 class CodingMixin(TransformerMixin):
@@ -29,7 +167,8 @@ class CodingMixin(TransformerMixin):
                            max_iter=100,
                            code_pos=False,
                            random_state=None,
-                           n_threads=1
+                           n_threads=1,
+                           code_solver='cd',
                            ):
         self.n_components = n_components
         self.code_l1_ratio = code_l1_ratio
@@ -38,84 +177,209 @@ class CodingMixin(TransformerMixin):
         self.random_state = random_state
         self.tol = tol
         self.max_iter = max_iter
+        self.code_solver = code_solver
 
         self.n_threads = n_threads
 
         if self.n_threads > 1:
             self._pool = ThreadPoolExecutor(n_threads)
 
-    def transform(self, X):
+    def transform(self, X, chunk_size=None, out=None):
         """
         Compute the codes associated to input matrix X, decomposing it onto
         the dictionary
 
         Parameters
         ----------
-        X: ndarray, shape = (n_samples, n_features)
+        X: ndarray, shape = (n_samples, n_features), or iterable of such
+            arrays
+        chunk_size: int or None
+            Number of samples coded at once, bounding the memory used for
+            D^T x and for type conversion. None codes each array at once
+        out: ndarray, shape = (n_samples, n_components), or None
+            Array in which to write the codes, e.g. a np.memmap
 
         Returns
         -------
         code: ndarray, shape = (n_samples, n_components)
         """
         check_is_fitted(self, 'components_')
+        dtype = self.components_.dtype
+        if out is None:
+            if not hasattr(X, 'shape'):
+                codes = list(self.transform_iter(X, chunk_size=chunk_size))
+                if len(codes) == 0:
+                    return np.empty((0, self.n_components), dtype=dtype)
+                return np.concatenate(codes)
+            out = np.empty((X.shape[0], self.n_components), dtype=dtype)
+        elif out.ndim != 2 or out.shape[1] != self.n_components:
+            raise ValueError('out should have shape (n_samples, '
+                             'n_components)')
+        G = self._get_coding_gram()
+        buffers = {}
+        start = 0
+        for X_chunk in _iter_chunks(X, chunk_size):
+            stop = start + X_chunk.shape[0]
+            if stop > out.shape[0]:
+                raise ValueError('out has fewer rows than X')
+            code = out[start:stop]
+            in_place = (code.dtype == dtype and code.flags['C_CONTIGUOUS']
+                        and code.flags['WRITEABLE'])
+            if not in_place:
+                code = np.empty((stop - start, self.n_components),
+                                dtype=dtype)
+            self._transform_chunk(X_chunk, G, code, buffers, need_Dx=False)
+            if not in_place:
+                out[start:stop] = code
+            start = stop
+        return out
+
+    def transform_iter(self, X, chunk_size=None):
+        """
+        Generator of the codes of X, chunk by chunk. Only one chunk of
+        samples and of codes is held in memory at a time.
 
+        Parameters
+        ----------
+        X: ndarray, shape = (n_samples, n_features), or iterable of such
+            arrays, e.g. a generator loading sessions one after the other
+        chunk_size: int or None
+            Number of samples coded at once. None codes each array at once
+
+        Returns
+        -------
+        codes: generator of ndarray, shape = (chunk_size, n_components)
+        """
+        check_is_fitted(self, 'components_')
+        dtype = self.components_.dtype
+        G = self._get_coding_gram()
+        buffers = {}
+        for X_chunk in _iter_chunks(X, chunk_size):
+            code = np.empty((X_chunk.shape[0], self.n_components),
+                            dtype=dtype)
+            self._transform_chunk(X_chunk, G, code, buffers, need_Dx=False)
+            yield code
+
+    def _get_coding_gram(self):
+        """Gram matrix of the dictionary, used for coding"""
+        if not hasattr(self, 'G_agg') or self.G_agg != 'full':
+            return self.components_.dot(self.components_.T)
+        return self.G_
+
+    def _transform_chunk(self, X, G, code, buffers, need_Dx=True):
+        """Compute code for the samples X, overwriting it. D^T x is computed
+        in buffers['Dx'], reallocated only when X has more rows than
+        before. Returns Dx, or None if not need_Dx and the ridge projection
+        is cached"""
         dtype = self.components_.dtype
         X = check_array(X, order='C', dtype=dtype.type)
+        ridge_cache = self._get_ridge_cache()
+        if ridge_cache is not None and not need_Dx:
+            np.dot(X, ridge_cache['projection'], out=code)
+            return None
         if X.flags['WRITEABLE'] is False:
             X = X.copy()
-        n_samples, n_features = X.shape
-        if not hasattr(self, 'G_agg') or self.G_agg != 'full':
-            G = self.components_.dot(self.components_.T)
-        else:
-            G = self.G_
-        Dx = X.dot(self.components_.T)
-        code = np.ones((n_samples, self.n_components), dtype=dtype)
-        sample_indices = np.arange(n_samples)
-        size_job = ceil(n_samples / self.n_threads)
-        batches = list(gen_batches(n_samples, size_job))
-
-        par_func = lambda batch: _enet_regression_single_gram(
-            G, Dx[batch], X[batch], code,
-            get_sub_slice(sample_indices, batch),
-            self.code_l1_ratio, self.code_alpha, self.code_pos,
-            self.tol, self.max_iter)
-        if self.n_threads > 1:
-            res = self._pool.map(par_func, batches)
-            _ = list(res)
+        n_samples = X.shape[0]
+        if 'Dx' not in buffers or buffers['Dx'].shape[0] < n_samples:
+            buffers['Dx'] = np.empty((n_samples, self.n_components),
+                                     dtype=dtype)
+        Dx = buffers['Dx'][:n_samples]
+        np.dot(X, self.components_.T, out=Dx)
+        if ridge_cache is not None:
+            np.dot(Dx, ridge_cache['inverse'], out=code)
         else:
-            _enet_regression_single_gram(
-                G, Dx, X, code,
-                sample_indices,
-                self.code_l1_ratio, self.code_alpha, self.code_pos,
-                self.tol, self.max_iter)
-
-        return code
-
-    def score(self, X):
+            rhs = Dx
+            if self.code_l1_ratio != 0:
+                # Elastic-net solvers start from a constant code
+                code[:] = 1
+            elif need_Dx:
+                # The ridge solver overwrites its right-hand side
+                rhs = Dx.copy()
+            self._enet_regression(G, rhs, X, code, np.arange(n_samples),
+                                  screening=True)
+        return Dx
+
+    def _get_ridge_cache(self):
+        """Cached ridge solution operators, if valid for the current
+        parameters (see Coder.fit)"""
+        ridge_cache = getattr(self, '_ridge_cache', None)
+        if (ridge_cache is None or self.code_l1_ratio != 0
+                or ridge_cache['alpha'] != self.code_alpha):
+            return None
+        return ridge_cache
+
+    def _enet_regression(self, G, Dx, X, code, sample_indices, screening,
+                         n_iter=None):
+        """Elastic-net regression of the samples X, updating
+        code[sample_indices], with a single Gram matrix G. Coordinate
+        descent passes are added to n_iter[0] if not None"""
+        _enet_regression(G, Dx, X, code, sample_indices, self.code_solver,
+                         self.code_l1_ratio, self.code_alpha, self.code_pos,
+                         self.tol, self.max_iter, self.n_threads, screening,
+                         n_iter)
+
+    def score(self, X, chunk_size=None, X_sq_norm=None):
         """
-        Objective function value on test data X
+        Objective function value on test data X. The reconstruction loss is
+        computed chunk by chunk from the quantities used in coding,
+            ||x - D^T code||^2 = ||x||^2 - 2 code^T D x + code^T G code,
+        without forming the residual
 
         Parameters
         ----------
-        X: ndarray, shape=(n_samples, n_features)
+        X: ndarray, shape=(n_samples, n_features), or iterable of such
+            arrays
             Input matrix
+        chunk_size: int or None
+            Number of samples coded at once. None codes each array at once
+        X_sq_norm: float or None
+            Squared Frobenius norm of X, e.g. cached for a test set scored
+            many times. Computed chunk by chunk if None
+
         Returns
         -------
         score: float, positive
         """
         check_is_fitted(self, 'components_')
-
-        code = self.transform(X)
-        loss = np.sum((X - code.dot(self.components_)) ** 2) / 2
-        norm1_code = np.sum(np.abs(code))
-        norm2_code = np.sum(code ** 2)
+        dtype = self.components_.dtype
+        G = self._get_coding_gram()
+        buffers = {}
+        n_samples = 0
+        sq_norm = 0.
+        cross_term = 0.
+        quad_term = 0.
+        norm1_code = 0.
+        norm2_code = 0.
+        for X_chunk in _iter_chunks(X, chunk_size):
+            X_chunk = check_array(X_chunk, order='C', dtype=dtype.type)
+            this_n_samples = X_chunk.shape[0]
+            if ('code' not in buffers
+                    or buffers['code'].shape[0] < this_n_samples):
+                buffers['code'] = np.empty((this_n_samples,
+                                            self.n_components), dtype=dtype)
+            code = buffers['code'][:this_n_samples]
+            Dx = self._transform_chunk(X_chunk, G, code, buffers)
+            if X_sq_norm is None:
+                sq_norm += _squared_norm(X_chunk)
+            cross_term += np.sum(code * Dx, dtype=np.float64)
+            quad_term += np.sum(code.dot(G) * code, dtype=np.float64)
+            norm1_code += np.sum(np.abs(code), dtype=np.float64)
+            norm2_code += np.sum(code ** 2, dtype=np.float64)
+            n_samples += this_n_samples
+        if X_sq_norm is not None:
+            sq_norm = X_sq_norm
+        loss = (sq_norm - 2 * cross_term + quad_term) / 2
         regul = self.code_alpha * (norm1_code * self.code_l1_ratio
                                    + (1 - self.code_l1_ratio) * norm2_code / 2)
-        return (loss + regul) / X.shape[0]
+        return (loss + regul) / n_samples
 
     def __getstate__(self):
         state = dict(self.__dict__)
         state.pop('_pool', None)
+        state.pop('_workspace', None)
+        state.pop('_process_pool', None)
+        state.pop('_shared', None)
+        state.pop('_atexit_registered', None)
         return state
 
     def __setstate__(self, state):
@@ -150,6 +414,20 @@ class DictFact(CodingMixin, BaseEstimator):
                  n_threads=1,
                  rand_size=True,
                  replacement=True,
+                 fused=False,
+                 lazy_B=False,
+                 feature_major=False,
+                 G_packed=False,
+                 G_average_dir=None,
+                 G_average_chunk_size=None,
+                 code_solver='cd',
+                 sample_storage='memory',
+                 sample_storage_dir=None,
+                 growable=False,
+                 profiler=None,
+                 stat_dtype=None,
+                 n_processes=1,
+                 feature_block_size=None,
                  ):
         """
         Estimator to perform matrix factorization by streaming samples and
@@ -219,34 +497,136 @@ class DictFact(CodingMixin, BaseEstimator):
             Whether the masks should have fixed size
         replacement: boolean
             Whether to compute random or cycling masks
+        fused: boolean
+            Whether to perform each mini-batch step in a single compiled
+            call, writing into preallocated buffers. Only used when
+            n_threads == 1, G_agg != 'average' and code_solver == 'cd';
+            otherwise the Python implementation is used.
+        lazy_B: boolean
+            Whether to store B_ up to a global scale factor B_scale_, so
+            that the (1 - w) decay of the variational optimizer is applied
+            as a scalar update instead of rescaling the whole of B_ at each
+            iteration. Only gradient_[:, subset] is materialized.
+        feature_major: boolean
+            Whether to store components_, B_ and gradient_ in Fortran
+            order, i.e. as transposed views of (n_features, n_components)
+            arrays, so that gathering and scattering a subset of features
+            copies contiguous rows. Shapes of the attributes are unchanged.
+        G_packed: boolean
+            Whether to store G_average_ in LAPACK packed format, keeping
+            only the upper triangle of each symmetric Gram matrix. This
+            halves the memory-mapped storage when G_agg == 'average'.
+        G_average_dir: str or None
+            Directory in which to store G_average_ when G_agg == 'average'.
+            None uses the default temporary directory
+        G_average_chunk_size: int or None
+            Number of samples per backing file of G_average_. None uses a
+            single file
+        code_solver: str in ['cd', 'fista', 'lars']
+            Solver for the elastic-net codes. 'cd' performs coordinate
+            descent sample by sample, 'fista' performs accelerated proximal
+            gradient on the whole batch, relying on matrix-matrix products.
+            'lars' follows the regularization path sample by sample, and is
+            faster when few atoms are active in each code. Paths longer
+            than 2 * n_components steps are finished by coordinate
+            descent, bounded by max_iter. 'fista' and 'lars' are not used
+            when G_agg == 'average'
+        sample_storage: str in ['memory', 'mmap', 'none']
+            Storage of the per-sample state code_, Dx_average_,
+            sample_n_iter_ and labels_. 'memory' keeps dense in-memory
+            arrays. 'mmap' keeps them out-of-core in ChunkedStorage, read
+            and written back batch by batch. 'none' keeps no per-sample
+            state, and cold-starts each code from a ridge solution; it
+            requires Dx_agg and G_agg different from 'average', and
+            disables fused
+        sample_storage_dir: str or None
+            Directory in which to store per-sample state when
+            sample_storage == 'mmap'. None uses the default temporary
+            directory
+        growable: boolean
+            Whether partial_fit may receive sample_indices larger than the
+            n_samples given to prepare. Per-sample state then grows by at
+            least a factor GROWTH_FACTOR, appending new backing files to
+            out-of-core storages, so that new samples can be streamed
+            without preparing the estimator again
+        profiler: Profiler or None
+            Instrumentation of the optimisation (see modl.utils.profiling).
+            Phases sampling, sample_io, Dx_G, G_average_io, code, stats,
+            dict and fused are timed, as well as stats_dict, in which stats
+            and dict are updated concurrently when n_threads > 1. samples,
+            batches, active_atoms, bytes_read and cd_iter (outside of fused)
+            are counted. A record is written to the profiler sink at the end
+            of each partial_fit. None disables instrumentation
+        stat_dtype: dtype in np.float32, np.float64 or None
+            Type of the sufficient statistics B_, C_ and Dx_average_, which
+            accumulate many (1 - w) decays. np.float64 with float32 data
+            keeps components_, code_, gradient_ and G_average_ in float32
+            while avoiding the accumulation of rounding errors. Disables
+            fused if different from the type of components_. None uses the
+            type of components_
+        n_processes: int
+            Number of worker processes used to compute codes. If larger than
+            1, components_ is allocated in shared memory, along with the
+            Gram matrix used for coding, the current batch and one
+            n_components x n_features buffer per process. Each process codes
+            a disjoint shard of each batch and returns its contributions to
+            B_ and C_, which are folded in before the dictionary update.
+            Requires G_agg != 'average', and disables fused. Batches should
+            be large compared to n_processes
+        feature_block_size: int or None
+            If not None, features are partitioned into contiguous blocks of
+            feature_block_size features (e.g. runs of voxels or rows of
+            patches), and the subset of each batch is a random union of
+            blocks, drawn with reduction. The Gram matrix of each block is
+            cached in block_G_ and refreshed for the blocks updated by the
+            dictionary step, so that the Gram matrix of a subset is a sum of
+            cached n_components x n_components matrices. Disables fused.
+            With G_agg == 'full' and a masked Dx_agg, the variance of the
+            masked Dx grows with the block size, as it is not compensated
+            by a Gram matrix computed on the same blocks
 
         Attributes
         ----------
         self.components_: ndarray, shape = (n_components, n_features)
             Current estimation of the dictionary
         self.code_: ndarray, shape = (n_samples, n_components)
-            Current estimation of each sample code
+            Current estimation of each sample code. ChunkedStorage if
+            sample_storage == 'mmap', absent if sample_storage == 'none'
         self.C_: ndarray, shape = (n_components, n_components)
-            For computing D gradient
+            For computing D gradient. Of type stat_dtype
         self.B_: ndarray, shape = (n_components, n_features)
-            For computing D gradient
+            For computing D gradient. Scaled by B_scale_ if lazy_B. Of type
+            stat_dtype
+        self.B_scale_: float
+            Scale factor of B_, equal to 1 unless lazy_B
         self.gradient_: ndarray, shape = (n_components, n_features)
             D gradient, to perform block coordinate descent
         self.G_: ndarray, shape = (n_components, n_components)
             Gram matrix
         self.Dx_average_: ndarray, shape = (n_samples, n_components)
-            Current estimate of D^T X
+            Current estimate of D^T X. Stored as code_, of type stat_dtype
         self.G_average_: ndarray, shape =
         (n_samples, n_components, n_components)
-            Averaged previously seen subsampled Gram matrix. Memory-mapped
+            Averaged previously seen subsampled Gram matrix, stored
+            out-of-core in a ChunkedStorage. Rows of the next batch are
+            prefetched in partial_fit.
+            Shape is (n_samples, n_components * (n_components + 1) / 2) if
+            G_packed
         self.n_iter_: int
             Number of seen samples
-        self.sample_n_iter_: int
-            Number of time each sample has been seen
+        self.sample_n_iter_: ndarray, shape = (n_samples)
+            Number of time each sample has been seen. Stored as code_
+        self.n_samples_: int
+            Number of samples
         self.verbose_iter_: int
             List of verbose iteration
+        self.block_G_: ndarray, shape = (n_blocks, n_components, n_components)
+            Gram matrix of each block of features, if feature_block_size is
+            not None
         self.feature_sampler_: Sampler
-            Generator of masks
+            Generator of masks, drawing blocks if feature_block_size is not
+            None. Subsets are written in increasing order in
+            a preallocated buffer, so that gathers of features are monotone
         """
 
         self.batch_size = batch_size
@@ -265,7 +645,8 @@ class DictFact(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_solver=code_solver)
 
         self.comp_l1_ratio = comp_l1_ratio
         self.comp_pos = comp_pos
@@ -283,6 +664,20 @@ class DictFact(CodingMixin, BaseEstimator):
         self.rand_size = rand_size
         self.replacement = replacement
 
+        self.fused = fused
+        self.lazy_B = lazy_B
+        self.feature_major = feature_major
+        self.G_packed = G_packed
+        self.G_average_dir = G_average_dir
+        self.G_average_chunk_size = G_average_chunk_size
+        self.sample_storage = sample_storage
+        self.sample_storage_dir = sample_storage_dir
+        self.growable = growable
+        self.profiler = profiler
+        self.stat_dtype = stat_dtype
+        self.n_processes = n_processes
+        self.feature_block_size = feature_block_size
+
     def fit(self, X):
         """
         Compute the factorisation X ~ code_ x components_, solving for
@@ -304,10 +699,13 @@ class DictFact(CodingMixin, BaseEstimator):
                                     dtype=X.dtype.type)
         self.prepare(n_samples=X.shape[0], X=dict_init)
         # Main loop
-        for _ in range(self.n_epochs):
-            self.partial_fit(X)
-            permutation = self.shuffle()
-            X = X[permutation]
+        try:
+            for _ in range(self.n_epochs):
+                self.partial_fit(X)
+                permutation = self.shuffle()
+                X = X[permutation]
+        finally:
+            self.close()
         return self
 
     def partial_fit(self, X, sample_indices=None):
@@ -328,12 +726,29 @@ class DictFact(CodingMixin, BaseEstimator):
         X = check_array(X, dtype=[np.float32, np.float64], order='C')
 
         n_samples, n_features = X.shape
-        batches = gen_batches(n_samples, self.batch_size)
+        batches = list(gen_batches(n_samples, self.batch_size))
+
+        if self.growable and n_samples > 0:
+            if sample_indices is None:
+                max_index = n_samples - 1
+            else:
+                max_index = np.max(sample_indices)
+            if max_index >= self.n_samples_:
+                self._grow(max_index + 1)
 
-        for batch in batches:
+        for i, batch in enumerate(batches):
             this_X = X[batch]
             these_sample_indices = get_sub_slice(sample_indices, batch)
+            if i + 1 < len(batches):
+                # Overlap the I/O of the next batch with computations
+                next_sample_indices = get_sub_slice(sample_indices,
+                                                    batches[i + 1])
+                for storage in self._storages():
+                    storage.prefetch(next_sample_indices)
             self._single_batch_fit(this_X, these_sample_indices)
+        for storage in self._storages():
+            storage.flush()
+        check_profiler(self.profiler).record(n_iter=self.n_iter_)
         return self
 
     def set_params(self, **params):
@@ -356,10 +771,17 @@ class DictFact(CodingMixin, BaseEstimator):
             self.G_agg = 'full'
         BaseEstimator.set_params(self, **params)
 
-    def shuffle(self):
+    def shuffle(self, indirect=False):
         """
         Shuffle regression statistics, code_,
-        G_average_ and Dx_average_ and return the permutation used
+        G_average_ and Dx_average_ and return the permutation used.
+        In-memory statistics are permuted in place.
+
+        Parameters
+        ----------
+        indirect: boolean,
+            Whether out-of-core statistics only record the permutation as
+            an index of their rows, instead of moving rows
 
         Returns
         -------
@@ -369,12 +791,15 @@ class DictFact(CodingMixin, BaseEstimator):
 
         random_seed = self.random_state.randint(MAX_INT)
         random_state = RandomState(random_seed)
-        list = [self.code_]
-        if self.G_agg == 'average':
-            list.append(self.G_average_)
-        list.append(self.Dx_average_)
-        perm = random_state.shuffle_with_trace(list)
-        self.labels_ = self.labels_[perm]
+        if self.sample_storage == 'memory':
+            list = [self.code_, self.Dx_average_]
+            perm = random_state.shuffle_with_trace(list)
+            self.labels_ = self.labels_[perm]
+        else:
+            perm = random_state.shuffle_with_trace(
+                [np.arange(self.n_samples_)])
+        for storage in self._storages(labels=True):
+            storage.permute(perm, indirect=indirect)
         return perm
 
     def prepare(self, n_samples=None, n_features=None,
@@ -425,22 +850,46 @@ class DictFact(CodingMixin, BaseEstimator):
             self.reduction = 1
             self.G_agg = 'full'
             self.Dx_agg = 'full'
+        if self.sample_storage not in ['memory', 'mmap', 'none']:
+            raise ValueError("sample_storage should be 'memory', 'mmap' or "
+                             "'none'")
+        if self.sample_storage == 'none' and 'average' in [self.G_agg,
+                                                           self.Dx_agg]:
+            raise ValueError("sample_storage='none' requires G_agg and "
+                             "Dx_agg different from 'average'")
+        if self.feature_block_size is not None and self.feature_block_size < 1:
+            raise ValueError('feature_block_size should be positive')
+        if self.n_processes > 1 and self.G_agg == 'average':
+            raise ValueError("n_processes > 1 requires G_agg different from "
+                             "'average'")
+        stat_dtype = np.dtype(dtype if self.stat_dtype is None
+                              else self.stat_dtype)
+        if stat_dtype not in [np.float32, np.float64]:
+            raise ValueError('stat_dtype should be float32 or float64')
+        self._exit()
 
         # Regression statistics
         if self.G_agg == 'average':
-            with TemporaryFile() as self.G_average_mmap_:
-                self.G_average_mmap_ = TemporaryFile()
-                self.G_average_ = np.memmap(self.G_average_mmap_, mode='w+',
-                                            shape=(n_samples,
-                                                   self.n_components,
-                                                   self.n_components),
-                                            dtype=dtype)
-            atexit.register(self._exit)
-        self.Dx_average_ = np.zeros((n_samples, self.n_components),
-                                    dtype=dtype)
+            if self.G_packed:
+                G_shape = (n_samples,
+                           self.n_components * (self.n_components + 1) // 2)
+            else:
+                G_shape = (n_samples, self.n_components, self.n_components)
+            self.G_average_ = ChunkedStorage(
+                G_shape, dtype, directory=self.G_average_dir,
+                chunk_size=self.G_average_chunk_size)
+            self._register_exit()
+        self.n_samples_ = n_samples
+        self._prepare_sample_stats(n_samples, dtype, stat_dtype)
         # Dictionary statistics
-        self.C_ = np.zeros((self.n_components, self.n_components), dtype=dtype)
-        self.B_ = np.zeros((self.n_components, n_features), dtype=dtype)
+        self.C_ = np.zeros((self.n_components, self.n_components),
+                           dtype=stat_dtype)
+        order = 'F' if self.feature_major else 'C'
+        self.B_ = np.zeros((self.n_components, n_features), dtype=stat_dtype,
+                           order=order)
+        self.B_scale_ = 1.
+        self.__dict__.pop('_merge_base', None)
+        self.__dict__.pop('_workspace', None)
         self.gradient_ = np.zeros((self.n_components, n_features), dtype=dtype,
                                   order='F')
 
@@ -448,25 +897,20 @@ class DictFact(CodingMixin, BaseEstimator):
         if X is None:
             self.components_ = np.empty((self.n_components,
                                          n_features),
-                                        dtype=dtype)
+                                        dtype=dtype, order=order)
             self.components_[:, :] = self.random_state.randn(self.n_components,
                                                              n_features)
         else:
             random_idx = self.random_state.permutation(this_n_samples)[
                          :self.n_components]
             self.components_ = check_array(X[random_idx], dtype=dtype.type,
-                                           copy=True)
+                                           order=order, copy=True)
         if self.comp_pos:
             self.components_[self.components_ <= 0] = \
                 - self.components_[self.components_ <= 0]
-        for i in range(self.n_components):
-            enet_scale(self.components_[i],
-                       l1_ratio=self.comp_l1_ratio,
-                       radius=1)
-
-        self.code_ = np.ones((n_samples, self.n_components), dtype=dtype)
-
-        self.labels_ = np.arange(n_samples)
+        enet_scale_rows(self.components_,
+                        np.ones(self.n_components, dtype=dtype),
+                        self.comp_l1_ratio, self.n_threads)
 
         self.comp_norm_ = np.zeros(self.n_components, dtype=dtype)
 
@@ -474,19 +918,358 @@ class DictFact(CodingMixin, BaseEstimator):
             self.G_ = self.components_.dot(self.components_.T)
 
         self.n_iter_ = 0
-        self.sample_n_iter_ = np.zeros(n_samples, dtype='int')
         self.random_state = check_random_state(self.random_state)
         random_seed = self.random_state.randint(MAX_INT)
-        self.feature_sampler_ = Sampler(n_features, self.rand_size,
-                                        self.replacement, random_seed)
+        self.feature_sampler_ = Sampler(self._n_sampled(n_features),
+                                        self.rand_size, self.replacement,
+                                        random_seed)
+        self._prepare_block_gram()
         if self.verbose:
-            log_lim = log(n_samples * self.n_epochs / self.batch_size, 10)
+            log_lim = log(max(n_samples, self.batch_size) * self.n_epochs
+                          / self.batch_size, 10)
             self.verbose_iter_ = (np.logspace(0, log_lim, self.verbose,
                                               base=10) - 1) * self.batch_size
             self.verbose_iter_ = self.verbose_iter_.tolist()
         self.time_ = 0
         return self
 
+    def _prepare_sample_stats(self, n_samples, dtype, stat_dtype):
+        """Allocate code_, Dx_average_, sample_n_iter_ and labels_
+        according to sample_storage"""
+        for name in SAMPLE_STATS:
+            self.__dict__.pop(name, None)
+        if self.sample_storage == 'none':
+            return
+        dtypes = {'code_': dtype, 'Dx_average_': stat_dtype,
+                  'sample_n_iter_': 'int', 'labels_': 'int'}
+        shapes = {'code_': (n_samples, self.n_components),
+                  'Dx_average_': (n_samples, self.n_components),
+                  'sample_n_iter_': (n_samples,),
+                  'labels_': (n_samples,)}
+        if self.sample_storage == 'memory':
+            self.code_ = np.ones(shapes['code_'], dtype=dtype)
+            self.Dx_average_ = np.zeros(shapes['Dx_average_'],
+                                        dtype=stat_dtype)
+            self.sample_n_iter_ = np.zeros(n_samples, dtype='int')
+            self.labels_ = np.arange(n_samples)
+        else:
+            for name in SAMPLE_STATS:
+                setattr(self, name,
+                        ChunkedStorage(shapes[name], dtypes[name],
+                                       directory=self.sample_storage_dir))
+            self.code_.fill(0, lambda start, stop: 1)
+            self.labels_.fill(0, np.arange)
+            self._register_exit()
+
+    def _grow(self, n_samples):
+        """Extend per-sample state to at least n_samples rows. New samples
+        are initialized as in prepare"""
+        n_samples = max(n_samples, int(self.n_samples_ * GROWTH_FACTOR))
+        old_n_samples = self.n_samples_
+        n_new_samples = n_samples - old_n_samples
+        if self.sample_storage == 'memory':
+            self.code_ = np.concatenate(
+                [self.code_, np.ones((n_new_samples, self.n_components),
+                                     dtype=self.code_.dtype)])
+            self.Dx_average_ = np.concatenate(
+                [self.Dx_average_, np.zeros((n_new_samples,
+                                             self.n_components),
+                                            dtype=self.Dx_average_.dtype)])
+            self.sample_n_iter_ = np.concatenate(
+                [self.sample_n_iter_, np.zeros(n_new_samples, dtype='int')])
+            self.labels_ = np.concatenate(
+                [self.labels_, np.arange(old_n_samples, n_samples)])
+        elif self.sample_storage == 'mmap':
+            for name in SAMPLE_STATS:
+                getattr(self, name).grow(n_samples)
+            self.code_.fill(old_n_samples, lambda start, stop: 1)
+            self.labels_.fill(old_n_samples, np.arange)
+        if isinstance(getattr(self, 'G_average_', None), ChunkedStorage):
+            self.G_average_.grow(n_samples)
+        self.n_samples_ = n_samples
+
+    def _storages(self, labels=False):
+        """Out-of-core storages in use, labels_ excepted unless labels"""
+        names = ['code_', 'Dx_average_', 'sample_n_iter_']
+        if self.G_agg == 'average':
+            names.append('G_average_')
+        if labels:
+            names.append('labels_')
+        return [getattr(self, name) for name in names
+                if isinstance(getattr(self, name, None), ChunkedStorage)]
+
+    def _read_sample_stats(self, sample_indices):
+        """Return code, Dx_average and indices such that code[indices] and
+        Dx_average[indices] hold the statistics of sample_indices.
+
+        Arrays are the whole in-memory state if sample_storage == 'memory',
+        and batch-local copies otherwise. code is None if sample_storage ==
+        'none'"""
+        batch_size = sample_indices.shape[0]
+        if self.sample_storage == 'memory':
+            return self.code_, self.Dx_average_, sample_indices
+        indices = np.arange(batch_size)
+        if self.sample_storage == 'none':
+            return None, np.zeros((batch_size, self.n_components),
+                                  dtype=self.B_.dtype), indices
+        return (self.code_.read(sample_indices),
+                self.Dx_average_.read(sample_indices), indices)
+
+    def _write_sample_stats(self, sample_indices, code, Dx_average):
+        """Write back the batch-local copies of _read_sample_stats"""
+        if self.sample_storage == 'mmap':
+            self.code_.write_async(sample_indices, code)
+            self.Dx_average_.write_async(sample_indices, Dx_average)
+
+    def _update_sample_n_iter(self, sample_indices):
+        """Increment and return the number of times samples have been
+        seen"""
+        if self.sample_storage == 'none':
+            return np.ones(sample_indices.shape[0], dtype='int')
+        if self.sample_storage == 'memory':
+            self.sample_n_iter_[sample_indices] += 1
+            return self.sample_n_iter_[sample_indices]
+        this_sample_n_iter = self.sample_n_iter_.read(sample_indices) + 1
+        self.sample_n_iter_.write_async(sample_indices, this_sample_n_iter)
+        return this_sample_n_iter
+
+    def save_checkpoint(self, directory, extra=None):
+        """
+        Write the optimisation state to directory, from which
+        load_checkpoint can resume the factorization.
+
+        Arrays are written as .npy files, block by block, and G_average_
+        chunk by chunk. Chunks of out-of-core storages that did not change
+        since the previous checkpoint in directory are hard-linked from it.
+        The checkpoint is first written to directory.tmp, then swapped with
+        any previous checkpoint in directory.
+
+        Parameters
+        ----------
+        directory: str,
+            Checkpoint directory
+        extra: dict or None,
+            Additional state to store, e.g. the position of the caller in
+            the data. ndarray values are stored as .npy files
+
+        Returns
+        -------
+        self
+        """
+        check_is_fitted(self, 'components_')
+        tmp_directory = directory + '.tmp'
+        old_directory = directory + '.old'
+        if os.path.exists(tmp_directory):
+            shutil.rmtree(tmp_directory)
+        os.makedirs(tmp_directory)
+
+        storages = {}
+        for name in CHECKPOINT_ARRAYS + ['G_average_']:
+            value = getattr(self, name, None)
+            if isinstance(value, ChunkedStorage):
+                if name != 'G_average_' or self.G_agg == 'average':
+                    value.save(tmp_directory, name, previous=directory)
+                    storages[name] = (value.shape, value.dtype.str)
+            elif value is not None:
+                _save_array(join(tmp_directory, name + '.npy'), value)
+        if extra is None:
+            extra = {}
+        extra_arrays = []
+        for key, value in extra.items():
+            if isinstance(value, np.ndarray):
+                _save_array(join(tmp_directory, 'extra_%s.npy' % key), value)
+                extra_arrays.append(key)
+        state = {'n_iter_': self.n_iter_,
+                 'B_scale_': self.B_scale_,
+                 'time_': self.time_,
+                 'verbose_iter_': getattr(self, 'verbose_iter_', None),
+                 'n_samples_': self.n_samples_,
+                 'storages': storages,
+                 'random_state': self.random_state.get_state(),
+                 'feature_sampler_': self.feature_sampler_.get_state(),
+                 'G_agg': self.G_agg,
+                 'Dx_agg': self.Dx_agg,
+                 'reduction': self.reduction,
+                 'merge_base': getattr(self, '_merge_base', None),
+                 'extra': {key: value for key, value in extra.items()
+                           if key not in extra_arrays},
+                 'extra_arrays': extra_arrays}
+        with open(join(tmp_directory, 'state.pkl'), 'wb') as f:
+            pickle.dump(state, f)
+
+        if os.path.exists(directory):
+            if os.path.exists(old_directory):
+                shutil.rmtree(old_directory)
+            os.rename(directory, old_directory)
+        os.rename(tmp_directory, directory)
+        if os.path.exists(old_directory):
+            shutil.rmtree(old_directory)
+        return self
+
+    def load_checkpoint(self, directory):
+        """
+        Restore the optimisation state written by save_checkpoint.
+
+        Arrays are memory-mapped in copy-on-write mode, so that restoring is
+        independent of their size. Out-of-core storages such as G_average_
+        adopt the checkpoint files, each of them being copied on its first
+        write.
+
+        Parameters
+        ----------
+        directory: str,
+            Checkpoint directory
+
+        Returns
+        -------
+        extra: dict,
+            Additional state given to save_checkpoint
+        """
+        with open(join(directory, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        self._exit()
+        for name in CHECKPOINT_ARRAYS + ['G_average_']:
+            self.__dict__.pop(name, None)
+            filename = join(directory, name + '.npy')
+            if os.path.exists(filename):
+                setattr(self, name, np.load(filename, mmap_mode='c'))
+        for name, (shape, dtype) in state['storages'].items():
+            if name == 'G_average_':
+                storage = ChunkedStorage(shape, dtype,
+                                         directory=self.G_average_dir,
+                                         chunk_size=self.G_average_chunk_size)
+            else:
+                storage = ChunkedStorage(shape, dtype,
+                                         directory=self.sample_storage_dir)
+            storage.restore(directory, name)
+            setattr(self, name, storage)
+        if state['storages']:
+            self._register_exit()
+        self.G_agg = state['G_agg']
+        self.Dx_agg = state['Dx_agg']
+        self.reduction = state['reduction']
+        self.n_samples_ = state['n_samples_']
+        self.n_iter_ = state['n_iter_']
+        self.B_scale_ = state['B_scale_']
+        self.time_ = state['time_']
+        if state['verbose_iter_'] is not None:
+            self.verbose_iter_ = state['verbose_iter_']
+        # Restore in place, as the random state may be shared with the caller
+        self.random_state = check_random_state(self.random_state)
+        self.random_state.set_state(state['random_state'])
+        n_features = self.components_.shape[1]
+        self.feature_sampler_ = Sampler(self._n_sampled(n_features),
+                                        self.rand_size, self.replacement, 0)
+        self.feature_sampler_.set_state(state['feature_sampler_'])
+        self._prepare_block_gram()
+        self.__dict__.pop('_workspace', None)
+        self.__dict__.pop('_merge_base', None)
+        if state.get('merge_base') is not None:
+            self._merge_base = state['merge_base']
+        extra = state['extra']
+        for key in state['extra_arrays']:
+            extra[key] = np.load(join(directory, 'extra_%s.npy' % key),
+                                 mmap_mode='c')
+        return extra
+
+    def export_stats(self):
+        """
+        Sufficient statistics accumulated since the last merge_stats, to be
+        merged with the statistics of other instances sharing the same
+        dictionary.
+
+        B_ and C_ are weighted averages of code.T.dot(X) and
+        code.T.dot(code) over the n_iter_ seen samples. The exported
+        statistics are the corresponding sums over the samples seen since
+        the last merge, so that statistics of several instances can be
+        added with reduce_stats.
+
+        Returns
+        -------
+        stats: dict,
+            'n_iter': number of samples seen since the last merge,
+            'B': array, shape (n_components, n_features),
+            'C': array, shape (n_components, n_components),
+            'components': array, shape (n_components, n_features),
+            components_ weighted by 'n_iter'
+        """
+        check_is_fitted(self, 'components_')
+        base_n_iter, base_B, base_C = self._get_merge_base()
+        n_iter = self.n_iter_ - base_n_iter
+        B = self.B_ * (self.B_scale_ * self.n_iter_)
+        C = self.C_ * self.n_iter_
+        if base_n_iter > 0:
+            B -= base_B * base_n_iter
+            C -= base_C * base_n_iter
+        return {'n_iter': n_iter, 'B': B, 'C': C,
+                'components': self.components_ * n_iter}
+
+    def merge_stats(self, stats_list):
+        """
+        Merge statistics exported by several instances, including this one,
+        e.g. after gathering them from all nodes of a cluster. Each instance
+        calling merge_stats with the same stats_list ends up with the same
+        B_, C_, n_iter_ and components_.
+
+        components_ is set to the average of the exported dictionaries,
+        weighted by their number of new samples, and then refined by a block
+        coordinate descent pass over all features using the merged B_ and
+        C_ (variational optimizer only).
+
+        Parameters
+        ----------
+        stats_list: list of dict,
+            Statistics returned by export_stats, or by reduce_stats
+
+        Returns
+        -------
+        self
+        """
+        check_is_fitted(self, 'components_')
+        stats = reduce_stats(stats_list)
+        base_n_iter, base_B, base_C = self._get_merge_base()
+        n_iter = base_n_iter + stats['n_iter']
+        if n_iter == 0:
+            return self
+        self.B_scale_ = 1.
+        self.B_[:] = stats['B']
+        self.C_[:] = stats['C']
+        if base_n_iter > 0:
+            self.B_ += base_B * base_n_iter
+            self.C_ += base_C * base_n_iter
+        self.B_ /= n_iter
+        self.C_ /= n_iter
+        self.n_iter_ = n_iter
+        if stats['n_iter'] > 0:
+            self.components_[:] = stats['components'] / stats['n_iter']
+        dtype = self.components_.dtype
+        n_components = self.components_.shape[0]
+        comp_norm = np.empty(n_components, dtype=dtype)
+        enet_norm_rows(self.components_, comp_norm, self.comp_l1_ratio,
+                       self.n_threads)
+        comp_norm = 1 - comp_norm
+        if self.optimizer == 'variational':
+            C = self.C_.astype(dtype)
+            components = np.ascontiguousarray(self.components_)
+            gradient = self.B_.astype(dtype, order='C')
+            gradient -= C.dot(components)
+            _update_dict_subset(C, components, gradient, comp_norm,
+                                np.arange(n_components), self.comp_l1_ratio,
+                                self.comp_pos, True, 0)
+            self.components_[:] = components
+        self.comp_norm_[:] = comp_norm
+        if self.G_agg == 'full':
+            self.G_ = self.components_.dot(self.components_.T)
+        self._prepare_block_gram()
+        self._merge_base = (self.n_iter_, self.B_.copy(), self.C_.copy())
+        return self
+
+    def _get_merge_base(self):
+        """n_iter_, B_ and C_ at the time of the last merge"""
+        if not hasattr(self, '_merge_base'):
+            return 0, None, None
+        return self._merge_base
+
     def _callback(self):
         if self.callback is not None:
             self.callback(self)
@@ -502,38 +1285,218 @@ class DictFact(CodingMixin, BaseEstimator):
         if X.flags['WRITEABLE'] is False:
             X = X.copy()
         t0 = time.perf_counter()
+        profiler = check_profiler(self.profiler)
 
-        subset = self.feature_sampler_.yield_subset(self.reduction)
+        with profiler.timer('sampling'):
+            subset = self._yield_subset()
         batch_size = X.shape[0]
 
         self.n_iter_ += batch_size
-        self.sample_n_iter_[sample_indices] += 1
-        this_sample_n_iter = self.sample_n_iter_[sample_indices]
-        w_sample = np.power(this_sample_n_iter, -self.sample_learning_rate). \
-            astype(self.components_.dtype)
+        with profiler.timer('sample_io'):
+            this_sample_n_iter = self._update_sample_n_iter(sample_indices)
+            code, Dx_average, indices = self._read_sample_stats(
+                sample_indices)
+        w_sample = np.power(this_sample_n_iter, -self.sample_learning_rate,
+                            dtype=self.components_.dtype)
         w = _batch_weight(self.n_iter_, batch_size,
                           self.learning_rate, 0)
-        self._compute_code(X, sample_indices, w_sample, subset)
-
-        this_code = self.code_[sample_indices]
+        profiler.count('samples', batch_size)
+        profiler.count('batches')
+        if profiler.enabled and self.sample_storage == 'mmap':
+            profiler.count('bytes_read', code.nbytes + Dx_average.nbytes)
+        if self.n_processes > 1:
+            this_code = self._compute_code_and_stats_processes(
+                X, w_sample, subset, w, code, Dx_average, indices)
+            with profiler.timer('sample_io'):
+                self._write_sample_stats(sample_indices, code, Dx_average)
+            if profiler.enabled:
+                profiler.count('active_atoms', np.count_nonzero(this_code))
+            with profiler.timer('stats'):
+                self.gradient_[:, subset] = (self.B_[:, subset]
+                                             * self.B_scale_)
+            with profiler.timer('dict'):
+                self._update_dict(subset, w)
+            self.time_ += time.perf_counter() - t0
+            return
+        if (self.fused and self.n_threads == 1 and self.G_agg != 'average'
+                and self.code_solver == 'cd'
+                and self.sample_storage != 'none'
+                and self.feature_block_size is None
+                and subset.shape[0] > 0
+                and X.dtype == self.components_.dtype
+                and self.B_.dtype == self.components_.dtype):
+            with profiler.timer('fused'):
+                self._single_batch_fit_fused(X, indices, w_sample,
+                                             subset, w, code, Dx_average)
+            with profiler.timer('sample_io'):
+                self._write_sample_stats(sample_indices, code, Dx_average)
+            if profiler.enabled:
+                profiler.count('active_atoms',
+                               np.count_nonzero(code[indices]))
+            self.time_ += time.perf_counter() - t0
+            return
+        code = self._compute_code(X, sample_indices, w_sample, subset,
+                                  code, Dx_average, indices)
+        with profiler.timer('sample_io'):
+            self._write_sample_stats(sample_indices, code, Dx_average)
+
+        this_code = code[indices]
+        if profiler.enabled:
+            profiler.count('active_atoms', np.count_nonzero(this_code))
 
         if self.n_threads == 1:
             self._update_stat_and_dict(subset, X, this_code, w)
         else:
-            self._update_stat_and_dict_parallel(subset, X,
-                                                this_code, w)
+            with profiler.timer('stats_dict'):
+                self._update_stat_and_dict_parallel(subset, X,
+                                                    this_code, w)
         self.time_ += time.perf_counter() - t0
 
+    def _single_batch_fit_fused(self, X, indices, w_sample, subset,
+                                w, code, Dx_average):
+        """Perform _compute_code, statistics and dictionary update in a
+        single compiled call"""
+        n_components, n_features = self.components_.shape
+        batch_size = X.shape[0]
+        workspace = self._get_workspace(batch_size)
+        order = self.random_state.permutation(n_components)
+        if self.G_agg == 'full':
+            G = self.G_
+        else:
+            G = self.C_  # Unused
+        lazy_B = self.lazy_B and self.optimizer == 'variational'
+        if lazy_B:
+            self._decay_B_scale(w)
+        else:
+            self._materialize_B()
+        feature_major = self.components_.flags['F_CONTIGUOUS']
+        if feature_major:
+            components, B, gradient = (self.components_.T, self.B_.T,
+                                       self.gradient_.T)
+        else:
+            components, B, gradient = (self.components_, self.B_,
+                                       self.gradient_)
+        _single_batch_fit_fused(X, indices, subset, w_sample,
+                                components, code,
+                                Dx_average, self.C_, B,
+                                gradient, G, self.comp_norm_, order,
+                                workspace, w, self.reduction,
+                                self.Dx_agg, self.G_agg,
+                                self.optimizer == 'variational',
+                                lazy_B, self.B_scale_, feature_major,
+                                self.step_size,
+                                self.code_l1_ratio, self.code_alpha,
+                                self.code_pos, self.tol, self.max_iter,
+                                self.comp_l1_ratio, self.comp_pos)
+
+    def _n_sampled(self, n_features):
+        """Number of features, or of blocks of features, drawn by
+        feature_sampler_"""
+        if self.feature_block_size is None:
+            return n_features
+        return (n_features + self.feature_block_size - 1) \
+            // self.feature_block_size
+
+    def _yield_subset(self):
+        """Draw the subset of features of a batch, in increasing order. In
+        block sampling mode, the blocks of the subset are kept in
+        _subset_blocks"""
+        subset = np.asarray(self.feature_sampler_.yield_subset(
+            self.reduction, out=self._get_subset_buffer(), sort=True))
+        block_size = self.feature_block_size
+        if block_size is None:
+            return subset
+        n_features = self.components_.shape[1]
+        self._subset_blocks = subset.copy()
+        subset = (self._subset_blocks[:, np.newaxis] * block_size
+                  + np.arange(block_size)).ravel()
+        if subset.shape[0] > 0 and subset[-1] >= n_features:
+            subset = subset[subset < n_features]
+        return subset
+
+    def _prepare_block_gram(self):
+        """Compute the Gram matrices of all blocks of features, in block
+        sampling mode"""
+        self.__dict__.pop('block_G_', None)
+        if self.feature_block_size is None:
+            return
+        n_components, n_features = self.components_.shape
+        n_blocks = self._n_sampled(n_features)
+        self.block_G_ = np.empty((n_blocks, n_components, n_components),
+                                 dtype=self.components_.dtype)
+        self._refresh_block_gram(np.arange(n_blocks))
+
+    def _refresh_block_gram(self, blocks):
+        """Recompute the cached Gram matrices of blocks from components_"""
+        block_size = self.feature_block_size
+        n_features = self.components_.shape[1]
+        partial = (blocks + 1) * block_size > n_features
+        full_blocks = blocks[~partial]
+        if full_blocks.shape[0] > 0:
+            indices = (full_blocks[:, np.newaxis] * block_size
+                       + np.arange(block_size))
+            # shape (n_full_blocks, n_components, block_size)
+            components = self.components_[:, indices].transpose(1, 0, 2)
+            self.block_G_[full_blocks] = np.matmul(
+                components, components.transpose(0, 2, 1))
+        for block in blocks[partial]:
+            components = self.components_[:, block * block_size:]
+            self.block_G_[block] = components.dot(components.T)
+
+    def _subset_gram(self, components_subset):
+        """Gram matrix of components_subset, the columns of the current
+        subset, summed from block_G_ in block sampling mode"""
+        if self.feature_block_size is not None:
+            return np.sum(self.block_G_[self._subset_blocks], axis=0)
+        return components_subset.dot(components_subset.T)
+
+    def _get_subset_buffer(self):
+        """Buffer in which feature_sampler_ writes the subset of each
+        batch"""
+        n_features = self.components_.shape[1]
+        if (not hasattr(self, '_subset_buffer')
+                or self._subset_buffer.shape[0] < n_features):
+            self._subset_buffer = np.empty(n_features, dtype='long')
+        return self._subset_buffer
+
+    def _get_workspace(self, batch_size):
+        """Buffers used by the fused mini-batch kernel, reallocated when
+        one of them is too small for the current shapes, or has the wrong
+        dtype. The kernel accesses them through raw pointers"""
+        n_components, n_features = self.components_.shape
+        dtype = self.components_.dtype
+        batch_size = max(batch_size, self.batch_size)
+        sizes = [batch_size * n_features,
+                 n_components * n_features,
+                 n_components * n_features,
+                 batch_size * n_components,
+                 n_components ** 2,
+                 n_components ** 2,
+                 batch_size * n_components,
+                 n_components,
+                 n_components,
+                 n_features]
+        workspace = getattr(self, '_workspace', None)
+        if (workspace is None
+                or any(buffer.dtype != dtype or buffer.shape[0] < size
+                       for buffer, size in zip(workspace, sizes))):
+            self._workspace = tuple(np.empty(size, dtype=dtype)
+                                    for size in sizes)
+        return self._workspace
+
     def _update_stat_and_dict(self, subset, X, code, w):
         """For multi-threading"""
-        self._update_C(code, w)
-        self._update_B(X, code, w)
-        self.gradient_[:, subset] = self.B_[:, subset]
-        self._update_dict(subset, w)
+        profiler = check_profiler(self.profiler)
+        with profiler.timer('stats'):
+            self._update_C(code, w)
+            self._update_B(X, code, w)
+            self.gradient_[:, subset] = self.B_[:, subset] * self.B_scale_
+        with profiler.timer('dict'):
+            self._update_dict(subset, w)
 
     def _update_stat_and_dict_parallel(self, subset, X, this_code, w):
         """For multi-threading"""
-        self.gradient_[:, subset] = self.B_[:, subset]
+        self.gradient_[:, subset] = self.B_[:, subset] * self.B_scale_
         dict_thread = self._pool.submit(self._update_stat_partial_and_dict,
                                         subset, X, this_code, w)
         B_thread = self._pool.submit(self._update_B, X,
@@ -557,94 +1520,225 @@ class DictFact(CodingMixin, BaseEstimator):
 
     def _update_B(self, X, code, w):
         """Update B statistics (for updating D)"""
-        batch_size = X.shape[0]
+        self._fold_B(code.T.dot(X), X.shape[0], w)
+
+    def _fold_B(self, codeTX, batch_size, w):
+        """Update B statistics from code.T.dot(X) computed over batch_size
+        samples"""
         if self.optimizer == 'variational':
-            self.B_ *= 1 - w
-            self.B_ += w * code.T.dot(X) / batch_size
+            if self.lazy_B:
+                self._decay_B_scale(w)
+                self.B_ += codeTX * (w / batch_size / self.B_scale_)
+            else:
+                self._materialize_B()
+                self.B_ *= 1 - w
+                self.B_ += w * codeTX / batch_size
         else:
-            self.B_ = code.T.dot(X) / batch_size
+            self.B_[:] = codeTX / batch_size
+            self.B_scale_ = 1.
+
+    def _decay_B_scale(self, w):
+        """Apply the (1 - w) decay to the scale of the lazy B_ statistic,
+        renormalizing B_ when the scale becomes too small"""
+        self.B_scale_ *= 1 - w
+        if self.B_scale_ < MIN_B_SCALE:
+            self._materialize_B()
+
+    def _materialize_B(self):
+        """Fold B_scale_ into B_"""
+        if self.B_scale_ != 1:
+            self.B_ *= self.B_scale_
+            self.B_scale_ = 1.
 
     def _update_C(self, this_code, w):
         """Update C statistics (for updating D)"""
-        batch_size = this_code.shape[0]
+        self._fold_C(this_code.T.dot(this_code), this_code.shape[0], w)
+
+    def _fold_C(self, codeTcode, batch_size, w):
+        """Update C statistics from code.T.dot(code) computed over
+        batch_size samples"""
         if self.optimizer == 'variational':
             self.C_ *= 1 - w
-            self.C_ += w * this_code.T.dot(this_code) / batch_size
+            self.C_ += w * codeTcode / batch_size
         else:
-            self.C_ = this_code.T.dot(this_code) / batch_size
+            self.C_[:] = codeTcode / batch_size
+
+    def _get_process_pool(self, batch_size):
+        """Pool of coding processes, attached to the shared copies of
+        components_, of the coding Gram matrix, of the current batch and of
+        their contributions to B_. Restarted whenever components_ is not
+        the shared array anymore (e.g. after load_checkpoint), or when
+        batch_size grows"""
+        shared = getattr(self, '_shared', None)
+        if (shared is not None and shared['components_'] is self.components_
+                and shared['X'].shape[0] >= batch_size):
+            return self._process_pool, shared
+        self._close_processes()
+        batch_size = max(batch_size, self.batch_size)
+        n_components, n_features = self.components_.shape
+        dtype = self.components_.dtype
+        order = 'F' if self.components_.flags['F_CONTIGUOUS'] else 'C'
+        shapes = {'components_': ((n_components, n_features), order),
+                  'G': ((n_components, n_components), 'C'),
+                  'X': ((batch_size, n_features), 'C'),
+                  'codeTX': ((self.n_processes, n_components, n_features),
+                             'C')}
+        buffers = {}
+        shared = {}
+        for name, (shape, order) in shapes.items():
+            raw = RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+            buffers[name] = (raw, shape, dtype.str, order)
+            shared[name] = _shared_array(raw, shape, dtype, order)
+        shared['components_'][:] = self.components_
+        self.components_ = shared['components_']
+        self._shared = shared
+        self._process_pool = Pool(self.n_processes,
+                                  initializer=_init_coding_process,
+                                  initargs=(buffers,))
+        self._register_exit()
+        return self._process_pool, shared
+
+    def close(self):
+        """
+        Terminate the coding processes started when n_processes > 1. They
+        are started again by the next partial_fit. Called at the end of fit
+
+        Returns
+        -------
+        self
+        """
+        self._close_processes()
+        return self
+
+    def _close_processes(self):
+        """Terminate the coding processes"""
+        pool = self.__dict__.pop('_process_pool', None)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        self.__dict__.pop('_shared', None)
+
+    def _compute_code_and_stats_processes(self, X, w_sample, subset, w,
+                                          code, Dx_average, indices):
+        """Compute code and update B_, C_ using n_processes processes,
+        each of them coding a disjoint shard of the batch.
+
+        code[indices] and Dx_average[indices] hold the statistics of the
+        batch, as returned by _read_sample_stats. Returns the code of the
+        batch"""
+        batch_size, n_features = X.shape
+        profiler = check_profiler(self.profiler)
+        pool, shared = self._get_process_pool(batch_size)
+        with profiler.timer('Dx_G'):
+            if self.G_agg == 'full':
+                shared['G'][:] = self.G_
+            else:
+                components_subset = self.components_[:, subset]
+                shared['G'][:] = self._subset_gram(components_subset)
+                shared['G'] *= self.reduction
+            shared['X'][:batch_size] = X
+        params = dict(reduction=self.reduction, Dx_agg=self.Dx_agg,
+                      G_agg=self.G_agg, code_solver=self.code_solver,
+                      l1_ratio=self.code_l1_ratio, alpha=self.code_alpha,
+                      positive=self.code_pos, tol=self.tol,
+                      max_iter=self.max_iter)
+        shards = [shard for shard in np.array_split(np.arange(batch_size),
+                                                    self.n_processes)
+                  if shard.shape[0] > 0]
+        # Memoryviews returned by the sampler cannot be pickled
+        subset = np.asarray(subset)
+        tasks = [(shard[0], shard[-1] + 1, slot, subset,
+                  None if code is None else code[indices[shard]],
+                  Dx_average[indices[shard]], w_sample[shard], params)
+                 for slot, shard in enumerate(shards)]
+        with profiler.timer('code'):
+            results = pool.starmap(_code_shard, tasks)
+        this_code = np.concatenate([res[0] for res in results])
+        if code is not None:
+            code[indices] = this_code
+        Dx_average[indices] = np.concatenate([res[1] for res in results])
+        profiler.count('cd_iter', sum(res[3] for res in results))
+        with profiler.timer('stats'):
+            self._fold_C(sum(res[2] for res in results), batch_size, w)
+            self._fold_B(shared['codeTX'][:len(shards)].sum(axis=0),
+                         batch_size, w)
+        return this_code
 
     def _compute_code(self, X, sample_indices,
-                      w_sample, subset):
+                      w_sample, subset, code, Dx_average, indices):
         """Update regression statistics if
-        necessary and compute code from X[:, subset]"""
+        necessary and compute code from X[:, subset].
+
+        code[indices] and Dx_average[indices] hold the statistics of
+        sample_indices, as returned by _read_sample_stats. Returns code,
+        cold-started from a ridge solution if None"""
         batch_size, n_features = X.shape
         reduction = self.reduction
+        profiler = check_profiler(self.profiler)
 
-        if self.n_threads > 1:
-            size_job = ceil(batch_size / self.n_threads)
-            batches = list(gen_batches(batch_size, size_job))
-
-        if self.Dx_agg != 'full' or self.G_agg != 'full':
-            components_subset = self.components_[:, subset]
+        with profiler.timer('Dx_G'):
+            if self.Dx_agg != 'full' or self.G_agg != 'full':
+                components_subset = self.components_[:, subset]
 
-        if self.Dx_agg == 'full':
-            Dx = X.dot(self.components_.T)
-        else:
-            X_subset = X[:, subset]
-            Dx = X_subset.dot(components_subset.T) * reduction
-            self.Dx_average_[sample_indices] \
-                *= 1 - w_sample[:, np.newaxis]
-            self.Dx_average_[sample_indices] \
-                += Dx * w_sample[:, np.newaxis]
-            if self.Dx_agg == 'average':
-                Dx = self.Dx_average_[sample_indices]
-
-        if self.G_agg != 'full':
-            G = components_subset.dot(components_subset.T) * reduction
-            if self.G_agg == 'average':
-                G_average = np.array(self.G_average_[sample_indices],
-                                     copy=True)
-                if self.n_threads > 1:
-                    par_func = lambda batch: _update_G_average(
-                        G_average[batch],
-                        G,
-                        w_sample[batch],
-                    )
-                    res = self._pool.map(par_func, batches)
-                    _ = list(res)
-                else:
-                    _update_G_average(G_average, G, w_sample)
-                self.G_average_[sample_indices] = G_average
-        else:
-            G = self.G_
-        if self.n_threads > 1:
-            if self.G_agg == 'average':
-                par_func = lambda batch: _enet_regression_multi_gram(
-                    G_average[batch], Dx[batch], X[batch], self.code_,
-                    get_sub_slice(sample_indices, batch),
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
+            if self.Dx_agg == 'full':
+                Dx = X.dot(self.components_.T)
             else:
-                par_func = lambda batch: _enet_regression_single_gram(
-                    G, Dx[batch], X[batch], self.code_,
-                    get_sub_slice(sample_indices, batch),
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
-            res = self._pool.map(par_func, batches)
-            _ = list(res)
-        else:
+                X_subset = X[:, subset]
+                Dx = X_subset.dot(components_subset.T) * reduction
+                Dx_average[indices] \
+                    *= 1 - w_sample[:, np.newaxis]
+                Dx_average[indices] \
+                    += Dx * w_sample[:, np.newaxis]
+                if self.Dx_agg == 'average':
+                    Dx = Dx_average[indices].astype(self.components_.dtype,
+                                                    copy=False)
+
+            if self.G_agg != 'full':
+                G = self._subset_gram(components_subset) * reduction
+            else:
+                G = self.G_
+        if self.G_agg == 'average':
+            with profiler.timer('G_average_io'):
+                G_average = self.G_average_.read(sample_indices)
+            profiler.count('bytes_read', G_average.nbytes)
+            with profiler.timer('Dx_G'):
+                if self.G_packed:
+                    _update_G_average_packed(G_average, G, w_sample,
+                                             self.n_threads)
+                else:
+                    _update_G_average(G_average, G, w_sample, self.n_threads)
+            with profiler.timer('G_average_io'):
+                self.G_average_.write_async(sample_indices, G_average)
+                if self.code_l1_ratio == 0:
+                    # Ridge regression overwrites G_average
+                    G_average = G_average.copy()
+
+        n_iter = np.zeros(1, dtype='long') if profiler.enabled else None
+        with profiler.timer('code'):
+            if code is None:
+                code = _ridge_code(G, Dx, self.code_alpha,
+                                   self.code_l1_ratio)
             if self.G_agg == 'average':
-                _enet_regression_multi_gram(
-                    G_average, Dx, X, self.code_,
-                    sample_indices,
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
+                if self.G_packed:
+                    _enet_regression_multi_gram_packed(
+                        G_average, Dx, X, code,
+                        indices,
+                        self.code_l1_ratio, self.code_alpha, self.code_pos,
+                        self.tol, self.max_iter, self.n_threads, n_iter)
+                else:
+                    _enet_regression_multi_gram(
+                        G_average, Dx, X, code,
+                        indices,
+                        self.code_l1_ratio, self.code_alpha, self.code_pos,
+                        self.tol, self.max_iter, self.n_threads, n_iter)
             else:
-                _enet_regression_single_gram(
-                    G, Dx, X, self.code_,
-                    sample_indices,
-                    self.code_l1_ratio, self.code_alpha, self.code_pos,
-                    self.tol, self.max_iter)
+                # Screening is only safe with exact Dx and G
+                screening = self.Dx_agg == 'full' and self.G_agg == 'full'
+                self._enet_regression(G, Dx, X, code, indices,
+                                      screening, n_iter)
+        if n_iter is not None:
+            profiler.count('cd_iter', int(n_iter[0]))
+        return code
 
     def _update_dict(self, subset, w):
         """Dictionary update part
@@ -655,69 +1749,148 @@ class DictFact(CodingMixin, BaseEstimator):
             Subset of features to update.
 
         """
-        ger, = scipy.linalg.get_blas_funcs(('ger',), (self.C_,
-                                                      self.components_))
         len_subset = subset.shape[0]
         n_components, n_features = self.components_.shape
-        components_subset = self.components_[:, subset]
-        atom_temp = np.zeros(len_subset, dtype=self.components_.dtype)
-        gradient_subset = self.gradient_[:, subset]
+        components_subset = np.ascontiguousarray(self.components_[:, subset])
+        gradient_subset = np.ascontiguousarray(self.gradient_[:, subset])
 
         if self.G_agg == 'full' and len_subset < n_features / 2.:
-            self.G_ -= components_subset.dot(components_subset.T)
+            self.G_ -= self._subset_gram(components_subset)
 
-        gradient_subset -= self.C_.dot(components_subset)
+        C = self.C_.astype(self.components_.dtype, copy=False)
+        gradient_subset -= C.dot(components_subset)
 
         order = self.random_state.permutation(n_components)
 
-        if self.optimizer == 'variational':
-            for k in order:
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] += subset_norm
-                gradient_subset = ger(1.0, self.C_[k], components_subset[k],
-                                      a=gradient_subset, overwrite_a=True)
-                if self.C_[k, k] > 1e-20:
-                    components_subset[k] = gradient_subset[k] / self.C_[k, k]
-                # Else do not update
-                if self.comp_pos:
-                    components_subset[components_subset < 0] = 0
-                enet_projection(components_subset[k],
-                                atom_temp,
-                                self.comp_norm_[k], self.comp_l1_ratio)
-                components_subset[k] = atom_temp
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] -= subset_norm
-                gradient_subset = ger(-1.0, self.C_[k], components_subset[k],
-                                      a=gradient_subset, overwrite_a=True)
-        else:
-            for k in order:
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] += subset_norm
-            components_subset += w * self.step_size * gradient_subset
-            for k in range(self.n_components):
-                enet_projection(components_subset[k],
-                                atom_temp,
-                                self.comp_norm_[k], self.comp_l1_ratio)
-                components_subset[k] = atom_temp
-                subset_norm = enet_norm(components_subset[k],
-                                        self.comp_l1_ratio)
-                self.comp_norm_[k] -= subset_norm
+        _update_dict_subset(C, components_subset, gradient_subset,
+                            self.comp_norm_, order, self.comp_l1_ratio,
+                            self.comp_pos, self.optimizer == 'variational',
+                            w * self.step_size, self.n_threads)
         self.components_[:, subset] = components_subset
+        if self.feature_block_size is not None:
+            self._refresh_block_gram(self._subset_blocks)
 
         if self.G_agg == 'full':
             if len_subset < n_features / 2.:
-                self.G_ += components_subset.dot(components_subset.T)
+                self.G_ += self._subset_gram(components_subset)
             else:
                 self.G_[:] = self.components_.dot(self.components_.T)
 
+    def _register_exit(self):
+        """Call _exit when the interpreter exits. Registered once per
+        instance, as the handler keeps the instance alive"""
+        if not getattr(self, '_atexit_registered', False):
+            atexit.register(self._exit)
+            self._atexit_registered = True
+
     def _exit(self):
-        """Useful to delete G_average_ memorymap when the algorithm is
-         interrupted/completed"""
-        if hasattr(self, 'G_average_mmap_'):
-            self.G_average_mmap_.close()
+        """Useful to delete G_average_ and per-sample state backing files
+        when the algorithm is interrupted/completed"""
+        self._close_processes()
+        for name in ['G_average_'] + SAMPLE_STATS:
+            if isinstance(getattr(self, name, None), ChunkedStorage):
+                getattr(self, name).close()
+
+
+def reduce_stats(stats_list):
+    """
+    Sum statistics exported by DictFact.export_stats. The result can itself
+    be reduced again, or merged with DictFact.merge_stats, so that
+    statistics can be aggregated along any reduction tree.
+
+    Parameters
+    ----------
+    stats_list: list of dict,
+        Statistics returned by export_stats or reduce_stats
+
+    Returns
+    -------
+    stats: dict,
+        Statistics of the union of the samples
+    """
+    if len(stats_list) == 0:
+        raise ValueError('stats_list should not be empty')
+    stats = {key: np.array(value, copy=True) if key != 'n_iter' else value
+             for key, value in stats_list[0].items()}
+    for this_stats in stats_list[1:]:
+        for key, value in this_stats.items():
+            stats[key] += value
+    return stats
+
+
+def _ridge_code(G, Dx, alpha, l1_ratio):
+    """Cold-start codes solving (G + alpha I) code^T = Dx^T. Ridge
+    regression does not need any, and gets uninitialized codes"""
+    if l1_ratio == 0:
+        return np.empty_like(Dx)
+    G = G + alpha * np.eye(G.shape[0], dtype=G.dtype)
+    return scipy.linalg.cho_solve(scipy.linalg.cho_factor(G), Dx.T).T.copy()
+
+
+def _shared_array(raw, shape, dtype, order):
+    """View the shared buffer raw as an array"""
+    return np.frombuffer(raw, dtype=dtype).reshape(shape, order=order)
+
+
+# Shared arrays of a coding process, set by _init_coding_process
+_coding_process_arrays = {}
+
+
+def _init_coding_process(buffers):
+    """Attach a coding process to the shared buffers of DictFact"""
+    for name, (raw, shape, dtype, order) in buffers.items():
+        _coding_process_arrays[name] = _shared_array(raw, shape, dtype, order)
+
+
+def _code_shard(start, stop, slot, subset, code, Dx_average, w_sample,
+                params):
+    """Code rows start:stop of the shared batch, in a coding process.
+
+    Writes code.T.dot(X) in slot of the shared codeTX buffer, and returns
+    code, the updated Dx_average, code.T.dot(code) and the number of
+    coordinate descent passes"""
+    components = _coding_process_arrays['components_']
+    G = _coding_process_arrays['G']
+    X = _coding_process_arrays['X'][start:stop]
+    reduction = params['reduction']
+    if params['Dx_agg'] == 'full':
+        Dx = X.dot(components.T)
+    else:
+        components_subset = components[:, subset]
+        Dx = X[:, subset].dot(components_subset.T) * reduction
+        Dx_average *= 1 - w_sample[:, np.newaxis]
+        Dx_average += Dx * w_sample[:, np.newaxis]
+        if params['Dx_agg'] == 'average':
+            Dx = Dx_average.astype(components.dtype)
+    if code is None:
+        code = _ridge_code(G, Dx, params['alpha'], params['l1_ratio'])
+    n_iter = np.zeros(1, dtype='long')
+    screening = params['Dx_agg'] == 'full' and params['G_agg'] == 'full'
+    _enet_regression(G, Dx, X, code, np.arange(stop - start),
+                     params['code_solver'], params['l1_ratio'],
+                     params['alpha'], params['positive'], params['tol'],
+                     params['max_iter'], 1, screening, n_iter)
+    np.dot(code.T, X, out=_coding_process_arrays['codeTX'][slot])
+    return code, Dx_average, code.T.dot(code), int(n_iter[0])
+
+
+def _save_array(filename, array):
+    """Write array to a .npy file, copying at most CHECKPOINT_BLOCK_SIZE
+    bytes at once"""
+    if array.ndim == 0 or array.size == 0:
+        np.save(filename, array)
+        return
+    fortran_order = (array.ndim > 1 and array.flags['F_CONTIGUOUS']
+                     and not array.flags['C_CONTIGUOUS'])
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=array.dtype,
+                                    shape=array.shape,
+                                    fortran_order=fortran_order)
+    row_size = max(1, array.nbytes // array.shape[0])
+    for batch in gen_batches(array.shape[0],
+                             max(1, CHECKPOINT_BLOCK_SIZE // row_size)):
+        out[batch] = array[batch]
+    out.flush()
+    del out
 
 
 class Coder(CodingMixin, BaseEstimator):
@@ -728,7 +1901,8 @@ class Coder(CodingMixin, BaseEstimator):
                  max_iter=100,
                  code_pos=False,
                  random_state=None,
-                 n_threads=1
+                 n_threads=1,
+                 code_solver='cd',
                  ):
         self._set_coding_params(dictionary.shape[0],
                                 code_l1_ratio=code_l1_ratio,
@@ -737,8 +1911,33 @@ class Coder(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_solver=code_solver)
         self.components_ = dictionary
 
     def fit(self, X=None):
+        """
+        Cache the ridge solution operators if code_l1_ratio == 0, as the
+        dictionary is fixed: the inverse of G + code_alpha I and the
+        projection D^T (G + code_alpha I)^-1, so that transform reduces to
+        a single matrix product
+
+        Returns
+        -------
+        self
+        """
+        self.__dict__.pop('_ridge_cache', None)
+        if self.code_l1_ratio == 0:
+            components = self.components_
+            n_components = components.shape[0]
+            G = components.dot(components.T).astype(np.float64)
+            G.flat[::n_components + 1] += self.code_alpha
+            inverse = scipy.linalg.cho_solve(scipy.linalg.cho_factor(G),
+                                             np.eye(n_components))
+            projection = inverse.dot(components).T
+            dtype = components.dtype
+            self._ridge_cache = {
+                'alpha': self.code_alpha,
+                'inverse': inverse.astype(dtype),
+                'projection': np.ascontiguousarray(projection, dtype=dtype)}
         return self
@@ -8,27 +8,44 @@ cdef char UP = 'U'
 cdef char NTRANS = 'N'
 cdef char TRANS = 'T'
 cdef int ONE = 1
+# Frequency of the duality gap computation when screening
+cdef int SCREEN_FREQ = 10
 
 from cython cimport floating
 
-from scipy.linalg.cython_blas cimport saxpy, daxpy, sdot, ddot, sasum, dasum, dgemv, sgemv
-from scipy.linalg.cython_lapack cimport dposv, sposv
+from scipy.linalg.cython_blas cimport saxpy, daxpy, sdot, ddot, sasum, dasum, dgemv, sgemv, \
+    sgemm, dgemm, sger, dger
+from scipy.linalg.cython_lapack cimport dposv, sposv, dppsv, sppsv
 
-from libc.math cimport pow, fabs
+from libc.math cimport pow, fabs, sqrt
+from libc.stdlib cimport malloc, free
 
 cimport numpy as np
 import numpy as np
 
 from cython cimport view
+from cython.parallel cimport prange, threadid
+
+from ..utils.math.enet cimport enet_norm, enet_projection, \
+    enet_projection_rows_nogil
 
 ctypedef void (*POSV)(char * UPLO, int* N,
                           int* NRHS, floating* A, int* LDA,
-                          floating *B, int* LDB, int* INFO)
+                          floating *B, int* LDB, int* INFO) nogil
+ctypedef void (*PPSV)(char * UPLO, int* N,
+                     int* NRHS, floating* AP,
+                     floating *B, int* LDB, int* INFO) nogil
+ctypedef void (*GEMM)(char* transA, char* transB, int* M, int* N, int* K,
+                      floating* alpha, floating* A, int* lda,
+                      floating* B, int* ldb, floating* beta,
+                      floating* C, int* ldc) nogil
 ctypedef floating (*DOT)(int* N, floating* X, int* incX, floating* Y,
                          int* incY) nogil
 ctypedef void (*AXPY)(int* N, floating* alpha, floating* X, int* incX,
                       floating* Y, int* incY) nogil
 ctypedef floating (*ASUM)(int* N, floating* X, int* incX) nogil
+ctypedef void (*GER)(int* M, int* N, floating* alpha, floating* X, int* incX,
+                     floating* Y, int* incY, floating* A, int* lda) nogil
 
 
 def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
@@ -39,6 +56,8 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
                                 bint positive,
                                 floating tol,
                                 int max_iter,
+                                int n_threads=1,
+                                long[:] n_iter=None,
                                 ):
     '''
     Perform elastic net regression: for all i in indices,
@@ -56,22 +75,21 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
     l1_ratio: floating, enet-regression parameter
     alpha: floating, enet-regression paramater
     positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads used to iterate over samples
+    n_iter: array, shape (1), if not None, incremented by the number of
+        coordinate descent passes
     '''
     cdef int batch_size = indices.shape[0]
     cdef int n_components = code.shape[1]
     cdef int i, j, info, ii
+    cdef long total_iter = 0
     cdef floating* G_ptr = <floating*> &G[0, 0, 0]
     cdef floating* code_ptr = <floating*> &code[0, 0]
     cdef POSV posv
     cdef str format
 
-
-    cdef floating[:] this_code
-    cdef floating[::1] this_Dx
-    cdef floating[:] this_X
-    cdef floating[:, ::1] this_G
-    cdef floating[:] H
-    cdef floating[:] XtA
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
 
     if floating is float:
         posv = sposv
@@ -80,39 +98,127 @@ def _enet_regression_multi_gram(floating[:, :, ::1] G, floating[:, ::1] Dx,
         posv = dposv
         format = 'd'
 
+    if n_threads < 1:
+        n_threads = 1
+
     if l1_ratio == 0:
-        for ii in range(batch_size):
-            i = indices[ii]
-            code[i, :] = Dx[ii, :]
-            for j in range(n_components):
-                G[ii, j, j] += alpha
-            posv(&UP, &n_components, &ONE,
-                G_ptr + ii * n_components ** 2,
-                &n_components,
-                code_ptr + i * n_components, &n_components,
-                &info)
-            for j in range(n_components):
-                G[ii, j, j] -= alpha
+        with nogil:
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='static'):
+                i = indices[ii]
+                for j in range(n_components):
+                    code[i, j] = Dx[ii, j]
+                    G[ii, j, j] += alpha
+                posv(&UP, &n_components, &ONE,
+                    G_ptr + ii * n_components ** 2,
+                    &n_components,
+                    code_ptr + i * n_components, &n_components,
+                    &info)
+                for j in range(n_components):
+                    G[ii, j, j] -= alpha
     else:
-        H = view.array((n_components, ), sizeof(floating),
+        # Per-thread scratch buffers
+        H = view.array((n_threads, n_components), sizeof(floating),
                        format=format, mode='c')
-        XtA = view.array((n_components, ), sizeof(floating),
+        XtA = view.array((n_threads, n_components), sizeof(floating),
                          format=format, mode='c')
         with nogil:
-            for ii in range(batch_size):
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='dynamic'):
+                total_iter += _enet_regression_sample(
+                    G, ii, Dx, X, code, H, XtA, ii, indices[ii], threadid(),
+                    alpha * l1_ratio, alpha * (1 - l1_ratio),
+                    max_iter, tol, positive, False)
+    if n_iter is not None:
+        n_iter[0] += total_iter
+    return np.asarray(code)
+
+def _enet_regression_multi_gram_packed(floating[:, ::1] G,
+                                       floating[:, ::1] Dx,
+                                       floating[:, ::1] X,
+                                       floating[: , ::1] code,
+                                       long[:] indices,
+                                       floating l1_ratio, floating alpha,
+                                       bint positive,
+                                       floating tol,
+                                       int max_iter,
+                                       int n_threads=1,
+                                       long[:] n_iter=None,
+                                       ):
+    '''
+    Same as _enet_regression_multi_gram, with Gram matrices stored in
+    packed format (see _update_G_average_packed). G is modified inplace
+    when l1_ratio == 0.
+
+    Parameters
+    ----------
+    G: array, shape (batch_size x n_components * (n_components + 1) / 2)
+    Dx: array, shape (batch_size x n_components)
+    X: array, shape (batch_size x n_features)
+    code: array, shape (n_samples x n_components)
+    indices: array, shape (batch_size
+    l1_ratio: floating, enet-regression parameter
+    alpha: floating, enet-regression paramater
+    positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads used to iterate over samples
+    n_iter: array, shape (1), if not None, incremented by the number of
+        coordinate descent passes
+    '''
+    cdef int batch_size = indices.shape[0]
+    cdef int n_components = code.shape[1]
+    cdef int i, j, info, ii, tid
+    cdef long total_iter = 0
+    cdef floating* code_ptr = <floating*> &code[0, 0]
+    cdef PPSV ppsv
+    cdef str format
+
+    cdef floating[:, :, ::1] G_full
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
+
+    if floating is float:
+        ppsv = sppsv
+        format = 'f'
+    else:
+        ppsv = dppsv
+        format = 'd'
+
+    if n_threads < 1:
+        n_threads = 1
+
+    if l1_ratio == 0:
+        with nogil:
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='static'):
                 i = indices[ii]
-                this_G = G[ii, :, :]
-                this_Dx = Dx[ii, :]
-                this_X = X[ii, :]
-                this_code = code[i, :]
-                enet_coordinate_descent_gram(
-                    this_code,
-                    alpha * l1_ratio,
-                    alpha * (1 - l1_ratio),
-                    this_G, this_Dx, this_X, H, XtA, max_iter, tol,
-                    positive)
+                for j in range(n_components):
+                    code[i, j] = Dx[ii, j]
+                    G[ii, j * (j + 3) // 2] += alpha
+                ppsv(&UP, &n_components, &ONE, &G[ii, 0],
+                     code_ptr + i * n_components, &n_components,
+                     &info)
+    else:
+        # Per-thread unpacked Gram matrices and scratch buffers
+        G_full = view.array((n_threads, n_components, n_components),
+                            sizeof(floating), format=format, mode='c')
+        H = view.array((n_threads, n_components), sizeof(floating),
+                       format=format, mode='c')
+        XtA = view.array((n_threads, n_components), sizeof(floating),
+                         format=format, mode='c')
+        with nogil:
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='dynamic'):
+                tid = threadid()
+                _unpack_gram(&G[ii, 0], &G_full[tid, 0, 0], n_components)
+                total_iter += _enet_regression_sample(
+                    G_full, tid, Dx, X, code, H, XtA, ii, indices[ii], tid,
+                    alpha * l1_ratio, alpha * (1 - l1_ratio),
+                    max_iter, tol, positive, False)
+    if n_iter is not None:
+        n_iter[0] += total_iter
     return np.asarray(code)
 
+
 def _batch_weight(long count, long batch_size,
            double learning_rate, double offset):
     cdef long i
@@ -130,7 +236,11 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
                                 floating l1_ratio, floating alpha,
                                 bint positive,
                                 floating tol,
-                                int max_iter):
+                                int max_iter,
+                                int n_threads=1,
+                                bint screening=False,
+                                bint lars=False,
+                                long[:] n_iter=None):
     '''
     Perform elastic net regression: for all i in indices,
     find code[i] s.t code[i].dot(G) = Dx[ii], where i = indices[ii].
@@ -147,23 +257,33 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
     l1_ratio: floating, enet-regression parameter
     alpha: floating, enet-regression paramater
     positive: bint, enet-regression parameter
+    n_threads: int, number of OpenMP threads used to iterate over samples
+    screening: bint, whether to use gap-safe screening in coordinate
+        descent. Only valid if G = D D^T and Dx = X D^T for the same D
+    lars: bint, whether to use the homotopy (LARS) solver instead of
+        coordinate descent. Paths truncated after 2 * n_components steps
+        are finished by coordinate descent
+    n_iter: array, shape (1), if not None, incremented by the number of
+        coordinate descent passes and of LARS steps
     '''
     cdef int batch_size = indices.shape[0]
     cdef int i, j, info, ii
+    cdef long total_iter = 0
     cdef int n_components = G.shape[0]
     cdef int n_features = X.shape[1]
     cdef floating* G_ptr = <floating*> &G[0, 0]
     cdef floating* Dx_ptr = <floating*> &Dx[0, 0]
     cdef POSV posv
     cdef str format
-    cdef floating[:] this_code
-    cdef floating[::1] this_Dx
-    cdef floating[:] this_X
     cdef floating[:, ::1] G_copy
-    cdef floating[:, ::1] code_copy
+    cdef floating[:, :, ::1] G_single
+    cdef floating[:, ::1] lars_buf
+    cdef int[:, ::1] lars_int_buf
+    cdef int n_steps
+    cdef bint reached
 
-    cdef floating[:] H
-    cdef floating[:] XtA
+    cdef floating[:, ::1] H
+    cdef floating[:, ::1] XtA
 
     if floating is float:
         posv = sposv
@@ -172,6 +292,9 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
         posv = dposv
         format = 'd'
 
+    if n_threads < 1:
+        n_threads = 1
+
     if l1_ratio == 0:
         # Make it thread-safe
         G_copy = view.array((n_components, n_components),
@@ -183,9 +306,7 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
         for j in range(n_components):
             G[j, j] += alpha
 
-        code_copy = view.array((batch_size, n_components),
-                                      sizeof(floating),
-                                      format=format, mode='c')
+        # A single multiple right-hand side solve
         posv(&UP, &n_components, &batch_size,
         G_ptr,
         &n_components,
@@ -193,42 +314,529 @@ def _enet_regression_single_gram(floating[:, ::1] G, floating[:, ::1] Dx,
         &info)
         for j in range(n_components):
             G[j, j] -= alpha
-        for ii in range(batch_size):
-            i = indices[ii]
-            code[i, :] = Dx[ii, :]
+        with nogil:
+            for ii in prange(batch_size, num_threads=n_threads,
+                             schedule='static'):
+                i = indices[ii]
+                for j in range(n_components):
+                    code[i, j] = Dx[ii, j]
     else:
-        H = view.array((n_components, ), sizeof(floating),
+        G_single = np.asarray(G)[np.newaxis]
+        # Per-thread scratch buffers
+        H = view.array((n_threads, n_components), sizeof(floating),
                    format=format, mode='c')
-        XtA = view.array((n_components, ), sizeof(floating),
+        XtA = view.array((n_threads, n_components), sizeof(floating),
                      format=format, mode='c')
-        with nogil:
-            for ii in range(batch_size):
-                i = indices[ii]
-                this_Dx = Dx[ii, :]
-                this_X = X[ii, :]
-                this_code = code[i, :]
-                enet_coordinate_descent_gram(
-                    this_code,
-                    alpha * l1_ratio,
-                    alpha * (1 - l1_ratio),
-                    G, this_Dx, this_X, H, XtA, max_iter, tol,
-                    positive)
+        if lars:
+            # Per-thread Cholesky factor and vectors
+            lars_buf = view.array((n_threads,
+                                   n_components * (n_components + 4)),
+                                  sizeof(floating), format=format, mode='c')
+            lars_int_buf = view.array((n_threads, 2 * n_components),
+                                      sizeof(int), format='i', mode='c')
+            with nogil:
+                for ii in prange(batch_size, num_threads=n_threads,
+                                 schedule='dynamic'):
+                    reached = enet_lars_gram(&code[indices[ii], 0],
+                                             alpha * l1_ratio,
+                                             alpha * (1 - l1_ratio),
+                                             G_ptr, &Dx[ii, 0],
+                                             n_components, positive,
+                                             &lars_buf[threadid(), 0],
+                                             &lars_int_buf[threadid(), 0],
+                                             &n_steps)
+                    total_iter += n_steps
+                    if not reached:
+                        # Finish the truncated path by coordinate descent,
+                        # warm-started from the LARS code
+                        total_iter += _enet_regression_sample(
+                            G_single, 0, Dx, X, code, H, XtA, ii,
+                            indices[ii], threadid(), alpha * l1_ratio,
+                            alpha * (1 - l1_ratio), max_iter, tol,
+                            positive, screening)
+        else:
+            with nogil:
+                for ii in prange(batch_size, num_threads=n_threads,
+                                 schedule='dynamic'):
+                    total_iter += _enet_regression_sample(
+                        G_single, 0, Dx, X, code, H, XtA, ii, indices[ii],
+                        threadid(), alpha * l1_ratio,
+                        alpha * (1 - l1_ratio), max_iter, tol, positive,
+                        screening)
+    if n_iter is not None:
+        n_iter[0] += total_iter
     return np.asarray(code)
 
+cdef int _enet_regression_sample(floating[:, :, ::1] G, int g,
+                                  floating[:, ::1] Dx,
+                                  floating[:, ::1] X,
+                                  floating[:, ::1] code,
+                                  floating[:, ::1] H,
+                                  floating[:, ::1] XtA,
+                                  int ii, long i, int tid,
+                                  floating alpha, floating beta,
+                                  int max_iter, floating tol,
+                                  bint positive,
+                                  bint screening) nogil:
+    """Elastic-net regression of a single sample, using the scratch
+    buffers of thread tid. Returns the number of coordinate descent
+    passes"""
+    cdef floating[:, ::1] this_G = G[g]
+    cdef floating[::1] this_Dx = Dx[ii]
+    cdef floating[:] this_X = X[ii]
+    cdef floating[:] this_code = code[i]
+    cdef floating[:] this_H = H[tid]
+    cdef floating[:] this_XtA = XtA[tid]
+    return enet_coordinate_descent_gram(this_code, alpha, beta, this_G,
+                                        this_Dx, this_X, this_H, this_XtA,
+                                        max_iter, tol, positive, screening)
+
+
 def _update_G_average(floating[:, :, ::1] G_average,
                               floating[:, ::1] G,
-                              floating[:] w_sample):
+                              floating[:] w_sample,
+                              int n_threads=1):
     cdef int batch_size = w_sample.shape[0]
     cdef int n_components = G_average.shape[1]
     cdef int ii, i, k, p, q
-    for ii in range(batch_size):
-        for p in range(n_components):
+    if n_threads < 1:
+        n_threads = 1
+    with nogil:
+        for ii in prange(batch_size, num_threads=n_threads,
+                         schedule='static'):
+            for p in range(n_components):
+                for q in range(n_components):
+                    G_average[ii, p, q] *= (1 - w_sample[ii])
+                    G_average[ii, p, q] += G[p, q] * w_sample[ii]
+    return G_average
+
+
+def _update_G_average_packed(floating[:, ::1] G_average,
+                             floating[:, ::1] G,
+                             floating[:] w_sample,
+                             int n_threads=1):
+    '''
+    Same as _update_G_average, with G_average[ii] holding the upper
+    triangle of the averaged Gram matrix in LAPACK packed format:
+    G_average[ii, p + q * (q + 1) // 2] for p <= q.
+    '''
+    cdef int batch_size = w_sample.shape[0]
+    cdef int n_components = G.shape[0]
+    cdef int ii, p, q, l
+    if n_threads < 1:
+        n_threads = 1
+    with nogil:
+        for ii in prange(batch_size, num_threads=n_threads,
+                         schedule='static'):
             for q in range(n_components):
-                G_average[ii, p, q] *= (1 - w_sample[ii])
-                G_average[ii, p, q] += G[p, q] * w_sample[ii]
+                for p in range(q + 1):
+                    l = p + q * (q + 1) // 2
+                    G_average[ii, l] *= (1 - w_sample[ii])
+                    G_average[ii, l] += G[p, q] * w_sample[ii]
     return G_average
 
 
+cdef void _unpack_gram(floating* G_packed, floating* G, int n) nogil:
+    """Unpack a symmetric matrix stored in packed format into a full
+    n x n array"""
+    cdef int p, q
+    cdef floating v
+    for q in range(n):
+        for p in range(q + 1):
+            v = G_packed[p + q * (q + 1) // 2]
+            G[p * n + q] = v
+            G[q * n + p] = v
+
+
+def _single_batch_fit_fused(floating[:, ::1] X,
+                            long[:] sample_indices,
+                            long[:] subset,
+                            floating[:] w_sample,
+                            floating[:, ::1] components,
+                            floating[:, ::1] code,
+                            floating[:, ::1] Dx_average,
+                            floating[:, ::1] C,
+                            floating[:, ::1] B,
+                            floating[:, :] gradient,
+                            floating[:, ::1] G,
+                            floating[:] comp_norm,
+                            long[:] order,
+                            tuple workspace,
+                            double w,
+                            floating reduction,
+                            str Dx_agg,
+                            str G_agg,
+                            bint variational,
+                            bint lazy_B,
+                            double B_scale,
+                            bint feature_major,
+                            floating step_size,
+                            floating code_l1_ratio,
+                            floating code_alpha,
+                            bint code_pos,
+                            floating tol,
+                            int max_iter,
+                            floating comp_l1_ratio,
+                            bint comp_pos):
+    '''
+    Perform a whole DictFact mini-batch step in a single nogil call: subset
+    gather, Dx and G computation, coding, C and B statistics update and
+    dictionary update restricted to the subset. All arrays are modified
+    inplace.
+
+    Parameters
+    ----------
+    X: array, shape (batch_size, n_features)
+    sample_indices: array, shape (batch_size)
+    subset: array, shape (len_subset), non empty
+    w_sample: array, shape (batch_size), weights for Dx_average
+    components: array, shape (n_components, n_features), or
+        (n_features, n_components) if feature_major
+    code: array, shape (n_samples, n_components)
+    Dx_average: array, shape (n_samples, n_components)
+    C: array, shape (n_components, n_components)
+    B: array, shape (n_components, n_features), or
+        (n_features, n_components) if feature_major
+    gradient: array, shape (n_components, n_features), or
+        (n_features, n_components) if feature_major
+    G: array, shape (n_components, n_components), used if G_agg == 'full'
+    comp_norm: array, shape (n_components)
+    order: array, shape (n_components), order of the atom updates
+    lazy_B: bint, whether B holds the statistic divided by B_scale, in which
+        case the (1 - w) decay is already applied to B_scale
+    feature_major: bint, whether components, B and gradient are given
+        transposed, so that subset gathers and scatters are row copies
+    workspace: tuple of flat buffers (X_subset, components_subset,
+        gradient_subset, Dx, G_subset, G_ridge, this_code, H, XtA,
+        atom_temp), large enough for the batch and the subset
+    '''
+    cdef int batch_size = X.shape[0]
+    cdef int n_features = X.shape[1]
+    cdef int n_components = code.shape[1]
+    cdef int len_subset = subset.shape[0]
+    cdef int i, ii, j, jj, k, info
+    cdef bint full_Dx = Dx_agg == 'full'
+    cdef bint average_Dx = Dx_agg == 'average'
+    cdef bint full_G = G_agg == 'full'
+    cdef floating one = 1
+    cdef floating zero = 0
+    cdef floating m_one = -1
+    # Leading dimension of components and B seen as Fortran arrays
+    cdef int ld_comp = n_components if feature_major else n_features
+    cdef char* comp_trans = &NTRANS if feature_major else &TRANS
+    cdef char* comp_ntrans = &TRANS if feature_major else &NTRANS
+    cdef floating alpha, beta, B_alpha, B_beta
+    cdef floating B_scale_ = B_scale
+    cdef GEMM gemm
+    cdef POSV posv
+
+    if floating is float:
+        gemm = sgemm
+        posv = sposv
+    else:
+        gemm = dgemm
+        posv = dposv
+
+    cdef floating[::1] X_subset_buf = workspace[0]
+    cdef floating[::1] components_subset_buf = workspace[1]
+    cdef floating[::1] gradient_subset_buf = workspace[2]
+    cdef floating[::1] Dx_buf = workspace[3]
+    cdef floating[::1] G_subset_buf = workspace[4]
+    cdef floating[::1] G_ridge_buf = workspace[5]
+    cdef floating[::1] this_code_buf = workspace[6]
+    cdef floating[:] H = workspace[7]
+    cdef floating[:] XtA = workspace[8]
+    cdef floating[::1] atom_temp_buf = workspace[9]
+    cdef floating[:] atom_temp = atom_temp_buf[:len_subset]
+
+    cdef floating* X_ptr = &X[0, 0]
+    cdef floating* components_ptr = &components[0, 0]
+    cdef floating* X_subset = &X_subset_buf[0]
+    cdef floating* Dx_ptr = &Dx_buf[0]
+    cdef floating* this_code = &this_code_buf[0]
+    cdef floating* G_ridge = &G_ridge_buf[0]
+    cdef floating[:, ::1] components_subset = \
+        <floating[:n_components, :len_subset]> &components_subset_buf[0]
+    cdef floating[:, ::1] gradient_subset = \
+        <floating[:n_components, :len_subset]> &gradient_subset_buf[0]
+    cdef floating[:, ::1] Dx = <floating[:batch_size, :n_components]> Dx_ptr
+    cdef floating[:, ::1] this_G
+    cdef floating[:] code_row
+    cdef floating[::1] Dx_row
+    cdef floating[:] X_row
+    cdef floating* cs_ptr = &components_subset[0, 0]
+    cdef floating* gs_ptr = &gradient_subset[0, 0]
+
+    if full_G:
+        this_G = G
+    else:
+        this_G = <floating[:n_components, :n_components]> &G_subset_buf[0]
+
+    with nogil:
+        # Subset gather
+        if feature_major:
+            for jj in range(len_subset):
+                j = subset[jj]
+                for k in range(n_components):
+                    components_subset[k, jj] = components[j, k]
+        else:
+            for k in range(n_components):
+                for jj in range(len_subset):
+                    components_subset[k, jj] = components[k, subset[jj]]
+        if not full_Dx:
+            for ii in range(batch_size):
+                for jj in range(len_subset):
+                    X_subset[ii * len_subset + jj] = X[ii, subset[jj]]
+
+        # Dx = X.dot(components.T)
+        if full_Dx:
+            gemm(comp_trans, &NTRANS, &n_components, &batch_size,
+                 &n_features, &one, components_ptr, &ld_comp,
+                 X_ptr, &n_features, &zero, Dx_ptr, &n_components)
+        else:
+            gemm(&TRANS, &NTRANS, &n_components, &batch_size, &len_subset,
+                 &reduction, cs_ptr, &len_subset, X_subset, &len_subset,
+                 &zero, Dx_ptr, &n_components)
+            for ii in range(batch_size):
+                i = sample_indices[ii]
+                for k in range(n_components):
+                    Dx_average[i, k] *= 1 - w_sample[ii]
+                    Dx_average[i, k] += Dx[ii, k] * w_sample[ii]
+                    if average_Dx:
+                        Dx[ii, k] = Dx_average[i, k]
+
+        # G = components_subset.dot(components_subset.T)
+        if not full_G:
+            gemm(&TRANS, &NTRANS, &n_components, &n_components, &len_subset,
+                 &reduction, cs_ptr, &len_subset, cs_ptr, &len_subset,
+                 &zero, &this_G[0, 0], &n_components)
+
+        # Coding
+        if code_l1_ratio == 0:
+            for k in range(n_components):
+                for j in range(n_components):
+                    G_ridge[k * n_components + j] = this_G[k, j]
+                G_ridge[k * n_components + k] += code_alpha
+            posv(&UP, &n_components, &batch_size, G_ridge, &n_components,
+                 Dx_ptr, &n_components, &info)
+            for ii in range(batch_size):
+                i = sample_indices[ii]
+                for k in range(n_components):
+                    code[i, k] = Dx[ii, k]
+        else:
+            for ii in range(batch_size):
+                i = sample_indices[ii]
+                code_row = code[i]
+                Dx_row = Dx[ii]
+                X_row = X[ii]
+                enet_coordinate_descent_gram(
+                    code_row, code_alpha * code_l1_ratio,
+                    code_alpha * (1 - code_l1_ratio),
+                    this_G, Dx_row, X_row, H, XtA, max_iter, tol, code_pos,
+                    full_Dx and full_G)
+        for ii in range(batch_size):
+            i = sample_indices[ii]
+            for k in range(n_components):
+                this_code[ii * n_components + k] = code[i, k]
+
+        # C = (1 - w) C + w / batch_size * this_code.T.dot(this_code)
+        # B = (1 - w) B + w / batch_size * this_code.T.dot(X)
+        if variational:
+            alpha = w / batch_size
+            beta = 1 - w
+        else:
+            alpha = 1. / batch_size
+            beta = 0
+        if lazy_B:
+            B_alpha = alpha / B_scale_
+            B_beta = 1
+        else:
+            B_alpha = alpha
+            B_beta = beta
+        gemm(&NTRANS, &TRANS, &n_components, &n_components, &batch_size,
+             &alpha, this_code, &n_components, this_code, &n_components,
+             &beta, &C[0, 0], &n_components)
+        if feature_major:
+            gemm(&NTRANS, &TRANS, &n_components, &n_features, &batch_size,
+                 &B_alpha, this_code, &n_components, X_ptr, &n_features,
+                 &B_beta, &B[0, 0], &n_components)
+        else:
+            gemm(&NTRANS, &TRANS, &n_features, &n_components, &batch_size,
+                 &B_alpha, X_ptr, &n_features, this_code, &n_components,
+                 &B_beta, &B[0, 0], &n_features)
+
+        # Dictionary update
+        if feature_major:
+            for jj in range(len_subset):
+                j = subset[jj]
+                for k in range(n_components):
+                    gradient[j, k] = B[j, k] * B_scale_
+                    gradient_subset[k, jj] = gradient[j, k]
+        else:
+            for k in range(n_components):
+                for jj in range(len_subset):
+                    j = subset[jj]
+                    gradient[k, j] = B[k, j] * B_scale_
+                    gradient_subset[k, jj] = gradient[k, j]
+        if full_G and len_subset < n_features / 2.:
+            gemm(&TRANS, &NTRANS, &n_components, &n_components, &len_subset,
+                 &m_one, cs_ptr, &len_subset, cs_ptr, &len_subset,
+                 &one, &G[0, 0], &n_components)
+        # gradient_subset -= C.dot(components_subset)
+        gemm(&NTRANS, &NTRANS, &len_subset, &n_components, &n_components,
+             &m_one, cs_ptr, &len_subset, &C[0, 0], &n_components,
+             &one, gs_ptr, &len_subset)
+        _update_dict_subset_nogil(C, components_subset, gradient_subset,
+                                  comp_norm, order, atom_temp,
+                                  comp_l1_ratio, comp_pos, variational,
+                                  <floating> (w * step_size), 1)
+        if feature_major:
+            for jj in range(len_subset):
+                j = subset[jj]
+                for k in range(n_components):
+                    components[j, k] = components_subset[k, jj]
+        else:
+            for k in range(n_components):
+                for jj in range(len_subset):
+                    components[k, subset[jj]] = components_subset[k, jj]
+        if full_G:
+            if len_subset < n_features / 2.:
+                gemm(&TRANS, &NTRANS, &n_components, &n_components,
+                     &len_subset, &one, cs_ptr, &len_subset,
+                     cs_ptr, &len_subset, &one, &G[0, 0], &n_components)
+            else:
+                gemm(comp_trans, comp_ntrans, &n_components, &n_components,
+                     &n_features, &one, components_ptr, &ld_comp,
+                     components_ptr, &ld_comp,
+                     &zero, &G[0, 0], &n_components)
+
+
+def _update_dict_subset(floating[:, ::1] C,
+                        floating[:, ::1] components_subset,
+                        floating[:, ::1] gradient_subset,
+                        floating[:] comp_norm,
+                        long[:] order,
+                        floating comp_l1_ratio,
+                        bint comp_pos,
+                        bint variational,
+                        floating step,
+                        int n_threads=1):
+    '''
+    Dictionary update restricted to a subset of features, in place and
+    without the GIL.
+
+    Parameters
+    ----------
+    C: array, shape (n_components, n_components)
+    components_subset: array, shape (n_components, len_subset)
+    gradient_subset: array, shape (n_components, len_subset), should hold
+        B[:, subset] - C.dot(components_subset). Overwritten
+    comp_norm: array, shape (n_components), norm of each atom outside of
+        the subset
+    order: array, shape (n_components), order of the atom updates
+    comp_l1_ratio: floating, l1 ratio of the atom constraint
+    comp_pos: bint, whether atoms are constrained to be positive
+    variational: bint, whether to perform block coordinate descent, or a
+        projected gradient step of size step
+    step: floating, gradient step size
+    n_threads: int, number of OpenMP threads used to project the atoms in
+        the projected gradient step
+    '''
+    cdef int len_subset = components_subset.shape[1]
+    cdef floating[:] atom_temp
+    cdef str format
+    if floating is float:
+        format = 'f'
+    else:
+        format = 'd'
+    if len_subset == 0:
+        return
+    atom_temp = view.array((len_subset, ), sizeof(floating),
+                           format=format, mode='c')
+    with nogil:
+        _update_dict_subset_nogil(C, components_subset, gradient_subset,
+                                  comp_norm, order, atom_temp,
+                                  comp_l1_ratio, comp_pos, variational,
+                                  step, n_threads)
+
+
+cdef void _update_dict_subset_nogil(floating[:, ::1] C,
+                                    floating[:, ::1] components_subset,
+                                    floating[:, ::1] gradient_subset,
+                                    floating[:] comp_norm,
+                                    long[:] order,
+                                    floating[:] atom_temp,
+                                    floating comp_l1_ratio,
+                                    bint comp_pos,
+                                    bint variational,
+                                    floating step,
+                                    int n_threads) nogil:
+    """Block coordinate descent (variational) or projected gradient step
+    (sgd) over the atoms, restricted to a subset of features.
+    gradient_subset should hold B[:, subset] - C.dot(components_subset)"""
+    cdef int n_components = components_subset.shape[0]
+    cdef int len_subset = components_subset.shape[1]
+    cdef int j, k, kk
+    cdef floating one = 1
+    cdef floating m_one = -1
+    cdef floating[:] atom
+    # Fused cpdef functions only specialize on exactly matching memoryviews
+    cdef floating[:, :] components_view = components_subset
+    cdef floating[:, :] gradient_view = gradient_subset
+    cdef floating* cs_ptr = &components_subset[0, 0]
+    cdef floating* gs_ptr = &gradient_subset[0, 0]
+    cdef AXPY axpy
+    cdef GER ger
+
+    if floating is float:
+        axpy = saxpy
+        ger = sger
+    else:
+        axpy = daxpy
+        ger = dger
+
+    if variational:
+        for kk in range(n_components):
+            k = order[kk]
+            atom = components_subset[k]
+            comp_norm[k] += enet_norm(atom, comp_l1_ratio)
+            # gradient_subset += np.outer(C[k], components_subset[k]),
+            # seen by BLAS as a Fortran (len_subset, n_components) array
+            ger(&len_subset, &n_components, &one, cs_ptr + k * len_subset,
+                &ONE, &C[k, 0], &ONE, gs_ptr, &len_subset)
+            if C[k, k] > 1e-20:
+                for j in range(len_subset):
+                    atom[j] = gradient_subset[k, j] / C[k, k]
+            # Else do not update
+            if comp_pos:
+                for j in range(len_subset):
+                    if atom[j] < 0:
+                        atom[j] = 0
+            enet_projection(atom, atom_temp, comp_norm[k], comp_l1_ratio)
+            atom[:] = atom_temp
+            comp_norm[k] -= enet_norm(atom, comp_l1_ratio)
+            # gradient_subset -= np.outer(C[k], components_subset[k])
+            ger(&len_subset, &n_components, &m_one, cs_ptr + k * len_subset,
+                &ONE, &C[k, 0], &ONE, gs_ptr, &len_subset)
+    else:
+        for kk in range(n_components):
+            k = order[kk]
+            atom = components_subset[k]
+            comp_norm[k] += enet_norm(atom, comp_l1_ratio)
+        for k in range(n_components):
+            axpy(&len_subset, &step, gs_ptr + k * len_subset, &ONE,
+                 cs_ptr + k * len_subset, &ONE)
+        # All atoms are projected at once, gradient_subset is free to hold
+        # the result
+        enet_projection_rows_nogil(components_view, gradient_view,
+                                   comp_norm, comp_l1_ratio, comp_pos,
+                                   n_threads)
+        components_subset[:, :] = gradient_subset
+        for k in range(n_components):
+            atom = components_subset[k]
+            comp_norm[k] -= enet_norm(atom, comp_l1_ratio)
+
+
 # Shamelessly copied from sklearn (no .pxd in sources :-( )
 cdef inline floating fmax(floating x, floating y) nogil:
     if x > y:
@@ -268,13 +876,14 @@ cdef floating max(int n, floating* a) nogil:
             m = d
     return m
 
-cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating beta,
+cdef int enet_coordinate_descent_gram(floating[:] w, floating alpha, floating beta,
                                  floating[:, ::1] Q,
                                  floating[::1] q,
                                  floating[:] y,
                                  floating[:] H,
                                  floating[:] XtA,
-                                 int max_iter, floating tol, bint positive) nogil:
+                                 int max_iter, floating tol, bint positive,
+                                 bint screening=False) nogil:
     """Cython version of the coordinate descent algorithm
         for Elastic-Net regression
 
@@ -285,6 +894,14 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
         which amount to the Elastic-Net problem when:
         Q = X^T X (Gram matrix)
         q = X^T y
+
+        If screening, the duality gap is computed every SCREEN_FREQ
+        iterations and used to discard coordinates that are provably zero
+        at the optimum (gap-safe sphere test), the following iterations
+        looping over the remaining active set. This requires Q, q and y to
+        be consistent.
+
+        Returns the number of passes over the coordinates.
     """
 
     # fused types version of BLAS functions
@@ -320,7 +937,12 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
     cdef floating dual_norm_XtA
     cdef int ii
     cdef int n_iter = 0
+    cdef int n_passes = 0
     cdef int f_iter
+    cdef int n_active = n_features
+    cdef int n_active_iter
+    cdef int* active = NULL
+    cdef floating radius, screen_tmp
 
     cdef floating* w_ptr = <floating*>&w[0]
     cdef floating* Q_ptr = &Q[0, 0]
@@ -349,11 +971,20 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
 
     XtA[:] = 0
 
+    if screening:
+        active = <int*> malloc(n_features * sizeof(int))
+        for ii in range(n_features):
+            active[ii] = ii
+
     for n_iter in range(max_iter):
+        n_passes += 1
         w_max = 0.0
         d_w_max = 0.0
-        for f_iter in range(n_features):  # Loop over coordinates
-            ii = f_iter
+        for f_iter in range(n_active):  # Loop over coordinates
+            if screening:
+                ii = active[f_iter]
+            else:
+                ii = f_iter
 
             if Q[ii, ii] == 0.0:
                 continue
@@ -386,7 +1017,9 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
             if fabs(w[ii]) > w_max:
                 w_max = fabs(w[ii])
 
-        if w_max == 0.0 or d_w_max / w_max < d_w_tol or n_iter == max_iter - 1:
+        if (w_max == 0.0 or d_w_max / w_max < d_w_tol
+                or n_iter == max_iter - 1
+                or (screening and n_iter % SCREEN_FREQ == 0)):
             # the biggest coordinate update of this iteration was smaller than
             # the tolerance: check the duality gap as ultimate stopping
             # criterion
@@ -425,4 +1058,189 @@ cdef void enet_coordinate_descent_gram(floating[:] w, floating alpha, floating b
 
             if gap < tol:
                 # return if we reached desired tolerance
-                break
\ No newline at end of file
+                break
+
+            if screening:
+                # Gap-safe sphere test: the optimal dual point lies within
+                # sqrt(2 * gap) / alpha of the feasible point const * XtA
+                radius = sqrt(2 * fmax(gap, 0))
+                f_iter = 0
+                for n_active_iter in range(n_active):
+                    ii = active[n_active_iter]
+                    if positive:
+                        screen_tmp = const * XtA[ii]
+                    else:
+                        screen_tmp = const * fabs(XtA[ii])
+                    if screen_tmp + radius * sqrt(Q[ii, ii] + beta) < alpha:
+                        if w[ii] != 0.0:
+                            # H -= w_ii * Q[ii]
+                            mw_ii = -w[ii]
+                            axpy(&n_features, &mw_ii,
+                                 Q_ptr + ii * n_features, &ONE,
+                                 H_ptr, &ONE)
+                            w[ii] = 0.0
+                    else:
+                        active[f_iter] = ii
+                        f_iter += 1
+                n_active = f_iter
+
+    if screening:
+        free(active)
+    return n_passes
+
+cdef void _lars_add(floating* L, floating* Q, int* active, int n_active,
+                    int j, floating beta, int n) nogil:
+    """Append atom j to the Cholesky factor L of (Q + beta I)[active,
+    active], stored as a lower triangular n x n row-major array"""
+    cdef int p, r
+    cdef floating v
+    cdef floating diag = Q[j * n + j] + beta
+    for p in range(n_active):
+        # Forward substitution L v = Q[active, j]
+        v = Q[active[p] * n + j]
+        for r in range(p):
+            v -= L[p * n + r] * L[n_active * n + r]
+        v /= L[p * n + p]
+        L[n_active * n + p] = v
+        diag -= v * v
+    L[n_active * n + n_active] = sqrt(fmax(diag, 0))
+
+
+cdef bint enet_lars_gram(floating* w, floating alpha, floating beta,
+                         floating* Q, floating* q, int n, bint positive,
+                         floating* buf, int* int_buf, int* n_steps) nogil:
+    """Homotopy (LARS-lasso) algorithm for Elastic-Net regression
+
+        We minimize
+
+        (1/2) * w^T Q w - q^T w + alpha norm(w, 1) + (beta/2) * norm(w, 2)^2
+
+        following the regularization path from alpha = max |q| down to
+        alpha. Atoms enter or leave the active set one at a time; the
+        Cholesky factor of (Q + beta I) restricted to the active set is
+        updated by rank-one appends, and recomputed when an atom leaves.
+        At most 2 * n steps are performed, and their number is written in
+        n_steps.
+
+        buf should hold n * (n + 4) floating, int_buf 2 * n ints.
+
+        Returns whether the path reached alpha. Otherwise, w is the
+        solution at a larger regularization.
+    """
+    cdef floating* L = buf
+    cdef floating* d = buf + n * n
+    cdef floating* a = d + n
+    cdef floating* c = a + n
+    cdef floating* sign = c + n
+    cdef int* active = int_buf
+    cdef int* position = int_buf + n
+    cdef int n_active = 0
+    cdef int n_iter = 0
+    cdef int j, p, r, drop
+    cdef bint reached = False
+    cdef int last_drop = -1
+    cdef floating lbda, gamma, this_gamma, min_gamma, v, c_max
+    cdef floating eps = 1e-10
+
+    for j in range(n):
+        w[j] = 0
+        c[j] = q[j]
+        position[j] = -1
+
+    # First atom
+    j = -1
+    c_max = 0
+    for r in range(n):
+        v = c[r] if positive else fabs(c[r])
+        if v > c_max:
+            c_max = v
+            j = r
+    lbda = c_max
+    n_steps[0] = 0
+    if j == -1 or lbda <= alpha:
+        return True
+
+    while n_iter < 2 * n:
+        n_iter += 1
+        if j != -1:
+            _lars_add(L, Q, active, n_active, j, beta, n)
+            if L[n_active * n + n_active] <= eps:
+                # Degenerate atom: stop the path here
+                break
+            sign[n_active] = fsign(c[j])
+            position[j] = n_active
+            active[n_active] = j
+            n_active += 1
+
+        # Direction: (Q + beta I)[active, active] d = sign
+        for p in range(n_active):
+            v = sign[p]
+            for r in range(p):
+                v -= L[p * n + r] * d[r]
+            d[p] = v / L[p * n + p]
+        for p in range(n_active - 1, -1, -1):
+            v = d[p]
+            for r in range(p + 1, n_active):
+                v -= L[r * n + p] * d[r]
+            d[p] = v / L[p * n + p]
+
+        # a = (Q + beta I)[:, active] d
+        for r in range(n):
+            a[r] = 0
+        for p in range(n_active):
+            for r in range(n):
+                a[r] += Q[active[p] * n + r] * d[p]
+            a[active[p]] += beta * d[p]
+
+        # Largest step before reaching alpha, an atom entering or leaving
+        gamma = lbda - alpha
+        j = -1
+        drop = -1
+        for r in range(n):
+            if position[r] != -1:
+                continue
+            # An atom that just left can only re-enter after a non-zero step
+            min_gamma = eps if r == last_drop else 0
+            if 1 - a[r] > eps:
+                this_gamma = (lbda - c[r]) / (1 - a[r])
+                if min_gamma <= this_gamma < gamma:
+                    gamma = this_gamma
+                    j = r
+            if not positive and 1 + a[r] > eps:
+                this_gamma = (lbda + c[r]) / (1 + a[r])
+                if min_gamma <= this_gamma < gamma:
+                    gamma = this_gamma
+                    j = r
+        for p in range(n_active):
+            if d[p] != 0:
+                this_gamma = - w[active[p]] / d[p]
+                if eps < this_gamma < gamma:
+                    gamma = this_gamma
+                    drop = p
+                    j = -1
+
+        for p in range(n_active):
+            w[active[p]] += gamma * d[p]
+        for r in range(n):
+            c[r] -= gamma * a[r]
+        lbda -= gamma
+
+        last_drop = -1
+        if drop != -1:
+            last_drop = active[drop]
+            # Remove the atom and recompute the Cholesky factor
+            w[active[drop]] = 0
+            position[active[drop]] = -1
+            for p in range(drop, n_active - 1):
+                active[p] = active[p + 1]
+                sign[p] = sign[p + 1]
+            n_active -= 1
+            for p in range(n_active):
+                position[active[p]] = p
+                _lars_add(L, Q, active, p, active[p], beta, n)
+        elif j == -1:
+            # alpha reached
+            reached = True
+            break
+    n_steps[0] = n_iter
+    return reached
@@ -8,6 +8,7 @@ component sparsity
 from __future__ import division
 
 import itertools
+import os
 import time
 import warnings
 from math import log, sqrt
@@ -26,7 +27,8 @@ from sklearn.utils import check_random_state
 
 from ..input_data.fmri.base import BaseNilearnEstimator
 
-from .dict_fact import DictFact, Coder
+from .dict_fact import DictFact, Coder, _squared_norm
+from ..utils.profiling import check_profiler
 
 warnings.filterwarnings('ignore', module='scipy.ndimage.interpolation',
                         category=UserWarning,
@@ -119,7 +121,8 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
             confounds = itertools.repeat(None)
         scores = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
             delayed(self._cache(_score_img, func_memory_level=1))(
-                self.coder_, self.masker_, img, these_confounds)
+                self.coder_, self.masker_, img, these_confounds,
+                chunk_size=self.transform_batch_size)
             for img, these_confounds in zip(imgs, confounds))
         scores = np.array(scores)
         try:
@@ -157,7 +160,8 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
             confounds = itertools.repeat(None)
         codes = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
             delayed(self._cache(_transform_img, func_memory_level=1))(
-                self.coder_, self.masker_, img, these_confounds)
+                self.coder_, self.masker_, img, these_confounds,
+                chunk_size=self.transform_batch_size)
             for img, these_confounds in zip(imgs, confounds))
         return codes
 
@@ -258,6 +262,24 @@ class fMRIDictFact(fMRICoderMixin):
     verbose: integer, optional
         Indicate the level of verbosity. By default, nothing is printed
 
+    checkpoint_dir: str or None, optional
+        Directory in which to checkpoint the optimisation state. If it
+        holds a checkpoint when fit is called, the optimisation resumes
+        from it
+
+    checkpoint_every: int or None, optional
+        Number of records between two checkpoints. None disables
+        checkpointing
+
+    profiler: Profiler or None, optional
+        Instrumentation of the optimisation, passed to DictFact (see
+        modl.utils.profiling). Loading and masking of records is timed as
+        phase io
+
+    n_processes: int, optional, default=1
+        Number of processes used to compute codes, passed to DictFact.
+        Requires method different from 'average'
+
     """
 
     def __init__(self,
@@ -280,7 +302,11 @@ class fMRIDictFact(fMRICoderMixin):
                  mask_strategy='background', mask_args=None,
                  memory=Memory(cachedir=None), memory_level=0,
                  n_jobs=1, verbose=0,
-                 callback=None):
+                 callback=None,
+                 checkpoint_dir=None,
+                 checkpoint_every=None,
+                 profiler=None,
+                 n_processes=1):
         fMRICoderMixin.__init__(self, n_components=n_components,
                                 alpha=alpha,
                                 dict_init=dict_init,
@@ -309,6 +335,10 @@ class fMRIDictFact(fMRICoderMixin):
         self.learning_rate = learning_rate
         self.random_state = random_state
         self.callback = callback
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.profiler = profiler
+        self.n_processes = n_processes
 
     def fit(self, imgs=None, y=None, confounds=None):
         """Compute the mask and the dictionary maps across subjects
@@ -338,7 +368,11 @@ class fMRIDictFact(fMRICoderMixin):
         self.components_ = self._cache(_compute_components,
                                        func_memory_level=1,
                                        ignore=['n_jobs',
-                                               'verbose'])(
+                                               'verbose',
+                                               'checkpoint_dir',
+                                               'checkpoint_every',
+                                               'profiler',
+                                               'n_processes'])(
             self.masker_, imgs,
             step_size=self.step_size,
             confounds=confounds,
@@ -354,7 +388,11 @@ class fMRIDictFact(fMRICoderMixin):
             verbose=self.verbose,
             random_state=self.random_state,
             callback=self.callback,
-            n_jobs=self.n_jobs)
+            n_jobs=self.n_jobs,
+            checkpoint_dir=self.checkpoint_dir,
+            checkpoint_every=self.checkpoint_every,
+            profiler=self.profiler,
+            n_processes=self.n_processes)
         self.components_img_ = self.masker_.inverse_transform(self.components_)
         self.coder_ = Coder(dictionary=self.components_,
                             code_alpha=self.alpha,
@@ -431,7 +469,11 @@ def _compute_components(masker,
                         verbose=0,
                         random_state=None,
                         callback=None,
-                        n_jobs=1):
+                        n_jobs=1,
+                        checkpoint_dir=None,
+                        checkpoint_every=None,
+                        profiler=None,
+                        n_processes=1):
     methods = {'masked': {'G_agg': 'masked', 'Dx_agg': 'masked'},
                'dictionary only': {'G_agg': 'full', 'Dx_agg': 'full'},
                'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
@@ -446,6 +488,7 @@ def _compute_components(masker,
     if dict_init is not None:
         n_components = dict_init.shape[0]
     random_state = check_random_state(random_state)
+    profiler = check_profiler(profiler)
     if method == 'sgd':
         optimizer = 'sgd'
         G_agg = 'full'
@@ -485,27 +528,47 @@ def _compute_components(masker,
                          batch_size=batch_size,
                          random_state=random_state,
                          n_threads=n_jobs,
+                         profiler=profiler,
+                         n_processes=n_processes,
                          verbose=0)
-    dict_fact.prepare(n_samples=n_samples, n_features=n_voxels,
-                      X=dict_init, dtype=dtype)
     cpu_time = 0
     io_time = 0
-    if n_records > 0:
+    start_epoch = 0
+    start_record = 0
+    current_n_records = 0
+    if verbose:
+        verbose_iter_ = np.linspace(0, n_records * n_epochs, verbose)
+        verbose_iter_ = verbose_iter_.tolist()
+    if checkpoint_dir is not None and os.path.exists(checkpoint_dir):
+        if verbose:
+            print('Resuming from checkpoint')
+        state = dict_fact.load_checkpoint(checkpoint_dir)
+        start_epoch = state['epoch']
+        start_record = state['record']
+        record_list = state['record_list']
+        current_n_records = state['current_n_records']
+        cpu_time = state['cpu_time']
+        io_time = state['io_time']
+        reduction = state['reduction']
         if verbose:
-            verbose_iter_ = np.linspace(0, n_records * n_epochs, verbose)
-            verbose_iter_ = verbose_iter_.tolist()
-        current_n_records = 0
-        for i in range(n_epochs):
+            verbose_iter_ = state['verbose_iter_']
+    else:
+        dict_fact.prepare(n_samples=n_samples, n_features=n_voxels,
+                          X=dict_init, dtype=dtype)
+    if n_records > 0:
+        for i in range(start_epoch, n_epochs):
             if verbose:
                 print('Epoch %i' % (i + 1))
-            if method == 'gram' and i == 5:
-                dict_fact.set_params(G_agg='full',
-                                     Dx_agg='average')
-            if method == 'reducing ratio':
-                reduction = 1 + (reduction - 1) / sqrt(i + 1)
-                dict_fact.set_params(reduction=reduction)
-            record_list = random_state.permutation(n_records)
-            for record in record_list:
+            if start_record == 0:
+                if method == 'gram' and i == 5:
+                    dict_fact.set_params(G_agg='full',
+                                         Dx_agg='average')
+                if method == 'reducing ratio':
+                    reduction = 1 + (reduction - 1) / sqrt(i + 1)
+                    dict_fact.set_params(reduction=reduction)
+                record_list = random_state.permutation(n_records)
+            for j in range(start_record, n_records):
+                record = record_list[j]
                 if (verbose and verbose_iter_ and
                             current_n_records >= verbose_iter_[0]):
                     print('Record %i' % current_n_records)
@@ -515,9 +578,11 @@ def _compute_components(masker,
 
                 # IO bounded
                 t0 = time.perf_counter()
-                img, these_confounds = data_list[record]
-                masked_data = masker.transform(img, confounds=these_confounds)
-                masked_data = masked_data.astype(dtype)
+                with profiler.timer('io'):
+                    img, these_confounds = data_list[record]
+                    masked_data = masker.transform(
+                        img, confounds=these_confounds)
+                    masked_data = masked_data.astype(dtype)
                 io_time += time.perf_counter() - t0
 
                 # CPU bounded
@@ -532,6 +597,19 @@ def _compute_components(masker,
                                       sample_indices=sample_indices)
                 current_n_records += 1
                 cpu_time += time.perf_counter() - t0
+
+                if (checkpoint_dir is not None and checkpoint_every
+                        and current_n_records % checkpoint_every == 0):
+                    state = {'epoch': i, 'record': j + 1,
+                             'record_list': record_list,
+                             'current_n_records': current_n_records,
+                             'cpu_time': cpu_time, 'io_time': io_time,
+                             'reduction': reduction,
+                             'verbose_iter_': (verbose_iter_ if verbose
+                                               else None)}
+                    dict_fact.save_checkpoint(checkpoint_dir, extra=state)
+            start_record = 0
+    dict_fact.close()
     components = _flip(dict_fact.components_)
     return components
 
@@ -563,15 +641,15 @@ def _lazy_scan(imgs):
     return n_samples_list, dtype
 
 
-def _transform_img(coder, masker, img, confounds):
+def _transform_img(coder, masker, img, confounds, chunk_size=None):
     data = masker.transform(img,
                             confounds=confounds)
-    return coder.transform(data)
+    return coder.transform(data, chunk_size=chunk_size)
 
 
-def _score_img(coder, masker, img, confounds):
+def _score_img(coder, masker, img, confounds, chunk_size=None):
     data = masker.transform(img, confounds=confounds)
-    return coder.score(data)
+    return coder.score(data, chunk_size=chunk_size)
 
 
 class rfMRIDictionaryScorer:
@@ -598,7 +676,10 @@ class rfMRIDictionaryScorer:
         if not hasattr(self, 'data'):
             self.data = masker.transform(self.test_imgs,
                                          confounds=self.test_confounds)
-        scores = np.array([dict_fact.score(data) for data in self.data])
+            self.sq_norms = [_squared_norm(data) for data in self.data]
+        scores = np.array([dict_fact.score(data, X_sq_norm=sq_norm)
+                           for data, sq_norm in zip(self.data,
+                                                    self.sq_norms)])
         len_imgs = np.array([data.shape[0] for data in self.data])
 
         score = np.sum(scores * len_imgs) / np.sum(len_imgs)
@@ -1,5 +1,7 @@
+import os
 from math import sqrt
 
+import numpy as np
 import time
 
 from modl.feature_extraction.image import LazyCleanPatchExtractor
@@ -7,7 +9,8 @@ from modl.input_data.image import scale_patches
 from sklearn.base import BaseEstimator
 from sklearn.utils import check_random_state, gen_batches
 
-from .dict_fact import DictFact
+from .dict_fact import DictFact, _squared_norm
+from ..utils.profiling import check_profiler
 
 
 class ImageDictFact(BaseEstimator):
@@ -47,6 +50,10 @@ class ImageDictFact(BaseEstimator):
                  max_patches=None,
                  verbose=0,
                  n_threads=1,
+                 checkpoint_dir=None,
+                 checkpoint_every=None,
+                 profiler=None,
+                 n_processes=1,
                  ):
         self.n_threads = n_threads
         self.step_size = step_size
@@ -64,9 +71,14 @@ class ImageDictFact(BaseEstimator):
         self.patch_size = patch_size
         self.buffer_size = buffer_size
         self.max_patches = max_patches
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.profiler = profiler
+        self.n_processes = n_processes
 
     def fit(self, image, y=None):
         self.random_state = check_random_state(self.random_state)
+        profiler = check_profiler(self.profiler)
 
         if self.method != 'sgd':
             method = ImageDictFact.methods[self.method]
@@ -111,7 +123,9 @@ class ImageDictFact(BaseEstimator):
                                    tol=1e-2,
                                    callback=self._callback,
                                    verbose=self.verbose,
-                                   n_threads=self.n_threads)
+                                   n_threads=self.n_threads,
+                                   profiler=self.profiler,
+                                   n_processes=self.n_processes)
 
         if self.verbose:
             print('Preparing patch extraction')
@@ -129,44 +143,73 @@ class ImageDictFact(BaseEstimator):
                                                          self.n_components)
         init_patches = _flatten_patches(init_patches, with_std=with_std,
                                         with_mean=with_mean, copy=False)
-        self.dict_fact_.prepare(n_samples=n_patches, X=init_patches)
-        for i in range(self.n_epochs):
+        start_epoch = 0
+        start_buffer = 0
+        n_seen_buffers = 0
+        if (self.checkpoint_dir is not None
+                and os.path.exists(self.checkpoint_dir)):
+            if self.verbose:
+                print('Resuming from checkpoint')
+            state = self.dict_fact_.load_checkpoint(self.checkpoint_dir)
+            start_epoch = state['epoch']
+            start_buffer = state['buffer']
+            n_seen_buffers = state['n_seen_buffers']
+            patch_extractor.indices_3d = np.array(state['indices_3d'])
+        else:
+            self.dict_fact_.prepare(n_samples=n_patches, X=init_patches)
+        for i in range(start_epoch, self.n_epochs):
             if self.verbose:
                 print('Epoch %i' % (i + 1))
-            if i >= 1:
-                if self.verbose:
-                    print('Shuffling dataset')
-                permutation = self.dict_fact_.shuffle()
-                patch_extractor.shuffle(permutation)
-            buffers = gen_batches(n_patches, buffer_size)
-            if self.method == 'gram' and i == 4:
-                self.dict_fact_.set_params(G_agg='full', Dx_agg='average')
-            if self.method == 'reducing ratio':
-                reduction = 1 + (self.reduction - 1) / sqrt(i + 1)
-                self.dict_fact_.set_params(reduction=reduction)
-            for j, buffer in enumerate(buffers):
-                buffer_size = buffer.stop - buffer.start
-                patches = patch_extractor.partial_transform(batch=buffer)
-                patches = _flatten_patches(patches, with_mean=with_mean,
-                                           with_std=with_std, copy=False)
+            if start_buffer == 0:
+                if i >= 1:
+                    if self.verbose:
+                        print('Shuffling dataset')
+                    permutation = self.dict_fact_.shuffle()
+                    patch_extractor.shuffle(permutation)
+                if self.method == 'gram' and i == 4:
+                    self.dict_fact_.set_params(G_agg='full',
+                                               Dx_agg='average')
+                if self.method == 'reducing ratio':
+                    reduction = 1 + (self.reduction - 1) / sqrt(i + 1)
+                    self.dict_fact_.set_params(reduction=reduction)
+            buffers = list(gen_batches(n_patches, buffer_size))
+            for j in range(start_buffer, len(buffers)):
+                buffer = buffers[j]
+                with profiler.timer('io'):
+                    patches = patch_extractor.partial_transform(batch=buffer)
+                    patches = _flatten_patches(patches, with_mean=with_mean,
+                                               with_std=with_std, copy=False)
                 self.dict_fact_.partial_fit(patches, buffer)
+                n_seen_buffers += 1
+                if (self.checkpoint_dir is not None and self.checkpoint_every
+                        and n_seen_buffers % self.checkpoint_every == 0):
+                    state = {'epoch': i, 'buffer': j + 1,
+                             'n_seen_buffers': n_seen_buffers,
+                             'indices_3d': patch_extractor.indices_3d}
+                    self.dict_fact_.save_checkpoint(self.checkpoint_dir,
+                                                    extra=state)
+            start_buffer = 0
+        self.dict_fact_.close()
         return self
 
     def transform(self, patches):
-        with_std = ImageDictFact.settings[self.setting]['with_std']
-        with_mean = ImageDictFact.settings[self.setting]['with_mean']
-
-        patches = _flatten_patches(patches, with_mean=with_mean,
-                                   with_std=with_std, copy=True)
+        patches = self._flatten(patches)
         return self.dict_fact_.transform(patches)
 
-    def score(self, patches):
+    def score(self, patches, X_sq_norm=None):
+        patches = self._flatten(patches)
+        return self.dict_fact_.score(patches, X_sq_norm=X_sq_norm)
+
+    def sq_norm(self, patches):
+        """Squared norm of the flattened patches, to be given to score"""
+        return _squared_norm(self._flatten(patches))
+
+    def _flatten(self, patches):
         with_std = ImageDictFact.settings[self.setting]['with_std']
         with_mean = ImageDictFact.settings[self.setting]['with_mean']
 
-        patches = _flatten_patches(patches, with_mean=with_mean,
-                                   with_std=with_std, copy=True)
-        return self.dict_fact_.score(patches)
+        return _flatten_patches(patches, with_mean=with_mean,
+                                with_std=with_std, copy=True)
 
     @property
     def n_iter_(self):
@@ -209,10 +252,13 @@ class DictionaryScorer:
         self.score = []
         self.iter = []
         self.info = info
+        self.test_sq_norm = None
 
     def __call__(self, dict_fact):
         test_time = time.clock()
-        score = dict_fact.score(self.test_data)
+        if self.test_sq_norm is None:
+            self.test_sq_norm = dict_fact.sq_norm(self.test_data)
+        score = dict_fact.score(self.test_data, X_sq_norm=self.test_sq_norm)
         self.test_time += time.clock() - test_time
         this_time = time.clock() - self.start_time - self.test_time
         self.time.append(this_time)
@@ -9,6 +9,8 @@ from sklearn.utils import gen_batches
 
 from .recsys_fast import _predict
 from .dict_fact_fast import _batch_weight
+from ..utils.math.enet import enet_norm_rows
+from ..utils.profiling import check_profiler
 
 from math import log, sqrt, ceil
 
@@ -43,6 +45,11 @@ class RecsysDictFact(BaseEstimator):
          accordingly
     crop: 2-uple or None,
         Bounds of matrix values, useful at prediction time
+    profiler: Profiler or None,
+        Instrumentation of the optimisation (see modl.utils.profiling).
+        Phases code, stats and dict are timed, and samples and batches are
+        counted. A record is written to the profiler sink at the end of each
+        epoch
 
 
     Attributes
@@ -63,8 +70,10 @@ class RecsysDictFact(BaseEstimator):
                  verbose=0,
                  detrend=False,
                  crop=None,
-                 callback=None):
+                 callback=None,
+                 profiler=None):
         self.callback = callback
+        self.profiler = profiler
         self.verbose = verbose
         self.random_state = random_state
         self.n_epochs = n_epochs
@@ -132,11 +141,13 @@ class RecsysDictFact(BaseEstimator):
                                               base=10) - 1) * batch_size
             self.verbose_iter_ = self.verbose_iter_.tolist()
 
+        profiler = check_profiler(self.profiler)
         for i in range(self.n_epochs):
             permutation = self.random_state.permutation(n_samples)
             batches = gen_batches(n_samples, batch_size)
             for batch in batches:
                 self._single_batch_fit(X, permutation[batch])
+            profiler.record(n_iter=self.n_iter_)
         self._refit(X)
         return self
 
@@ -151,18 +162,25 @@ class RecsysDictFact(BaseEstimator):
             self.verbose_iter_ = self.verbose_iter_[1:]
             self._callback()
 
+        profiler = check_profiler(self.profiler)
         batch_size = batch.shape[0]
         self.n_iter_ += batch_size
+        profiler.count('samples', batch_size)
+        profiler.count('batches')
         w = _batch_weight(self.n_iter_, batch_size, self.learning_rate, 0)
-        for i in batch:
-            self._single_sample_update(X, i, w)
-        self.C_ *= 1 - w
-        self.C_ += w / batch_size * self.code_[batch].T.dot(self.code_[batch])
-
-        subset = np.concatenate([X.indices[X.indptr[i]:X.indptr[i+1]]
-                                 for i in batch])
-        subset = np.unique(subset)
-        self._update_dict(subset)
+        with profiler.timer('code'):
+            for i in batch:
+                self._single_sample_update(X, i, w)
+        with profiler.timer('stats'):
+            self.C_ *= 1 - w
+            self.C_ += w / batch_size * self.code_[batch].T.dot(
+                self.code_[batch])
+
+        with profiler.timer('dict'):
+            subset = np.concatenate([X.indices[X.indptr[i]:X.indptr[i+1]]
+                                     for i in batch])
+            subset = np.unique(subset)
+            self._update_dict(subset)
 
     # Could be made into Cython
     def _single_sample_update(self, X, i, w):
@@ -194,7 +212,9 @@ class RecsysDictFact(BaseEstimator):
         gradient_subset -= self.C_.dot(components_subset)
 
         order = self.random_state.permutation(n_components)
-        subset_norm = np.sum(components_subset ** 2, axis=1)
+        # Squared l2 norm of the atoms, without temporaries
+        subset_norm = np.empty(n_components, dtype=self.comp_norm_.dtype)
+        enet_norm_rows(components_subset, subset_norm, 0.)
         self.comp_norm_ += subset_norm
         for k in order:
             gradient_subset = ger(1.0, self.C_[k], components_subset[k],
@@ -208,7 +228,7 @@ class RecsysDictFact(BaseEstimator):
                 components_subset[k] /= norm / lim_norm
             gradient_subset = ger(-1.0, self.C_[k], components_subset[k],
                                   a=gradient_subset, overwrite_a=True)
-        subset_norm = np.sum(components_subset ** 2, axis=1)
+        enet_norm_rows(components_subset, subset_norm, 0.)
         self.comp_norm_ -= subset_norm
         self.components_[:, subset] = components_subset
 
@@ -12,6 +12,8 @@ def configuration(parent_package='', top_path=None):
         Extension('modl.decomposition.dict_fact_fast',
                   sources=['modl/decomposition/dict_fact_fast.pyx'],
                   include_dirs=[numpy.get_include()],
+                  extra_compile_args=['-fopenmp'],
+                  extra_link_args=['-fopenmp'],
                   ),
         Extension('modl.decomposition.recsys_fast',
                   sources=['modl/decomposition/recsys_fast.pyx'],
@@ -1,12 +1,20 @@
 # Author: Arthur Mensch
 
+import atexit
+import pickle
+
 import numpy as np
 import pytest
-from modl.decomposition.dict_fact import DictFact
+from modl.decomposition.dict_fact import DictFact, Coder, reduce_stats, \
+    MIN_B_SCALE
+from modl.decomposition.dict_fact_fast import _enet_regression_single_gram, \
+    _update_dict_subset, _batch_weight
+from modl.utils.math.enet import enet_norm, enet_projection
+from modl.utils.profiling import Profiler, RingSink
 from numpy import linalg
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 from sklearn.linear_model import cd_fast
-from sklearn.utils import check_random_state
+from sklearn.utils import check_random_state, gen_batches
 
 rng_global = 0
 
@@ -52,6 +60,37 @@ def generate_synthetic(n_samples=200,
     return X, Q
 
 
+def fit_equivalent(param, values, attributes, solver='masked', dtype=None,
+                   decimal=6, **params):
+    """Fit DictFact on the same data with each value of param, and check
+    that the given attributes of the fits agree. Attributes are names, or
+    functions of the estimator and of X. Returns X and the estimators"""
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    if dtype is not None:
+        X = X.astype(dtype)
+    defaults = dict(n_components=4, code_alpha=1e-2, n_epochs=2,
+                    random_state=0, reduction=2, **solver_dict[solver])
+    defaults.update(params)
+    estimators = []
+    for value in values:
+        defaults[param] = value
+        estimators.append(DictFact(**defaults).fit(X))
+
+    def get(estimator, attribute):
+        if callable(attribute):
+            return attribute(estimator, X)
+        return np.asarray(getattr(estimator, attribute))
+
+    for estimator in estimators[1:]:
+        for attribute in attributes:
+            assert_array_almost_equal(get(estimator, attribute),
+                                      get(estimators[0], attribute),
+                                      decimal=decimal)
+    return X, estimators
+
+
 @pytest.mark.parametrize("solver", solvers)
 def test_dict_mf_reconstruction(solver):
     X, Q = generate_synthetic()
@@ -154,6 +193,564 @@ def test_dict_mf_reconstruction_sparse_dict(solver):
     assert (recovered_maps >= 4)
 
 
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+def test_dict_mf_transform_n_threads(code_l1_ratio):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-2,
+                       code_l1_ratio=code_l1_ratio,
+                       n_epochs=1,
+                       random_state=0)
+    dict_mf.fit(X)
+    P1 = dict_mf.transform(X)
+    dict_mf.n_threads = 3
+    P2 = dict_mf.transform(X)
+    assert_array_equal(P1, P2)
+
+
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+def test_dict_mf_transform_chunked(tmpdir, code_l1_ratio):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-2,
+                       code_l1_ratio=code_l1_ratio,
+                       n_epochs=1,
+                       random_state=0)
+    dict_mf.fit(X)
+    P = dict_mf.transform(X)
+    assert_array_almost_equal(dict_mf.transform(X, chunk_size=33), P)
+    out = np.memmap(str(tmpdir.join('code.mmap')), mode='w+',
+                    shape=P.shape, dtype=P.dtype)
+    # Codes are initialized by the solver, not by the caller
+    out[:] = np.nan
+    res = dict_mf.transform(X, chunk_size=33, out=out)
+    assert res is out
+    assert_array_almost_equal(out, P)
+    X_iter = (X[i:i + 150] for i in range(0, 400, 150))
+    assert_array_almost_equal(dict_mf.transform(X_iter, chunk_size=33), P)
+    codes = list(dict_mf.transform_iter([X[:150], X[150:]], chunk_size=100))
+    assert [code.shape[0] for code in codes] == [100, 50, 100, 100, 50]
+    assert_array_almost_equal(np.concatenate(codes), P)
+
+
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+@pytest.mark.parametrize("code_solver", ['cd', 'lars', 'fista'])
+def test_dict_mf_score(code_l1_ratio, code_solver):
+    # D x is only copied before the ridge solve, which overwrites it
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-2,
+                       code_l1_ratio=code_l1_ratio,
+                       code_solver=code_solver,
+                       n_epochs=1,
+                       random_state=0)
+    dict_mf.fit(X)
+    P = dict_mf.transform(X)
+    loss = np.sum((X - P.dot(dict_mf.components_)) ** 2) / 2
+    regul = 1e-2 * (np.sum(np.abs(P)) * code_l1_ratio
+                    + (1 - code_l1_ratio) * np.sum(P ** 2) / 2)
+    score = (loss + regul) / X.shape[0]
+    assert_array_almost_equal(dict_mf.score(X), score)
+    assert_array_almost_equal(dict_mf.score(X, chunk_size=33), score)
+    assert_array_almost_equal(dict_mf.score(X, X_sq_norm=np.sum(X ** 2)),
+                              score)
+
+
+def test_coder_ridge_cache():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    coder = Coder(Q, code_alpha=1e-1, code_l1_ratio=0)
+    P = coder.transform(X)
+    score = coder.score(X)
+    coder.fit()
+    assert_array_almost_equal(coder.transform(X), P)
+    assert_array_almost_equal(coder.transform(X, chunk_size=33), P)
+    assert_array_almost_equal(coder.score(X), score)
+    # Stale cache is not used
+    coder.code_alpha = 1
+    assert_array_almost_equal(coder.transform(X),
+                              Coder(Q, code_alpha=1,
+                                    code_l1_ratio=0).transform(X))
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("optimizer", ['variational', 'sgd'])
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+def test_dict_mf_fused(solver, optimizer, code_l1_ratio):
+    X, (dict_mf, fused_mf) = fit_equivalent(
+        'fused', [False, True], ['components_', 'code_', 'B_', 'C_'],
+        solver, comp_l1_ratio=0.5, code_l1_ratio=code_l1_ratio,
+        optimizer=optimizer, step_size=1e-2)
+    assert not hasattr(dict_mf, '_workspace')
+    # Buffers of the fused kernel are reused from one batch to the next
+    workspace = fused_mf._workspace
+    fused_mf.partial_fit(X[:10], np.arange(10))
+    assert all(buffer is reused for buffer, reused
+               in zip(workspace, fused_mf._workspace))
+
+
+def test_dict_mf_fused_prepare():
+    X, Q = generate_synthetic(n_features=10, n_samples=100)
+    X_large, Q = generate_synthetic(n_features=30, n_samples=100)
+    X_large = X_large.astype(np.float32)
+    params = dict(n_components=4, code_alpha=1e-2, random_state=0,
+                  reduction=2, fused=True)
+    dict_mf = DictFact(**params).prepare(X=X)
+    dict_mf.partial_fit(X, np.arange(100))
+    # Buffers of the fused kernel follow the new shape and dtype
+    dict_mf.set_params(random_state=0)
+    dict_mf.prepare(X=X_large)
+    dict_mf.partial_fit(X_large, np.arange(100))
+    ref_mf = DictFact(**params).prepare(X=X_large)
+    ref_mf.partial_fit(X_large, np.arange(100))
+    assert dict_mf.components_.dtype == np.float32
+    assert_array_almost_equal(dict_mf.components_, ref_mf.components_)
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("fused", [False, True])
+def test_dict_mf_lazy_B(solver, fused):
+    X, (dict_mf, lazy_mf) = fit_equivalent(
+        'lazy_B', [False, True],
+        ['components_', lambda mf, X: mf.B_ * mf.B_scale_],
+        solver, fused=fused)
+    assert dict_mf.B_scale_ == 1
+    assert MIN_B_SCALE <= lazy_mf.B_scale_ < 1
+    # B_ is renormalized once its scale falls below MIN_B_SCALE
+    B = lazy_mf.B_ * lazy_mf.B_scale_
+    lazy_mf.B_scale_ = MIN_B_SCALE * 1.01
+    lazy_mf.B_ = B / lazy_mf.B_scale_
+    for estimator in [dict_mf, lazy_mf]:
+        estimator.partial_fit(X[:10], np.arange(10))
+    assert lazy_mf.B_scale_ == 1
+    assert_array_almost_equal(lazy_mf.B_, dict_mf.B_)
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("fused", [False, True])
+@pytest.mark.parametrize("optimizer", ['variational', 'sgd'])
+def test_dict_mf_feature_major(solver, fused, optimizer):
+    X, estimators = fit_equivalent(
+        'feature_major', [False, True],
+        ['components_', 'B_', lambda mf, X: mf.transform(X)],
+        solver, fused=fused, optimizer=optimizer, step_size=1e-2)
+    for feature_major, dict_mf in zip([False, True], estimators):
+        for array in [dict_mf.components_, dict_mf.B_]:
+            # Each feature is a contiguous column of n_components values
+            assert array.flags['F_CONTIGUOUS'] == feature_major
+            assert array.flags['C_CONTIGUOUS'] != feature_major
+        assert dict_mf.gradient_.flags['F_CONTIGUOUS']
+
+
+@pytest.mark.parametrize("code_l1_ratio", [0, 1])
+def test_dict_mf_G_packed(code_l1_ratio):
+    X, (dict_mf, dict_mf_packed) = fit_equivalent(
+        'G_packed', [False, True], ['components_', 'code_'],
+        G_agg='average', Dx_agg='average', code_l1_ratio=code_l1_ratio)
+    # Only the k * (k + 1) / 2 upper-triangular coefficients are stored
+    assert dict_mf_packed.G_average_.shape == (400, 4 * 5 // 2)
+    i, j = np.triu_indices(4)
+    assert_array_almost_equal(dict_mf.G_average_[:, i, j],
+                              dict_mf_packed.G_average_[:, j * (j + 1) // 2
+                                                        + i])
+
+
+def test_dict_mf_G_average_storage(tmpdir):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    results = []
+    for chunk_size in [None, 64]:
+        dict_mf = DictFact(n_components=4,
+                           code_alpha=1e-2,
+                           n_epochs=2,
+                           G_agg='average',
+                           Dx_agg='average',
+                           random_state=0, reduction=2,
+                           G_average_dir=str(tmpdir),
+                           G_average_chunk_size=chunk_size)
+        dict_mf.fit(X)
+        results.append((dict_mf.components_, dict_mf.code_,
+                        np.asarray(dict_mf.G_average_)))
+    for res_chunked, res in zip(*results):
+        assert_array_equal(res_chunked, res)
+
+
+@pytest.mark.parametrize("G_agg", ['masked', 'average'])
+@pytest.mark.parametrize("sample_storage", ['memory', 'mmap'])
+def test_dict_mf_checkpoint(tmpdir, G_agg, sample_storage):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    params = dict(n_components=4, code_alpha=1e-2, G_agg=G_agg,
+                  Dx_agg=G_agg, random_state=0, reduction=2,
+                  G_average_chunk_size=64, sample_storage=sample_storage)
+    checkpoint_dir = str(tmpdir.join('checkpoint'))
+
+    dict_mf = DictFact(**params)
+    dict_mf.prepare(X=X)
+    dict_mf.partial_fit(X[:200], np.arange(200))
+    dict_mf.save_checkpoint(checkpoint_dir, extra={'position': 200})
+    dict_mf.partial_fit(X[200:], np.arange(200, 400))
+    permutation = dict_mf.shuffle()
+    dict_mf.partial_fit(X[permutation])
+
+    resumed_mf = DictFact(**params)
+    extra = resumed_mf.load_checkpoint(checkpoint_dir)
+    assert extra['position'] == 200
+    resumed_mf.partial_fit(X[200:], np.arange(200, 400))
+    resumed_permutation = resumed_mf.shuffle()
+    assert_array_equal(permutation, resumed_permutation)
+    resumed_mf.partial_fit(X[permutation])
+
+    assert_array_equal(dict_mf.components_, resumed_mf.components_)
+    assert_array_equal(np.asarray(dict_mf.code_),
+                       np.asarray(resumed_mf.code_))
+    if G_agg == 'average':
+        assert_array_equal(np.asarray(dict_mf.G_average_),
+                           np.asarray(resumed_mf.G_average_))
+
+    # The second checkpoint links the unchanged chunks of the first one
+    for _ in range(2):
+        resumed_mf.save_checkpoint(checkpoint_dir)
+    reloaded_mf = DictFact(**params)
+    reloaded_mf.load_checkpoint(checkpoint_dir)
+    assert_array_equal(np.asarray(dict_mf.code_),
+                       np.asarray(reloaded_mf.code_))
+    if G_agg == 'average':
+        assert_array_equal(np.asarray(dict_mf.G_average_),
+                           np.asarray(reloaded_mf.G_average_))
+
+
+def test_dict_mf_exit_registered_once(tmpdir, monkeypatch):
+    handlers = []
+    monkeypatch.setattr(atexit, 'register', handlers.append)
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4, G_agg='average', Dx_agg='average',
+                       sample_storage='mmap', random_state=0)
+    for _ in range(2):
+        dict_mf.prepare(X=X)
+    dict_mf.partial_fit(X[:10], np.arange(10))
+    checkpoint_dir = str(tmpdir.join('checkpoint'))
+    dict_mf.save_checkpoint(checkpoint_dir)
+    dict_mf.load_checkpoint(checkpoint_dir)
+    assert handlers == [dict_mf._exit]
+    dict_mf._exit()
+
+
+@pytest.mark.parametrize("G_agg", ['masked', 'average'])
+@pytest.mark.parametrize("fused", [False, True])
+def test_dict_mf_sample_storage(tmpdir, G_agg, fused):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    results = []
+    for sample_storage in ['memory', 'mmap']:
+        dict_mf = DictFact(n_components=4,
+                           code_alpha=1e-2,
+                           n_epochs=2,
+                           G_agg=G_agg,
+                           Dx_agg=G_agg,
+                           fused=fused,
+                           random_state=0, reduction=2,
+                           sample_storage=sample_storage,
+                           sample_storage_dir=str(tmpdir))
+        dict_mf.fit(X)
+        results.append((dict_mf.components_, np.asarray(dict_mf.code_),
+                        np.asarray(dict_mf.Dx_average_),
+                        np.asarray(dict_mf.sample_n_iter_),
+                        np.asarray(dict_mf.labels_)))
+    for res_mmap, res in zip(*results):
+        assert_array_equal(res_mmap, res)
+
+
+@pytest.mark.parametrize("sample_storage", ['memory', 'mmap'])
+def test_dict_mf_growable(sample_storage):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    params = dict(n_components=4, code_alpha=1e-2, G_agg='average',
+                  Dx_agg='average', random_state=0, reduction=2,
+                  sample_storage=sample_storage)
+    dict_mf = DictFact(**params)
+    dict_mf.prepare(n_samples=400, X=X[:100])
+    grown_mf = DictFact(growable=True, **params)
+    grown_mf.prepare(X=X[:100])
+    assert grown_mf.n_samples_ == 100
+    for estimator in [dict_mf, grown_mf]:
+        estimator.partial_fit(X[:100], np.arange(100))
+        estimator.partial_fit(X[100:130], np.arange(100, 130))
+        estimator.partial_fit(X[130:], np.arange(130, 400))
+        estimator.partial_fit(X[::-1], np.arange(400)[::-1])
+    assert grown_mf.n_samples_ >= 400
+    assert len(grown_mf.code_) == grown_mf.n_samples_
+    assert len(grown_mf.G_average_) == grown_mf.n_samples_
+    assert_array_equal(dict_mf.components_, grown_mf.components_)
+    assert_array_equal(np.asarray(dict_mf.code_),
+                       np.asarray(grown_mf.code_)[:400])
+
+
+@pytest.mark.parametrize("G_agg", ['masked', 'average'])
+def test_dict_mf_profiler(G_agg):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    sink = RingSink()
+    params = dict(n_components=4, code_alpha=1e-2, n_epochs=2,
+                  G_agg=G_agg, Dx_agg=G_agg, random_state=0, reduction=2)
+    dict_mf = DictFact(profiler=Profiler(sink), **params).fit(X)
+    ref_mf = DictFact(**params).fit(X)
+    assert_array_equal(dict_mf.components_, ref_mf.components_)
+
+    assert len(sink.records) == 2
+    record = sink.records[-1]
+    assert record['n_iter'] == 800
+    counters = record['counters']
+    assert counters['samples'] == 800
+    assert counters['batches'] == 80
+    assert counters['cd_iter'] >= 800
+    assert counters['active_atoms'] > 0
+    phases = {'sampling', 'sample_io', 'Dx_G', 'code', 'stats', 'dict'}
+    if G_agg == 'average':
+        assert counters['bytes_read'] == 800 * 4 * 4 * 8
+        phases.add('G_average_io')
+    assert set(record['timers']) == phases
+
+
+def test_dict_mf_stateless():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=2,
+                       random_state=0, reduction=2,
+                       sample_storage='none')
+    dict_mf.fit(X)
+    assert not hasattr(dict_mf, 'code_')
+    assert not hasattr(dict_mf, 'Dx_average_')
+    ref_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=2,
+                      random_state=0, reduction=2)
+    ref_mf.fit(X)
+    assert dict_mf.score(X) < 1.1 * ref_mf.score(X)
+
+    dict_mf = DictFact(n_components=4, G_agg='average', Dx_agg='average',
+                       sample_storage='none')
+    with pytest.raises(ValueError):
+        dict_mf.prepare(X=X)
+
+
+@pytest.mark.parametrize("G_agg", ['masked', 'average'])
+def test_dict_mf_stat_dtype(G_agg):
+    X, (ref_mf, dict_mf) = fit_equivalent(
+        'stat_dtype', [np.float32, np.float64], ['components_'],
+        dtype=np.float32, decimal=3, G_agg=G_agg, Dx_agg=G_agg)
+    assert dict_mf.components_.dtype == np.float32
+    assert dict_mf.code_.dtype == np.float32
+    for name in ['B_', 'C_', 'Dx_average_']:
+        assert getattr(dict_mf, name).dtype == np.float64
+
+    # Late in a run, the weight of a batch is below the float32 resolution,
+    # and its contribution to B_ is only kept by float64 accumulators
+    dict_mf.n_iter_ = 10 ** 9
+    B = dict_mf.B_.copy()
+    dict_mf.partial_fit(X[:10], np.arange(10))
+    w = _batch_weight(dict_mf.n_iter_, 10, 1, 0)
+    code = np.asarray(dict_mf.code_[:10])
+    delta = w * (code.T.dot(X[:10]) / 10 - B)
+    assert np.max(np.abs(dict_mf.B_ - B - delta)) < 1e-3 * np.max(
+        np.abs(delta))
+
+    dict_mf = DictFact(stat_dtype=np.int64)
+    with pytest.raises(ValueError):
+        dict_mf.prepare(X=X)
+
+
+@pytest.mark.parametrize("G_agg", ['masked', 'full'])
+@pytest.mark.parametrize("sample_storage", ['memory', 'none'])
+def test_dict_mf_n_processes(G_agg, sample_storage, monkeypatch):
+    handlers = []
+    monkeypatch.setattr(atexit, 'register', handlers.append)
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    params = dict(n_components=4, code_alpha=1e-2, n_epochs=2,
+                  G_agg=G_agg, Dx_agg=G_agg, random_state=0, reduction=2,
+                  batch_size=50, sample_storage=sample_storage)
+    dict_mf = DictFact(n_processes=2, **params).fit(X)
+    assert dict_mf.components_.base is not None  # Shared memory
+    # Processes do not outlive fit, and are restarted by partial_fit
+    assert not hasattr(dict_mf, '_process_pool')
+    dict_mf.partial_fit(X[:100], np.arange(100))
+    assert hasattr(dict_mf, '_process_pool')
+    dict_mf.close()
+    assert not hasattr(dict_mf, '_process_pool')
+    assert handlers == [dict_mf._exit]
+    dict_mf = DictFact(n_processes=2, **params).fit(X)
+    ref_mf = DictFact(**params).fit(X)
+    assert_array_almost_equal(dict_mf.components_, ref_mf.components_)
+    if sample_storage == 'memory':
+        assert_array_almost_equal(dict_mf.code_, ref_mf.code_)
+
+    dict_mf = DictFact(n_processes=2, G_agg='average', Dx_agg='average')
+    with pytest.raises(ValueError):
+        dict_mf.prepare(X=X)
+
+
+@pytest.mark.parametrize("solver", ['masked', 'gram'])
+def test_dict_mf_feature_block_size(solver):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    params = dict(n_components=4, code_alpha=1e-2, n_epochs=2,
+                  G_agg=solver_dict[solver]['G_agg'],
+                  Dx_agg=solver_dict[solver]['Dx_agg'], random_state=0)
+    dict_mf = DictFact(reduction=2, feature_block_size=3, **params).prepare(
+        X=X)
+    for batch in gen_batches(400, 10):
+        dict_mf.partial_fit(X[batch], np.arange(400)[batch])
+        if solver == 'gram':
+            assert_array_almost_equal(dict_mf.G_,
+                                      dict_mf.components_.dot(
+                                          dict_mf.components_.T))
+    assert dict_mf.block_G_.shape == (7, 4, 4)
+    for block in range(7):
+        components = dict_mf.components_[:, block * 3:(block + 1) * 3]
+        assert_array_almost_equal(dict_mf.block_G_[block],
+                                  components.dot(components.T))
+    # Drawing all blocks is drawing all features
+    fit_equivalent('feature_block_size', [None, 3], ['components_'], solver,
+                   reduction=1)
+    if solver == 'masked':
+        # The masked Dx of the gram solver is noisier with blocks
+        ref_mf = DictFact(reduction=2, **params).prepare(X=X)
+        ref_mf.partial_fit(X, np.arange(400))
+        assert dict_mf.score(X) < 1.1 * ref_mf.score(X)
+
+
+def test_dict_mf_merge_stats():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    params = dict(n_components=4, code_alpha=1e-2, random_state=0,
+                  reduction=2)
+    # A single pass is dominated by the initialization: nodes start from
+    # the same atoms as the single-process reference
+    nodes = [DictFact(**params).prepare(n_samples=200, X=X)
+             for _ in range(2)]
+    unmerged_nodes = [DictFact(**params).prepare(n_samples=200, X=X)
+                      for _ in range(2)]
+    assert_array_equal(nodes[0].components_, nodes[1].components_)
+    for epoch in range(2):
+        for node, unmerged_node, X_node in zip(nodes, unmerged_nodes,
+                                               [X[:200], X[200:]]):
+            for this_node in [node, unmerged_node]:
+                this_node.partial_fit(
+                    X_node[epoch * 100:(epoch + 1) * 100],
+                    np.arange(epoch * 100, (epoch + 1) * 100))
+        # All-reduce, with a pickle round-trip standing for the network
+        stats_list = [pickle.loads(pickle.dumps(node.export_stats()))
+                      for node in nodes]
+        n_iter = sum(stats['n_iter'] for stats in stats_list)
+        assert n_iter == 200
+        B = (nodes[0].B_ * nodes[0].B_scale_ * nodes[0].n_iter_
+             + nodes[1].B_ * nodes[1].B_scale_ * nodes[1].n_iter_)
+        for node in nodes:
+            node.merge_stats(stats_list)
+        assert_array_equal(nodes[0].components_, nodes[1].components_)
+        assert_array_equal(nodes[0].B_, nodes[1].B_)
+        assert nodes[0].n_iter_ == 200 * (epoch + 1)
+        if epoch == 0:
+            assert_array_almost_equal(nodes[0].B_, B / 200)
+    reduced = reduce_stats([reduce_stats(stats_list[:1]),
+                            reduce_stats(stats_list[1:])])
+    assert_array_almost_equal(reduced['B'],
+                              reduce_stats(stats_list)['B'])
+    ref_mf = DictFact(n_epochs=1, **params).fit(X)
+    score = nodes[0].score(X)
+    assert score < 1.1 * ref_mf.score(X)
+    assert score < max(node.score(X) for node in unmerged_nodes)
+
+
+@pytest.mark.parametrize("positive", [False, True])
+def test_enet_regression_screening(positive):
+    rng = check_random_state(0)
+    D = rng.randn(64, 100)
+    X = rng.randn(10, 100)
+    G = D.dot(D.T)
+    Dx = X.dot(D.T)
+    sample_indices = np.arange(10)
+    codes = []
+    for screening in [False, True]:
+        code = np.zeros((10, 64))
+        _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                     0.9, 20., positive, 1e-10, 1000,
+                                     1, screening)
+        codes.append(code)
+    assert np.sum(codes[0] != 0) < code.size / 2
+    assert_array_almost_equal(codes[0], codes[1])
+
+
+@pytest.mark.parametrize("code_solver", ['fista', 'lars'])
+def test_dict_mf_code_solver(code_solver):
+    X, Q = generate_synthetic()
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-4,
+                       n_epochs=5,
+                       comp_l1_ratio=0,
+                       random_state=0, reduction=1,
+                       code_solver=code_solver)
+    dict_mf.fit(X)
+    P = dict_mf.transform(X)
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert rel_error < 0.02
+
+    dict_mf.set_params(tol=1e-8, max_iter=10000, code_alpha=1)
+    for code_pos in [False, True]:
+        dict_mf.set_params(code_pos=code_pos, code_solver=code_solver)
+        code = dict_mf.transform(X)
+        dict_mf.set_params(code_solver='cd')
+        code_cd = dict_mf.transform(X)
+        assert_array_almost_equal(code, code_cd, decimal=4)
+
+
+@pytest.mark.parametrize("positive", [False, True])
+@pytest.mark.parametrize("l1_ratio", [0.5, 1])
+@pytest.mark.parametrize("n_components, n_features, alpha",
+                         [(64, 100, 20.), (200, 300, 1e-1)])
+def test_enet_regression_lars(positive, l1_ratio, n_components, n_features,
+                              alpha):
+    rng = check_random_state(0)
+    D = rng.randn(n_components, n_features)
+    X = rng.randn(3, n_features)
+    G = D.dot(D.T)
+    Dx = X.dot(D.T)
+    sample_indices = np.arange(3)
+    codes = []
+    # The LARS path is not bounded by max_iter, which is smaller than the
+    # number of atoms in the second problem
+    for lars, max_iter in [(False, 10000), (True, 100)]:
+        code = np.zeros((3, n_components))
+        n_iter = np.zeros(1, dtype='long')
+        _enet_regression_single_gram(G, Dx, X, code, sample_indices,
+                                     l1_ratio, alpha, positive, 1e-10,
+                                     max_iter, 1, False, lars, n_iter)
+        codes.append(code)
+    # Each active atom entered the path in a step
+    assert n_iter[0] >= np.sum(code != 0)
+    if n_components == 64:
+        assert np.sum(codes[0] != 0) < code.size / 2
+    assert_array_almost_equal(codes[0], codes[1])
+
+
 def enet_regression_multi_gram_(G, Dx, X, code, l1_ratio, alpha,
                                 positive):
     batch_size = code.shape[0]
@@ -200,3 +797,53 @@ def enet_regression_single_gram_(G, Dx, X, code, code_l1_ratio, code_alpha,
                 random_state,
                 False, code_pos)
     return code
+
+
+@pytest.mark.parametrize("comp_pos", [False, True])
+@pytest.mark.parametrize("variational", [False, True])
+def test_update_dict_subset(comp_pos, variational):
+    rng = check_random_state(0)
+    n_components, len_subset = 20, 30
+    code = rng.randn(100, n_components)
+    C = code.T.dot(code) / 100
+    components = rng.randn(n_components, len_subset)
+    if comp_pos:
+        components = np.abs(components)
+    B = rng.randn(n_components, len_subset)
+    comp_norm = np.full(n_components, 2.)
+    order = rng.permutation(n_components)
+    comp_l1_ratio, step = 0.5, 0.1
+
+    ref_components = components.copy()
+    ref_norm = comp_norm.copy()
+    gradient = B - C.dot(ref_components)
+    atom_temp = np.zeros(len_subset)
+    if variational:
+        for k in order:
+            ref_norm[k] += enet_norm(ref_components[k], comp_l1_ratio)
+            gradient += np.outer(C[k], ref_components[k])
+            ref_components[k] = gradient[k] / C[k, k]
+            if comp_pos:
+                ref_components[ref_components < 0] = 0
+            enet_projection(ref_components[k], atom_temp, ref_norm[k],
+                            comp_l1_ratio)
+            ref_components[k] = atom_temp
+            ref_norm[k] -= enet_norm(ref_components[k], comp_l1_ratio)
+            gradient -= np.outer(C[k], ref_components[k])
+    else:
+        for k in range(n_components):
+            ref_norm[k] += enet_norm(ref_components[k], comp_l1_ratio)
+        ref_components += step * gradient
+        if comp_pos:
+            ref_components[ref_components < 0] = 0
+        for k in range(n_components):
+            enet_projection(ref_components[k], atom_temp, ref_norm[k],
+                            comp_l1_ratio)
+            ref_components[k] = atom_temp
+            ref_norm[k] -= enet_norm(ref_components[k], comp_l1_ratio)
+
+    gradient = B - C.dot(components)
+    _update_dict_subset(C, components, gradient, comp_norm, order,
+                        comp_l1_ratio, comp_pos, variational, step)
+    assert_array_almost_equal(components, ref_components)
+    assert_array_almost_equal(comp_norm, ref_norm)
@@ -130,6 +130,27 @@ def test_component_sign():
         mp = mp.get_data()
         assert(np.sum(mp[mp <= 0]) <= np.sum(mp[mp > 0]))
 
+def test_dict_fact_checkpoint(tmpdir):
+    data, mask_img, components, init = _make_test_data(n_subjects=10)
+    checkpoint_dir = str(tmpdir.join('checkpoint'))
+    params = dict(n_components=4, random_state=0, mask=mask_img,
+                  dict_init=init, reduction=2, smoothing_fwhm=0., alpha=1)
+    dict_fact = fMRIDictFact(n_epochs=2, **params)
+    dict_fact.fit(data)
+
+    # Interrupted after the first epoch, last checkpoint on 9th record
+    interrupted_dict_fact = fMRIDictFact(n_epochs=1,
+                                         checkpoint_dir=checkpoint_dir,
+                                         checkpoint_every=3, **params)
+    interrupted_dict_fact.fit(data)
+    resumed_dict_fact = fMRIDictFact(n_epochs=2,
+                                     checkpoint_dir=checkpoint_dir,
+                                     checkpoint_every=3, **params)
+    resumed_dict_fact.fit(data)
+    np.testing.assert_array_equal(dict_fact.components_,
+                                  resumed_dict_fact.components_)
+
+
 def test_verbose():
     pass
 
@@ -3,6 +3,7 @@ from math import sqrt
 import numpy as np
 import scipy.sparse as sp
 from modl.decomposition.recsys import RecsysDictFact, compute_biases
+from modl.utils.profiling import Profiler, RingSink
 from modl.utils.recsys.cross_validation import train_test_split
 from numpy.testing import assert_almost_equal
 from numpy.testing import assert_array_almost_equal
@@ -34,6 +35,21 @@ def test_dict_completion():
     assert_almost_equal(rmse, rmse2)
 
 
+def test_dict_completion_profiler():
+    rng = np.random.RandomState(0)
+    U = rng.rand(50, 3)
+    V = rng.rand(3, 20)
+    X = np.dot(U, V)
+
+    sink = RingSink()
+    mf = RecsysDictFact(n_components=3, n_epochs=2, alpha=1e-3,
+                        random_state=0, profiler=Profiler(sink))
+    mf.fit(X)
+    assert len(sink.records) == 2
+    assert sink.records[-1]['counters']['samples'] == 100
+    assert set(sink.records[-1]['timers']) == {'code', 'stats', 'dict'}
+
+
 def test_dict_completion_normalise():
     # Generate some toy data.
     rng = np.random.RandomState(0)
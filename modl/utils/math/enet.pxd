@@ -14,3 +14,13 @@ cpdef void enet_projection(floating[:] v, floating[:] out, floating radius,
 
 cpdef void enet_scale(floating[:] X,
                               floating l1_ratio, floating radius=*) nogil
+
+cdef void enet_projection_rows_nogil(floating[:, :] V, floating[:, :] out,
+                                     floating[:] radius, floating l1_ratio,
+                                     bint positive, int n_threads) nogil
+
+cdef void enet_norm_rows_nogil(floating[:, :] X, floating[:] out,
+                               floating l1_ratio, int n_threads) nogil
+
+cdef void enet_scale_rows_nogil(floating[:, :] X, floating[:] radius,
+                                floating l1_ratio, int n_threads) nogil
@@ -13,6 +13,7 @@ for sparse coding (http://www.di.ens.fr/sierra/pdfs/icml09.pdf)
 from libc.math cimport sqrt, fabs
 
 from cython cimport floating
+from cython.parallel cimport prange
 
 cdef inline floating positive(floating a) nogil:
     if a > 0:
@@ -166,4 +167,121 @@ cpdef void enet_scale(floating[:] X,
     elif l1_norm != 0:
         S = radius / l1_norm
     for j in range(n_features):
-        X[j] *= S
\ No newline at end of file
+        X[j] *= S
+
+
+def enet_projection_rows(floating[:, :] V, floating[:, :] out,
+                         floating[:] radius, floating l1_ratio,
+                         bint positive=False, int n_threads=1):
+    """Projects each row of V on the elastic-net ball of its own radius,
+    in parallel over rows
+
+    Parameters
+    -----------------------------------------
+    V: floating memory-view, shape (n_rows, n_features)
+        Rows to project. Clipped to non-negative values in place if
+        positive is True
+
+    out: floating memory-view, shape (n_rows, n_features)
+        Projected rows, should not overlap V
+
+    radius: floating memory-view, shape (n_rows)
+        Radius of the ball of each row
+
+    l1_ratio: float,
+        Ratio of l1 norm (between 0 and 1)
+
+    positive: bool,
+        Projects on the intersection of the ball and the non-negative
+        orthant
+
+    n_threads: int,
+        Number of OpenMP threads
+    """
+    with nogil:
+        enet_projection_rows_nogil(V, out, radius, l1_ratio, positive,
+                                   n_threads)
+
+
+def enet_norm_rows(floating[:, :] X, floating[:] out,
+                   floating l1_ratio, int n_threads=1):
+    """Computes the elastic net norm of each row of X, in parallel over
+    rows
+
+    Parameters
+    -----------------------------------------
+    X: floating memory-view, shape (n_rows, n_features)
+        Rows
+
+    out: floating memory-view, shape (n_rows)
+        Elastic-net norm of each row
+
+    l1_ratio: float,
+        Ratio of l1 norm (between 0 and 1)
+
+    n_threads: int,
+        Number of OpenMP threads
+    """
+    with nogil:
+        enet_norm_rows_nogil(X, out, l1_ratio, n_threads)
+
+
+def enet_scale_rows(floating[:, :] X, floating[:] radius,
+                    floating l1_ratio, int n_threads=1):
+    """Scales each row of X in place so that it lies on the sphere of
+    its own radius, in parallel over rows
+
+    Parameters
+    -----------------------------------------
+    X: floating memory-view, shape (n_rows, n_features)
+        Rows to scale
+
+    radius: floating memory-view, shape (n_rows)
+        Radius of the sphere of each row
+
+    l1_ratio: float,
+        Ratio of l1 norm (between 0 and 1)
+
+    n_threads: int,
+        Number of OpenMP threads
+    """
+    with nogil:
+        enet_scale_rows_nogil(X, radius, l1_ratio, n_threads)
+
+
+# The OpenMP threads of the following kernels need the GIL to be released
+
+cdef void enet_projection_rows_nogil(floating[:, :] V, floating[:, :] out,
+                                     floating[:] radius, floating l1_ratio,
+                                     bint positive, int n_threads) nogil:
+    cdef int n_rows = V.shape[0]
+    cdef int n_features = V.shape[1]
+    cdef int i, j
+    if n_threads < 1:
+        n_threads = 1
+    for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+        if positive:
+            for j in range(n_features):
+                if V[i, j] < 0:
+                    V[i, j] = 0
+        enet_projection(V[i], out[i], radius[i], l1_ratio)
+
+
+cdef void enet_norm_rows_nogil(floating[:, :] X, floating[:] out,
+                               floating l1_ratio, int n_threads) nogil:
+    cdef int n_rows = X.shape[0]
+    cdef int i
+    if n_threads < 1:
+        n_threads = 1
+    for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+        out[i] = enet_norm(X[i], l1_ratio)
+
+
+cdef void enet_scale_rows_nogil(floating[:, :] X, floating[:] radius,
+                                floating l1_ratio, int n_threads) nogil:
+    cdef int n_rows = X.shape[0]
+    cdef int i
+    if n_threads < 1:
+        n_threads = 1
+    for i in prange(n_rows, num_threads=n_threads, schedule='static'):
+        enet_scale(X[i], l1_ratio, radius[i])
@@ -11,6 +11,8 @@ def configuration(parent_package='', top_path=None):
     extensions = [Extension('modl.utils.math.enet',
                             sources=['modl/utils/math/enet.pyx'],
                             include_dirs=[numpy.get_include()],
+                            extra_compile_args=['-fopenmp'],
+                            extra_link_args=['-fopenmp'],
                             ),
                   ]
     config.ext_modules += extensions
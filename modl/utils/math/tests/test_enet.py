@@ -2,11 +2,13 @@
 # License: BSD 3 clause
 
 import numpy as np
+import pytest
 from numpy import sqrt
 from numpy.testing import assert_array_almost_equal, assert_almost_equal
 from sklearn.utils import check_random_state
 
-from modl.utils.math.enet import enet_norm, enet_projection, enet_scale
+from modl.utils.math.enet import enet_norm, enet_projection, enet_scale, \
+    enet_norm_rows, enet_projection_rows, enet_scale_rows
 
 
 def _enet_norm_for_projection(v, gamma):
@@ -154,3 +156,41 @@ def test_enet_scale():
             enet_scale(a, l1_ratio, r)
             norm = enet_norm(a, l1_ratio)
         assert_almost_equal(norm, r)
+
+
+@pytest.mark.parametrize("positive", [False, True])
+@pytest.mark.parametrize("l1_ratio", [0., 0.1, 1.])
+def test_enet_projection_rows(positive, l1_ratio):
+    random_state = check_random_state(0)
+    V = random_state.randn(10, 100)
+    radius = random_state.uniform(0.5, 2, size=10)
+    radius[0] = 0
+    ref = np.zeros_like(V)
+    for i in range(10):
+        v = np.maximum(V[i], 0) if positive else V[i]
+        enet_projection(v, ref[i], radius[i], l1_ratio)
+    out = np.zeros_like(V)
+    enet_projection_rows(V, out, radius, l1_ratio, positive, 2)
+    assert_array_almost_equal(out, ref)
+    if positive:
+        assert np.all(out >= 0)
+
+
+def test_enet_norm_rows():
+    random_state = check_random_state(0)
+    X = np.asfortranarray(random_state.randn(10, 100))
+    for l1_ratio in [0., 0.5, 1.]:
+        out = np.zeros(10)
+        enet_norm_rows(X, out, l1_ratio, 2)
+        assert_array_almost_equal(out, [enet_norm(x, l1_ratio) for x in X])
+
+
+def test_enet_scale_rows():
+    random_state = check_random_state(0)
+    radius = np.linspace(1, 2, 10)
+    for l1_ratio in [0., 0.5, 1.]:
+        X = random_state.randn(10, 100)
+        enet_scale_rows(X, radius, l1_ratio, 2)
+        norms = np.zeros(10)
+        enet_norm_rows(X, norms, l1_ratio)
+        assert_array_almost_equal(norms, radius)
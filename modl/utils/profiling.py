@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class Profiler(object):
+    """
+    Per-phase timers and counters for the hot paths of the estimators.
+
+    Phases are timed with `with profiler.timer(phase):` and counters are
+    incremented with profiler.count(name, value). Timers of a given phase
+    accumulate, and phases timed by the estimators do not overlap. Each
+    timer keeps its own start time, so that a phase can be timed from
+    several threads, or within itself. record pushes a snapshot of
+    accumulated timers and counters to the sink.
+
+    Parameters
+    ----------
+    sink: object with a write(record) method, or None
+        Destination of the records, e.g. JSONLinesSink or RingSink
+
+    Attributes
+    ----------
+    timers: dict
+        Accumulated time in seconds per phase
+    counters: dict
+        Accumulated counters, e.g. samples, cd_iter, active_atoms,
+        bytes_read
+    """
+    enabled = True
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        """Set timers and counters to zero"""
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def timer(self, phase):
+        """Context manager adding its execution time to timers[phase]"""
+        return _Timer(self, phase)
+
+    def count(self, name, value=1):
+        """Add value to counters[name]"""
+        self.counters[name] += value
+
+    def snapshot(self, **info):
+        """Return accumulated timers and counters, and samples/s over the
+        timed phases, in a dict also holding info"""
+        record = dict(info)
+        record['timers'] = dict(self.timers)
+        record['counters'] = dict(self.counters)
+        total_time = sum(self.timers.values())
+        if total_time > 0:
+            record['samples_per_s'] = self.counters['samples'] / total_time
+        return record
+
+    def record(self, **info):
+        """Write a snapshot to the sink, and return it"""
+        record = self.snapshot(**info)
+        if self.sink is not None:
+            self.sink.write(record)
+        return record
+
+
+class NullProfiler(object):
+    """Disabled profiler, with the interface of Profiler and no cost"""
+    enabled = False
+
+    def timer(self, phase):
+        return _NULL_TIMER
+
+    def count(self, name, value=1):
+        pass
+
+    def snapshot(self, **info):
+        return {}
+
+    def record(self, **info):
+        pass
+
+
+class _Timer(object):
+    """Timer of a single execution of a phase"""
+    __slots__ = ('profiler', 'phase', 't0')
+
+    def __init__(self, profiler, phase):
+        self.profiler = profiler
+        self.phase = phase
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.t0
+        with self.profiler._lock:
+            self.profiler.timers[self.phase] += elapsed
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+NULL_PROFILER = NullProfiler()
+
+
+class JSONLinesSink(object):
+    """
+    Sink appending each record as a line of JSON.
+
+    Parameters
+    ----------
+    file: str or file object
+        File name, opened in append mode, or file object
+    """
+    def __init__(self, file):
+        if isinstance(file, str):
+            file = open(file, 'a')
+        self.file = file
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RingSink(object):
+    """
+    Sink keeping the last maxlen records in memory.
+
+    Parameters
+    ----------
+    maxlen: int or None
+        Number of records to keep. None keeps all of them
+    """
+    def __init__(self, maxlen=1000):
+        self.records = deque(maxlen=maxlen)
+
+    def write(self, record):
+        self.records.append(record)
+
+
+def check_profiler(profiler):
+    """Return NULL_PROFILER if profiler is None, else profiler"""
+    if profiler is None:
+        return NULL_PROFILER
+    return profiler
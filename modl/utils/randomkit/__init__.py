@@ -1,2 +1,2 @@
-from .random_fast import RandomState
-from .sampler import Sampler
\ No newline at end of file
+from .random_fast import RandomState, PhiloxRandomState
+from .sampler import Sampler
@@ -1,4 +1,6 @@
 
+from libc.stdint cimport uint32_t, uint64_t
+
 cdef extern from "randomkit.h":
 
     ctypedef struct rk_state:
@@ -6,6 +8,7 @@ cdef extern from "randomkit.h":
         int pos
         int has_gauss
         double gauss
+        int has_binomial
 
 cdef class RandomState:
 
@@ -13,4 +16,22 @@ cdef class RandomState:
     cdef public object initial_seed
     cpdef long randint(self, unsigned long high)
     cpdef binomial(self, int n, double p)
-    cpdef long[:] permutation(self, long size)
\ No newline at end of file
+    cpdef long[:] permutation(self, long size)
+    cdef void shuffle_long(self, long[:] x)
+
+cdef class PhiloxRandomState:
+
+    cdef uint32_t key[2]
+    cdef uint32_t stream[2]
+    cdef uint64_t counter
+    cdef uint32_t buffer[4]
+    cdef int buffer_pos
+    cdef uint64_t n_spawned
+    cdef void _refill(self) nogil
+    cdef uint32_t _next_uint32(self) nogil
+    cdef double _uniform(self) nogil
+    cdef unsigned long _interval(self, unsigned long max) nogil
+    cdef long _binomial(self, long n, double p) nogil
+    cdef void _shuffle_long(self, long[:] x) nogil
+    cpdef long randint(self, unsigned long high)
+    cpdef long[:] permutation(self, long size)
@@ -6,7 +6,12 @@
 # cython: boundscheck=False
 # cython: wraparound=False
 
+import os
+
 from libc cimport stdlib
+from libc.math cimport sqrt, log, floor, fabs, pow, lgamma
+from libc.stdint cimport uint32_t, uint64_t
+from libc.string cimport memcpy
 
 import numpy as np
 cimport numpy as np
@@ -20,6 +25,7 @@ cdef extern from "randomkit.h":
         int pos
         int has_gauss
         double gauss
+        int has_binomial
 
     ctypedef enum rk_error:
         RK_NOERR = 0
@@ -62,6 +68,31 @@ cdef class RandomState:
             stdlib.free(self.internal_state)
             self.internal_state = NULL
 
+    def get_state(self):
+        """Return the Mersenne Twister state as a tuple
+        (key, pos, has_gauss, gauss), usable by set_state"""
+        cdef int i
+        key = np.empty(624, dtype=np.uint64)
+        for i in range(624):
+            key[i] = self.internal_state.key[i]
+        return (key, self.internal_state.pos,
+                self.internal_state.has_gauss, self.internal_state.gauss)
+
+    def set_state(self, state):
+        """Restore a state returned by get_state"""
+        cdef int i
+        key, pos, has_gauss, gauss = state
+        key = np.asarray(key, dtype=np.uint64)
+        if key.shape[0] != 624:
+            raise ValueError("Wrong state")
+        for i in range(624):
+            self.internal_state.key[i] = key[i]
+        self.internal_state.pos = pos
+        self.internal_state.has_gauss = has_gauss
+        self.internal_state.gauss = gauss
+        # Binomial constants are a cache that only depend on (n, p)
+        self.internal_state.has_binomial = 0
+
     def seed(self, seed=None):
         cdef rk_error errcode
         if seed is None:
@@ -82,7 +113,7 @@ cdef class RandomState:
         cdef long[:] res = view.array((size, ), sizeof(long), format='l')
         for i in range(size):
             res[i] = i
-        self.shuffle(res)
+        self.shuffle_long(res)
         return res
 
     def shuffle(self, object x, long[:] swap=None):
@@ -125,6 +156,18 @@ cdef class RandomState:
                     x[i], x[j] = x[j][:], x[i][:]
                     i = i - 1
 
+    cdef void shuffle_long(self, long[:] x):
+        """Typed version of shuffle for index arrays, drawing the same
+        random sequence"""
+        cdef long i, j, tmp
+        i = x.shape[0] - 1
+        while i > 0:
+            j = rk_interval(i, self.internal_state)
+            tmp = x[i]
+            x[i] = x[j]
+            x[j] = tmp
+            i = i - 1
+
     def shuffle_with_trace(self, object list):
         cdef int i, j
         cdef int l = len(list)
@@ -141,7 +184,11 @@ cdef class RandomState:
             i = i - 1
         for k in range(l):
             x = list[k]
-            self.shuffle(x, swap=swap)
+            if (isinstance(x, np.ndarray) and x.ndim > 0
+                    and x.flags['C_CONTIGUOUS'] and x.flags['WRITEABLE']):
+                permute_rows(x, trace)
+            else:
+                self.shuffle(x, swap=swap)
         return np.asarray(trace)
 
     cpdef binomial(self, int n, double p):
@@ -149,3 +196,323 @@ cdef class RandomState:
 
     def __reduce__(self):
         return (RandomState, (self.initial_seed, ))
+
+
+def permute_rows(x, long[:] perm):
+    """Reorder in place the rows of the C-contiguous array x, so that new
+    row i is former row perm[i]. The cycles of perm are followed without
+    the GIL, so that each row is copied once, using a single row buffer.
+
+    Parameters
+    ----------
+    x: ndarray, shape (n, ...), C-contiguous, e.g. a np.memmap
+    perm: long array, shape (n,), permutation
+    """
+    cdef long n = x.shape[0]
+    cdef long row_size
+    cdef long i, j, k
+    cdef unsigned char[:, ::1] data
+    cdef unsigned char[:] buf
+    cdef unsigned char[:] visited
+    if perm.shape[0] != n:
+        raise ValueError('perm should have as many elements as x has rows')
+    if x.size == 0:
+        return
+    data = x.reshape(n, -1).view(np.uint8)
+    row_size = data.shape[1]
+    buf = view.array((row_size, ), sizeof(unsigned char), format='B')
+    visited = np.zeros(n, dtype=np.uint8)
+    with nogil:
+        for i in range(n):
+            if visited[i]:
+                continue
+            visited[i] = 1
+            if perm[i] == i:
+                continue
+            memcpy(&buf[0], &data[i, 0], row_size)
+            j = i
+            k = perm[j]
+            while k != i:
+                memcpy(&data[j, 0], &data[k, 0], row_size)
+                visited[k] = 1
+                j = k
+                k = perm[j]
+            memcpy(&data[j, 0], &buf[0], row_size)
+
+
+# Philox4x32-10 constants (Salmon et al., 'Parallel random numbers: as easy
+# as 1, 2, 3', SC '11)
+cdef uint32_t PHILOX_M0 = 0xD2511F53
+cdef uint32_t PHILOX_M1 = 0xCD9E8D57
+cdef uint32_t PHILOX_W0 = 0x9E3779B9
+cdef uint32_t PHILOX_W1 = 0xBB67AE85
+# Largest value drawn from a single 32 bits output
+cdef unsigned long UINT32_MASK = 0xFFFFFFFF
+
+
+cdef inline void philox4x32_10(uint32_t* ctr, uint32_t* key,
+                               uint32_t* out) nogil:
+    """Philox4x32 bijection with 10 rounds of the counter ctr, with key"""
+    cdef uint32_t c0 = ctr[0], c1 = ctr[1], c2 = ctr[2], c3 = ctr[3]
+    cdef uint32_t k0 = key[0], k1 = key[1]
+    cdef uint64_t prod0, prod1
+    cdef int r
+    for r in range(10):
+        if r > 0:
+            k0 += PHILOX_W0
+            k1 += PHILOX_W1
+        prod0 = (<uint64_t> PHILOX_M0) * c0
+        prod1 = (<uint64_t> PHILOX_M1) * c2
+        c0 = (<uint32_t> (prod1 >> 32)) ^ c1 ^ k0
+        c1 = <uint32_t> prod1
+        c2 = (<uint32_t> (prod0 >> 32)) ^ c3 ^ k1
+        c3 = <uint32_t> prod0
+    out[0] = c0
+    out[1] = c1
+    out[2] = c2
+    out[3] = c3
+
+
+cdef class PhiloxRandomState:
+    """
+    Counter-based random generator (Philox4x32-10).
+
+    The n-th block of four 32-bit outputs is a bijection of the counter
+    (n, stream) under key, so that a generator can jump ahead in O(1), and
+    spawn independent, reproducible generators for threads or processes.
+    Bulk draws are performed without the GIL. DictFact does not use it yet:
+    its coding threads and processes draw no random numbers, the sample
+    and atom orders being drawn in the main process.
+
+    Parameters
+    ----------
+    seed: int or None,
+        64-bit key of the generator. None draws it from the OS
+    stream: int,
+        64-bit stream identifier. Generators with the same seed and
+        different streams are independent
+    """
+    def __init__(self, seed=None, stream=0):
+        cdef uint64_t iseed
+        cdef uint64_t istream
+        if seed is None:
+            iseed = int.from_bytes(os.urandom(8), 'little')
+        elif isinstance(seed, (int, np.integer)):
+            iseed = int(seed) & 0xFFFFFFFFFFFFFFFF
+        else:
+            raise ValueError("Wrong seed")
+        istream = int(stream) & 0xFFFFFFFFFFFFFFFF
+        self.key[0] = <uint32_t> iseed
+        self.key[1] = <uint32_t> (iseed >> 32)
+        self.stream[0] = <uint32_t> istream
+        self.stream[1] = <uint32_t> (istream >> 32)
+        self.counter = 0
+        self.buffer_pos = 4
+        self.n_spawned = 0
+
+    def get_state(self):
+        """Return the state as a tuple (key, stream, counter, buffer_pos,
+        n_spawned), usable by set_state"""
+        key = int(self.key[0]) | (int(self.key[1]) << 32)
+        stream = int(self.stream[0]) | (int(self.stream[1]) << 32)
+        return (key, stream, int(self.counter), int(self.buffer_pos),
+                int(self.n_spawned))
+
+    def set_state(self, state):
+        """Restore a state returned by get_state"""
+        key, stream, counter, buffer_pos, n_spawned = state
+        self.__init__(key, stream)
+        self.counter = counter
+        self.n_spawned = n_spawned
+        if buffer_pos < 4:
+            # Regenerate the partially consumed block
+            self.counter -= 1
+            self._refill()
+        self.buffer_pos = buffer_pos
+
+    def __reduce__(self):
+        return (_philox_from_state, (self.get_state(), ))
+
+    cdef void _refill(self) nogil:
+        cdef uint32_t ctr[4]
+        ctr[0] = <uint32_t> self.counter
+        ctr[1] = <uint32_t> (self.counter >> 32)
+        ctr[2] = self.stream[0]
+        ctr[3] = self.stream[1]
+        philox4x32_10(ctr, self.key, self.buffer)
+        self.counter += 1
+        self.buffer_pos = 0
+
+    cdef uint32_t _next_uint32(self) nogil:
+        if self.buffer_pos >= 4:
+            self._refill()
+        self.buffer_pos += 1
+        return self.buffer[self.buffer_pos - 1]
+
+    cdef double _uniform(self) nogil:
+        """Uniform double in [0, 1), with 53 random bits"""
+        cdef uint32_t a = self._next_uint32() >> 5
+        cdef uint32_t b = self._next_uint32() >> 6
+        return (a * 67108864.0 + b) / 9007199254740992.0
+
+    cdef unsigned long _interval(self, unsigned long max) nogil:
+        """Uniform integer in [0, max], by rejection of masked draws"""
+        cdef unsigned long mask = max
+        cdef unsigned long value
+        if max == 0:
+            return 0
+        mask |= mask >> 1
+        mask |= mask >> 2
+        mask |= mask >> 4
+        mask |= mask >> 8
+        mask |= mask >> 16
+        if sizeof(unsigned long) > 4:
+            mask |= mask >> 32
+        while True:
+            if max <= UINT32_MASK:
+                value = self._next_uint32() & mask
+            else:
+                value = ((<unsigned long> self._next_uint32() << 32)
+                         | self._next_uint32()) & mask
+            if value <= max:
+                return value
+
+    cdef long _binomial(self, long n, double p) nogil:
+        """Binomial draw, by inversion if n * min(p, 1 - p) < 10, and by
+        transformed rejection (BTRS, Hormann 1993) otherwise"""
+        cdef bint flip = p > 0.5
+        cdef double q, s, a, r, u, v, us, spq, b, c, alpha, v_r, lpq, h, m
+        cdef long k
+        if flip:
+            p = 1 - p
+        if n <= 0 or p <= 0:
+            k = 0
+        elif n * p < 10:
+            while True:
+                q = 1 - p
+                s = p / q
+                a = (n + 1) * s
+                r = pow(q, n)
+                u = self._uniform()
+                k = 0
+                while u > r and k <= n:
+                    u -= r
+                    k += 1
+                    r *= a / k - s
+                if k <= n:
+                    break
+        else:
+            spq = sqrt(n * p * (1 - p))
+            b = 1.15 + 2.53 * spq
+            a = -0.0873 + 0.0248 * b + 0.01 * p
+            c = n * p + 0.5
+            v_r = 0.92 - 4.2 / b
+            alpha = (2.83 + 5.1 / b) * spq
+            lpq = log(p / (1 - p))
+            m = floor((n + 1) * p)
+            h = lgamma(m + 1) + lgamma(n - m + 1)
+            while True:
+                u = self._uniform() - 0.5
+                v = self._uniform()
+                us = 0.5 - fabs(u)
+                k = <long> floor((2 * a / us + b) * u + c)
+                if k < 0 or k > n:
+                    continue
+                if us >= 0.07 and v <= v_r:
+                    break
+                v = log(v * alpha / (a / (us * us) + b))
+                if v <= (h - lgamma(k + 1) - lgamma(n - k + 1)
+                         + (k - m) * lpq):
+                    break
+        if flip:
+            return n - k
+        return k
+
+    cdef void _shuffle_long(self, long[:] x) nogil:
+        cdef long i, j, tmp
+        i = x.shape[0] - 1
+        while i > 0:
+            j = self._interval(i)
+            tmp = x[i]
+            x[i] = x[j]
+            x[j] = tmp
+            i = i - 1
+
+    def jump(self, n_blocks):
+        """Skip the next n_blocks blocks of four 32-bit outputs, in O(1)"""
+        self.counter += <uint64_t> n_blocks
+        self.buffer_pos = 4
+        return self
+
+    def spawn(self, long n):
+        """Return n generators, independent of this one and of each other.
+        Successive calls return different generators, and the result only
+        depends on the state of this generator"""
+        cdef uint32_t ctr[4]
+        cdef uint32_t out[4]
+        cdef long i
+        children = []
+        for i in range(n):
+            # Child keys are outputs of this generator's key on a counter
+            # space disjoint from its draws
+            ctr[0] = <uint32_t> self.n_spawned
+            ctr[1] = <uint32_t> (self.n_spawned >> 32)
+            ctr[2] = self.stream[0] ^ 0xFFFFFFFF
+            ctr[3] = self.stream[1] ^ 0xFFFFFFFF
+            philox4x32_10(ctr, self.key, out)
+            self.n_spawned += 1
+            children.append(PhiloxRandomState(
+                int(out[0]) | (int(out[1]) << 32),
+                int(out[2]) | (int(out[3]) << 32)))
+        return children
+
+    cpdef long randint(self, unsigned long high):
+        return <long> self._interval(high)
+
+    def random_sample(self, size=None):
+        """Uniform doubles in [0, 1)"""
+        cdef double[:] out
+        cdef long i
+        if size is None:
+            return self._uniform()
+        res = np.empty(size, dtype=np.float64)
+        out = res.reshape(-1)
+        with nogil:
+            for i in range(out.shape[0]):
+                out[i] = self._uniform()
+        return res
+
+    def binomial(self, long n, double p, size=None):
+        """Binomial draws of parameters n and p"""
+        cdef long[:] out
+        cdef long i
+        if p < 0 or p > 1 or n < 0:
+            raise ValueError('Wrong binomial parameters')
+        if size is None:
+            return self._binomial(n, p)
+        res = np.empty(size, dtype='long')
+        out = res.reshape(-1)
+        with nogil:
+            for i in range(out.shape[0]):
+                out[i] = self._binomial(n, p)
+        return res
+
+    cpdef long[:] permutation(self, long size):
+        cdef long i
+        cdef long[:] res = view.array((size, ), sizeof(long), format='l')
+        with nogil:
+            for i in range(size):
+                res[i] = i
+            self._shuffle_long(res)
+        return res
+
+    def shuffle(self, long[:] x):
+        """Shuffle the index array x in place"""
+        with nogil:
+            self._shuffle_long(x)
+
+
+def _philox_from_state(state):
+    random_state = PhiloxRandomState(0)
+    random_state.set_state(state)
+    return random_state
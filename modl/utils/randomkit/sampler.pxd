@@ -7,9 +7,12 @@ cdef class Sampler(object):
 
     cdef public long[:] box
     cdef public long[:] temp
+    cdef unsigned char[:] mask
     cdef public long lim_sup
     cdef public long lim_inf
 
     cdef public RandomState random_state
 
-    cpdef long[:] yield_subset(self, double reduction)
\ No newline at end of file
+    cpdef long[:] yield_subset(self, double reduction, long[:] out=*,
+                               bint sort=*)
+    cdef void _sorted_subset(self, long[:] out) nogil
\ No newline at end of file
@@ -5,8 +5,16 @@
 # cython: wraparound=False
 
 from cython cimport view
+from libc.stdlib cimport qsort
 import numpy as np
 
+
+cdef int _compare_long(const void* a, const void* b) nogil:
+    cdef long x = (<long*> a)[0]
+    cdef long y = (<long*> b)[0]
+    return (x > y) - (x < y)
+
+
 cdef class Sampler(object):
     def __init__(self, range, rand_size,
                   replacement,
@@ -34,12 +42,51 @@ cdef class Sampler(object):
 
         self.box = self.random_state.permutation(self.range)
         self.temp = view.array((self.range, ), sizeof(long), format='l')
+        self.mask = view.array((self.range, ), sizeof(unsigned char),
+                               format='B')
+        self.mask[:] = 0
         self.lim_sup = 0
         self.lim_inf = 0
 
-        self.random_state.shuffle(self.box)
+        self.random_state.shuffle_long(self.box)
+
+    def get_state(self):
+        """Return the sampling position as a tuple
+        (box, lim_inf, lim_sup, random_state_state), usable by set_state"""
+        return (np.array(self.box), self.lim_inf, self.lim_sup,
+                self.random_state.get_state())
+
+    def set_state(self, state):
+        """Restore a state returned by get_state"""
+        box, lim_inf, lim_sup, random_state_state = state
+        box = np.asarray(box, dtype='long')
+        if box.shape[0] != self.range:
+            raise ValueError("Wrong state")
+        np.asarray(self.box)[:] = box
+        self.lim_inf = lim_inf
+        self.lim_sup = lim_sup
+        self.random_state.set_state(random_state_state)
+
+    cpdef long[:] yield_subset(self, double reduction, long[:] out=None,
+                               bint sort=False):
+        """Draw a subset of range(self.range) of expected size
+        range / reduction.
+
+        Parameters
+        ----------
+        reduction: double
+        out: long array, shape (>= len_subset,) or None
+            Caller-owned buffer in which to write the subset, to avoid an
+            allocation at each call. None allocates a new array
+        sort: bint
+            Whether to return the subset in increasing order, so that
+            gathers of the subset access memory monotonically. The same
+            indices are drawn as without sorting
 
-    cpdef long[:] yield_subset(self, double reduction):
+        Returns
+        -------
+        subset: long array, shape (len_subset,), a view of out if provided
+        """
         cdef long remainder
         cdef long len_subset
         if self.rand_size:
@@ -48,7 +95,7 @@ cdef class Sampler(object):
         else:
             len_subset = int(self.range / reduction)
         if self.replacement:
-            self.random_state.shuffle(self.box)
+            self.random_state.shuffle_long(self.box)
             self.lim_inf = 0
             self.lim_sup = len_subset
         else: # Without replacement
@@ -56,16 +103,50 @@ cdef class Sampler(object):
                 self.lim_inf = self.lim_sup
                 remainder = self.range - self.lim_inf
                 if remainder == 0:
-                    self.random_state.shuffle(self.box)
+                    self.random_state.shuffle_long(self.box)
                     self.lim_inf = 0
                 elif remainder < len_subset:
-                    self.temp[:remainder] = self.box[:remainder]
-                    self.box[:remainder] = self.box[self.lim_inf:]
-                    self.box[self.lim_inf:] = self.temp[:remainder]
-                    self.random_state.shuffle(self.box[remainder:])
+                    # Rotate the unseen indices to the front through temp,
+                    # the two ranges overlap when remainder > lim_inf
+                    self.temp[:remainder] = self.box[self.lim_inf:]
+                    self.temp[remainder:] = self.box[:self.lim_inf]
+                    self.box[:] = self.temp
+                    self.random_state.shuffle_long(self.box[remainder:])
                     self.lim_inf = 0
                 self.lim_sup = self.lim_inf + len_subset
             else:
                 self.lim_inf = 0
                 self.lim_sup = self.range
-        return np.array(self.box[self.lim_inf:self.lim_sup])
\ No newline at end of file
+        len_subset = self.lim_sup - self.lim_inf
+        if out is None:
+            out = np.empty(len_subset, dtype='long')
+        elif out.shape[0] < len_subset:
+            raise ValueError('out should have at least %i elements'
+                             % len_subset)
+        out = out[:len_subset]
+        if sort:
+            self._sorted_subset(out)
+        else:
+            out[:] = self.box[self.lim_inf:self.lim_sup]
+        return out
+
+    cdef void _sorted_subset(self, long[:] out) nogil:
+        """Write box[lim_inf:lim_sup] in increasing order into out. Dense
+        subsets are sorted in O(range) by counting the selected indices in
+        mask, sparse ones with qsort"""
+        cdef long i
+        cdef long j = 0
+        cdef long len_subset = self.lim_sup - self.lim_inf
+        if len_subset * 16 < self.range:
+            for i in range(len_subset):
+                out[i] = self.box[self.lim_inf + i]
+            if len_subset > 0:
+                qsort(&out[0], len_subset, sizeof(long), _compare_long)
+            return
+        for i in range(self.lim_inf, self.lim_sup):
+            self.mask[self.box[i]] += 1
+        for i in range(self.range):
+            while self.mask[i] > 0:
+                out[j] = i
+                j += 1
+                self.mask[i] -= 1
\ No newline at end of file
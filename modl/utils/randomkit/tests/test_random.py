@@ -4,7 +4,8 @@ import pickle
 import numpy as np
 from numpy.testing import (assert_almost_equal, assert_array_equal,
                            assert_equal)
-from modl.utils.randomkit import RandomState
+from modl.utils.randomkit import RandomState, PhiloxRandomState
+from modl.utils.randomkit.random_fast import permute_rows
 
 
 def test_random():
@@ -32,6 +33,31 @@ def test_shuffle_with_trace():
     assert_array_equal(ind, perm)
 
 
+def test_shuffle_with_trace_rows():
+    rng = np.random.RandomState(0)
+    X = rng.randn(100, 3, 2)
+    Y = rng.randn(100, 4).astype(np.float32)
+    Z = np.asfortranarray(rng.randn(100, 4))  # Generic path
+    X_ref, Y_ref, Z_ref = X.copy(), Y.copy(), Z.copy()
+    rs = RandomState(seed=0)
+    perm = rs.shuffle_with_trace([X, Y, Z])
+    assert_array_equal(np.sort(perm), np.arange(100))
+    assert_array_equal(X, X_ref[perm])
+    assert_array_equal(Y, Y_ref[perm])
+    assert_array_equal(Z, Z_ref[perm])
+
+
+def test_permute_rows(tmpdir):
+    rng = np.random.RandomState(0)
+    X = np.memmap(str(tmpdir.join('X.mmap')), mode='w+', shape=(50, 7),
+                  dtype=np.float64)
+    X[:] = rng.randn(50, 7)
+    X_ref = np.array(X)
+    perm = rng.permutation(50)
+    permute_rows(X, perm)
+    assert_array_equal(X, X_ref[perm])
+
+
 def test_permutation():
     rs = RandomState(seed=0)
     perm = rs.permutation(10)
@@ -45,3 +71,66 @@ def test_random_state_pickle():
     pickle_rs = pickle.loads(pickle_rs)
     pickle_random_integer = pickle_rs.randint(5)
     assert_equal(random_integer, pickle_random_integer)
+
+
+def test_random_state_get_state():
+    rs = RandomState(seed=0)
+    rs.randint(5)
+    rs.binomial(100, 0.3)
+    state = rs.get_state()
+    vals = [rs.randint(10) for t in range(10)]
+    vals += [rs.binomial(100, 0.3) for t in range(10)]
+    new_rs = RandomState(seed=1)
+    new_rs.set_state(state)
+    new_vals = [new_rs.randint(10) for t in range(10)]
+    new_vals += [new_rs.binomial(100, 0.3) for t in range(10)]
+    assert_array_equal(vals, new_vals)
+
+
+def test_philox():
+    # Known answer of Philox4x32-10 for a zero counter and key
+    rs = PhiloxRandomState(seed=0)
+    vals = [rs.randint(0xFFFFFFFF) for t in range(4)]
+    assert_array_equal(vals, [0x6627e8d5, 0xe169c58d, 0xbc57ac4c,
+                              0x9b00dbd8])
+    rs = PhiloxRandomState(seed=0)
+    vals = rs.random_sample(10000)
+    assert np.all((vals >= 0) & (vals < 1))
+    assert abs(np.mean(vals) - 0.5) < 0.01
+    for n, p in [(20, 0.1), (1000, 0.8), (100000, 0.1)]:
+        vals = rs.binomial(n, p, size=2000)
+        assert np.all((vals >= 0) & (vals <= n))
+        assert abs(np.mean(vals) - n * p) < 4 * np.sqrt(n * p * (1 - p)
+                                                         / 2000)
+    perm = np.asarray(rs.permutation(100))
+    assert_array_equal(np.sort(perm), np.arange(100))
+
+
+def test_philox_jump_spawn():
+    rs = PhiloxRandomState(seed=42)
+    vals = rs.random_sample(20)
+    rs = PhiloxRandomState(seed=42)
+    rs.jump(5)  # 5 blocks of 4 outputs, i.e. 10 doubles
+    assert_array_equal(rs.random_sample(10), vals[10:])
+
+    children = PhiloxRandomState(seed=42).spawn(3)
+    other_children = PhiloxRandomState(seed=42).spawn(3)
+    draws = [child.random_sample(5) for child in children]
+    for child, draw in zip(other_children, draws):
+        assert_array_equal(child.random_sample(5), draw)
+    assert len(set(tuple(draw) for draw in draws)) == 3
+    rs = PhiloxRandomState(seed=42)
+    rs.spawn(3)
+    assert not np.array_equal(rs.spawn(1)[0].random_sample(5), draws[0])
+
+
+def test_philox_state():
+    rs = PhiloxRandomState(seed=3, stream=7)
+    rs.random_sample(3)
+    state = rs.get_state()
+    vals = rs.random_sample(10)
+    new_rs = PhiloxRandomState(seed=1)
+    new_rs.set_state(state)
+    assert_array_equal(new_rs.random_sample(10), vals)
+    pickle_rs = pickle.loads(pickle.dumps(new_rs))
+    assert_array_equal(pickle_rs.random_sample(10), new_rs.random_sample(10))
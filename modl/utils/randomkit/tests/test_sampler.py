@@ -1,5 +1,6 @@
 from modl.utils.randomkit.sampler import Sampler
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal, assert_equal
 
 
@@ -43,3 +44,40 @@ def test_sampler():
                       random_seed=0)
     A = np.concatenate([sampler.yield_subset(10) for t in range(20)])
     assert_array_equal(np.sort(A[:100]), np.arange(100))
+
+
+def test_sampler_get_state():
+    sampler = Sampler(100, rand_size=False,
+                      replacement=False,
+                      random_seed=0)
+    for t in range(3):
+        sampler.yield_subset(7)
+    state = sampler.get_state()
+    A = [sampler.yield_subset(7) for t in range(20)]
+    new_sampler = Sampler(100, rand_size=False,
+                          replacement=False,
+                          random_seed=1)
+    new_sampler.set_state(state)
+    B = [new_sampler.yield_subset(7) for t in range(20)]
+    assert_array_equal(np.concatenate(A), np.concatenate(B))
+
+
+def test_sampler_sorted_out():
+    for reduction in [2, 40]:
+        sampler = Sampler(1000, rand_size=True, replacement=False,
+                          random_seed=0)
+        ref_sampler = Sampler(1000, rand_size=True, replacement=False,
+                              random_seed=0)
+        out = np.empty(1000, dtype='long')
+        for t in range(5):
+            A = np.asarray(sampler.yield_subset(reduction, out=out,
+                                                sort=True))
+            B = np.asarray(ref_sampler.yield_subset(reduction))
+            assert np.shares_memory(A, out)
+            assert_array_equal(A, np.sort(B))
+            assert_array_equal(np.unique(A), A)
+            assert_array_equal(np.sort(sampler.box), np.arange(1000))
+    sampler = Sampler(100, rand_size=False, replacement=True,
+                      random_seed=0)
+    with pytest.raises(ValueError):
+        sampler.yield_subset(2, out=np.empty(10, dtype='long'))
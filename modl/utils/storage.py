@@ -0,0 +1,336 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from tempfile import TemporaryFile
+
+import numpy as np
+
+# Upper bound on the memory used to copy rows between backing files
+COPY_BLOCK_BYTES = 2 ** 26
+
+
+def _file_id(filename):
+    stat = os.stat(filename)
+    return stat.st_dev, stat.st_ino
+
+
+class ChunkedStorage(object):
+    """
+    Out-of-core storage for per-sample statistics, with asynchronous
+    prefetching and write-back.
+
+    Rows are stored in memory-mapped temporary files of chunk_size rows
+    each, created in directory. Reads and writes are performed by a single
+    background thread, in the order they were submitted, so that the I/O
+    of the next batch can overlap with computation. The storage can grow by
+    appending new files with grow. Rows can be permuted without moving any
+    data, by recording the permutation as an index of physical rows.
+
+    Files written by save can be adopted as read-only backing files by
+    restore, each of them being copied to a new backing file on its first
+    write. Chunks that are not written between two saves are hard-linked
+    from the previous save instead of being rewritten.
+
+    Parameters
+    ----------
+    shape: tuple,
+        Shape of the stored array. The first axis indexes samples
+    dtype: dtype,
+        Type of the stored array
+    directory: str or None,
+        Directory in which to create the backing files. None uses the
+        default temporary directory
+    chunk_size: int or None,
+        Number of rows per backing file. None stores all rows in a single
+        file, and the rows added by each call to grow in another one
+    """
+    def __init__(self, shape, dtype, directory=None, chunk_size=None):
+        self.shape = (0,) + tuple(shape[1:])
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+        # None for the read-only chunks adopted by restore
+        self._files = []
+        self._chunks = []
+        # Identity of the saved file holding each unmodified chunk
+        self._saved = {}
+        self._starts = np.zeros(1, dtype=np.int64)
+        # Physical row of each row, None for the identity
+        self._index = None
+        self._pool = ThreadPoolExecutor(1)
+        self._prefetched = None
+        self._pending = []
+        self.grow(shape[0])
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _new_chunk(self, n_samples):
+        file = TemporaryFile(dir=self.directory)
+        chunk = np.memmap(file, mode='w+',
+                          shape=(n_samples,) + self.shape[1:],
+                          dtype=self.dtype)
+        return file, chunk
+
+    def _row_blocks(self, n_samples):
+        """Slices of range(n_samples) holding at most COPY_BLOCK_BYTES of
+        rows"""
+        row_bytes = self.dtype.itemsize * int(np.prod(self.shape[1:]))
+        block_size = max(1, COPY_BLOCK_BYTES // max(1, row_bytes))
+        for start in range(0, n_samples, block_size):
+            yield slice(start, min(n_samples, start + block_size))
+
+    def _own_chunk(self, chunk):
+        """Copy a chunk adopted by restore to a new backing file, by blocks
+        of at most COPY_BLOCK_BYTES"""
+        source = self._chunks[chunk]
+        file, new_chunk = self._new_chunk(source.shape[0])
+        for block in self._row_blocks(source.shape[0]):
+            new_chunk[block] = source[block]
+        self._files[chunk] = file
+        self._chunks[chunk] = new_chunk
+
+    def _chunk_indices(self, indices):
+        return np.searchsorted(self._starts, indices, side='right') - 1
+
+    def _read(self, indices):
+        if self._index is not None:
+            indices = self._index[indices]
+        res = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        chunk_indices = self._chunk_indices(indices)
+        for chunk in np.unique(chunk_indices):
+            mask = chunk_indices == chunk
+            res[mask] = self._chunks[chunk][indices[mask]
+                                            - self._starts[chunk]]
+        return res
+
+    def _write(self, indices, values):
+        if self._index is not None:
+            indices = self._index[indices]
+        chunk_indices = self._chunk_indices(indices)
+        for chunk in np.unique(chunk_indices):
+            if self._files[chunk] is None:
+                self._own_chunk(chunk)
+            self._saved.pop(chunk, None)
+            mask = chunk_indices == chunk
+            self._chunks[chunk][indices[mask]
+                                - self._starts[chunk]] = values[mask]
+
+    def grow(self, n_samples):
+        """Append zero rows so that the storage holds n_samples rows.
+        Existing backing files are left untouched"""
+        self.flush()
+        n_new_samples = n_samples - self.shape[0]
+        if n_new_samples <= 0:
+            return
+        if self.chunk_size is None:
+            sizes = [n_new_samples]
+        else:
+            chunk_size = max(1, int(self.chunk_size))
+            sizes = [min(chunk_size, n_new_samples - start)
+                     for start in range(0, n_new_samples, chunk_size)]
+        for size in sizes:
+            file, chunk = self._new_chunk(size)
+            self._files.append(file)
+            self._chunks.append(chunk)
+        self._starts = np.concatenate([self._starts,
+                                       self._starts[-1]
+                                       + np.cumsum(sizes)])
+        if self._index is not None:
+            self._index = np.concatenate([self._index,
+                                          np.arange(self.shape[0],
+                                                    n_samples)])
+        self.shape = (n_samples,) + self.shape[1:]
+
+    def _check_indices(self, indices):
+        if isinstance(indices, slice):
+            return np.arange(self.shape[0])[indices]
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            return np.nonzero(indices)[0]
+        return indices.astype(np.int64, copy=False)
+
+    def prefetch(self, indices):
+        """Start reading rows indices in the background"""
+        indices = self._check_indices(indices).copy()
+        self._prefetched = (indices, self._pool.submit(self._read, indices))
+
+    def read(self, indices):
+        """Return a copy of rows indices, using the prefetched rows if
+        available"""
+        indices = self._check_indices(indices)
+        if self._prefetched is not None:
+            prefetched_indices, future = self._prefetched
+            if np.array_equal(prefetched_indices, indices):
+                self._prefetched = None
+                return future.result()
+        self.flush()
+        return self._read(indices)
+
+    def write_async(self, indices, values):
+        """Write rows indices in the background. values should not be
+        modified until flush is called"""
+        indices = self._check_indices(indices).copy()
+        if (self._prefetched is not None
+                and np.intersect1d(self._prefetched[0], indices).shape[0]):
+            # Prefetched rows are stale
+            self._prefetched = None
+        self._pending.append(self._pool.submit(self._write, indices, values))
+
+    def fill(self, start, rows):
+        """Set rows start to the end to rows(block_start, block_stop),
+        broadcast to the row shape, by blocks of at most COPY_BLOCK_BYTES"""
+        self.flush()
+        self._prefetched = None
+        for block in self._row_blocks(self.shape[0] - start):
+            block_start, block_stop = start + block.start, start + block.stop
+            values = np.broadcast_to(rows(block_start, block_stop),
+                                     (block_stop - block_start,)
+                                     + self.shape[1:])
+            self._write(np.arange(block_start, block_stop), values)
+
+    def write(self, indices, values):
+        """Write rows indices"""
+        self.flush()
+        self._prefetched = None
+        self._write(self._check_indices(indices), values)
+
+    def flush(self):
+        """Wait for pending writes to complete"""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def permute(self, permutation, indirect=False):
+        """Reorder rows so that new row i is former row permutation[i].
+
+        If indirect, only the index of physical rows is permuted, and no
+        data is moved, at the cost of non-sequential reads of consecutive
+        rows. Otherwise, each chunk is written to a new backing file, by
+        blocks of at most COPY_BLOCK_BYTES"""
+        self.flush()
+        self._prefetched = None
+        self._saved = {}
+        permutation = self._check_indices(permutation)
+        if indirect:
+            if self._index is None:
+                self._index = permutation.copy()
+            else:
+                self._index = self._index[permutation]
+            return
+        files, chunks = [], []
+        for chunk, start in zip(self._chunks, self._starts):
+            file, new_chunk = self._new_chunk(chunk.shape[0])
+            for block in self._row_blocks(chunk.shape[0]):
+                new_chunk[block] = self._read(
+                    permutation[start + block.start:start + block.stop])
+            files.append(file)
+            chunks.append(new_chunk)
+        self._close_files()
+        self._files, self._chunks = files, chunks
+        self._index = None
+
+    def save(self, directory, name, previous=None):
+        """Write rows to directory/name_i.npy files, one per chunk, without
+        loading more than COPY_BLOCK_BYTES in memory.
+
+        previous is the directory of an earlier save or restore. Its files
+        are hard-linked for the chunks that have not been written since, if
+        they are still the saved files"""
+        self.flush()
+        saved = {}
+        for i, (chunk, start) in enumerate(zip(self._chunks, self._starts)):
+            filename = join(directory, '%s_%i.npy' % (name, i))
+            if previous is not None and i in self._saved:
+                source = join(previous, '%s_%i.npy' % (name, i))
+                try:
+                    if _file_id(source) == self._saved[i]:
+                        os.link(source, filename)
+                        saved[i] = self._saved[i]
+                        continue
+                except OSError:
+                    # Missing file, or no hard links: write the chunk
+                    pass
+            out = np.lib.format.open_memmap(filename, mode='w+',
+                                            dtype=self.dtype,
+                                            shape=chunk.shape)
+            for block in self._row_blocks(chunk.shape[0]):
+                if self._index is None:
+                    out[block] = chunk[block]
+                else:
+                    out[block] = self._read(np.arange(start + block.start,
+                                                      start + block.stop))
+            out.flush()
+            del out
+            if self._index is None:
+                saved[i] = _file_id(filename)
+        self._saved = saved
+
+    def restore(self, directory, name):
+        """Adopt the files written by save as backing files, without
+        reading them. They are memory-mapped read-only, and each of them is
+        copied to a new backing file on its first write. Rows keep the
+        chunks of the saved storage"""
+        self.flush()
+        self._prefetched = None
+        files, chunks, saved = [], [], {}
+        start = 0
+        while start < self.shape[0]:
+            filename = join(directory, '%s_%i.npy' % (name, len(chunks)))
+            chunk = np.load(filename, mmap_mode='r')
+            if chunk.shape[1:] != self.shape[1:] or chunk.dtype != self.dtype:
+                raise ValueError('Stored rows do not match storage shape')
+            saved[len(chunks)] = _file_id(filename)
+            files.append(None)
+            chunks.append(chunk)
+            start += chunk.shape[0]
+        if start != self.shape[0]:
+            raise ValueError('Stored rows do not match storage shape')
+        self._close_files()
+        self._files, self._chunks, self._saved = files, chunks, saved
+        sizes = [chunk.shape[0] for chunk in chunks]
+        self._starts = np.concatenate([np.zeros(1, dtype=np.int64),
+                                       np.cumsum(sizes, dtype=np.int64)])
+        self._index = None
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first, (int, np.integer)):
+            return self.read(np.array([first]))[0][rest]
+        return self.read(first)[(slice(None),) + rest]
+
+    def __setitem__(self, key, values):
+        if isinstance(key, (int, np.integer)):
+            self.write(np.array([key]), np.asarray(values)[np.newaxis])
+        else:
+            indices = self._check_indices(key)
+            values = np.broadcast_to(values, (len(indices),) + self.shape[1:])
+            self.write(indices, values)
+
+    def __array__(self, dtype=None):
+        res = self.read(slice(None))
+        if dtype is not None:
+            res = res.astype(dtype, copy=False)
+        return res
+
+    def close(self):
+        """Wait for pending I/O and delete the backing files"""
+        self.flush()
+        self._prefetched = None
+        self._pool.shutdown()
+        self._close_files()
+        self._chunks = []
+        self._files = []
+        self._saved = {}
+
+    def _close_files(self):
+        for file in self._files:
+            if file is not None:
+                file.close()
@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+
+from modl.utils.profiling import (Profiler, RingSink, JSONLinesSink,
+                                  check_profiler, NULL_PROFILER)
+
+
+def test_profiler(tmpdir):
+    sink = RingSink(maxlen=2)
+    profiler = Profiler(sink=sink)
+    for i in range(3):
+        with profiler.timer('a'):
+            profiler.count('samples', 10)
+        with profiler.timer('b'):
+            pass
+        profiler.record(iteration=i)
+    assert len(sink.records) == 2
+    record = sink.records[-1]
+    assert record['iteration'] == 2
+    assert record['counters']['samples'] == 30
+    assert set(record['timers']) == {'a', 'b'}
+    assert record['samples_per_s'] > 0
+
+    filename = str(tmpdir.join('profile.jsonl'))
+    sink = JSONLinesSink(filename)
+    profiler = Profiler(sink=sink)
+    profiler.count('samples', 3)
+    profiler.record()
+    profiler.record()
+    sink.close()
+    with open(filename) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    assert records[0]['counters']['samples'] == 3
+
+    profiler.reset()
+    assert profiler.snapshot()['counters'] == {}
+
+
+
+def test_profiler_overlapping_timers():
+    profiler = Profiler()
+    with profiler.timer('a'):
+        time.sleep(0.02)
+        with profiler.timer('a'):
+            time.sleep(0.02)
+    # Nested timers of the same phase both accumulate
+    assert profiler.timers['a'] >= 0.06
+
+    profiler.reset()
+    entered = threading.Event()
+
+    def run():
+        with profiler.timer('a'):
+            entered.set()
+            time.sleep(0.03)
+
+    thread = threading.Thread(target=run)
+    with profiler.timer('a'):
+        time.sleep(0.03)
+        thread.start()
+        entered.wait()
+    thread.join()
+    assert profiler.timers['a'] >= 0.06
+
+def test_null_profiler():
+    profiler = check_profiler(None)
+    assert profiler is NULL_PROFILER
+    assert not profiler.enabled
+    with profiler.timer('a'):
+        profiler.count('samples', 10)
+    assert profiler.record() is None
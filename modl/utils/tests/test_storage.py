@@ -0,0 +1,147 @@
+import os
+from os.path import join
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from modl.utils import storage as storage_module
+from modl.utils.storage import ChunkedStorage
+
+
+def test_chunked_storage(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(25, 3, 3)
+    storage = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir),
+                             chunk_size=7)
+    storage[:] = X
+    assert len(tmpdir.listdir()) == 0  # Anonymous files
+    indices = rng.permutation(25)[:10]
+    assert_array_equal(storage[indices], X[indices])
+    assert_array_equal(storage[3], X[3])
+    assert_array_equal(storage[:, 1, 2], X[:, 1, 2])
+
+    storage.prefetch(indices)
+    new_values = rng.randn(5, 3, 3)
+    storage.write_async(indices[:5], new_values)
+    X[indices[:5]] = new_values
+    # Prefetched rows were invalidated by the write
+    assert_array_equal(storage.read(indices), X[indices])
+
+    storage.prefetch(indices)
+    assert_array_equal(storage.read(indices), X[indices])
+
+    permutation = rng.permutation(25)
+    storage.permute(permutation)
+    assert_array_equal(np.asarray(storage), X[permutation])
+    storage.close()
+
+
+def test_chunked_storage_grow(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(25, 3)
+    for chunk_size in [None, 7]:
+        storage = ChunkedStorage((0, 3), X.dtype, directory=str(tmpdir),
+                                 chunk_size=chunk_size)
+        for stop in [10, 11, 25]:
+            start = len(storage)
+            storage.grow(stop)
+            assert_array_equal(storage[start:stop], np.zeros((stop - start,
+                                                              3)))
+            storage[start:stop] = X[start:stop]
+        assert storage.shape == X.shape
+        assert_array_equal(np.asarray(storage), X)
+        permutation = rng.permutation(25)
+        storage.permute(permutation)
+        assert_array_equal(np.asarray(storage), X[permutation])
+        X = X[permutation]
+        storage.close()
+
+
+def test_chunked_storage_indirect_permute(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(25, 3)
+    storage = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir),
+                             chunk_size=7)
+    storage[:] = X
+    chunks = list(storage._chunks)
+    for _ in range(2):
+        permutation = rng.permutation(25)
+        storage.permute(permutation, indirect=True)
+        X = X[permutation]
+    # No data was moved
+    assert all(chunk is new_chunk
+               for chunk, new_chunk in zip(chunks, storage._chunks))
+    assert_array_equal(np.asarray(storage), X)
+    indices = rng.permutation(25)[:10]
+    new_values = rng.randn(10, 3)
+    storage[indices] = new_values
+    X[indices] = new_values
+    assert_array_equal(storage[indices], X[indices])
+    storage.grow(30)
+    assert_array_equal(storage[25:], np.zeros((5, 3)))
+    storage.save(str(tmpdir), 'X')
+    restored = ChunkedStorage((30, 3), X.dtype, directory=str(tmpdir))
+    restored.restore(str(tmpdir), 'X')
+    assert_array_equal(np.asarray(restored)[:25], X)
+    permutation = rng.permutation(30)
+    storage.permute(permutation)
+    assert_array_equal(np.asarray(storage),
+                       np.concatenate([X, np.zeros((5, 3))])[permutation])
+    storage.close()
+    restored.close()
+
+
+def test_chunked_storage_block_copy(tmpdir, monkeypatch):
+    # Copy two rows at a time, within a single chunk
+    monkeypatch.setattr(storage_module, 'COPY_BLOCK_BYTES', 2 * 3 * 8)
+    rng = np.random.RandomState(0)
+    X = rng.randn(25, 3)
+    storage = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir))
+    storage[:] = X
+    permutation = rng.permutation(25)
+    storage.permute(permutation)
+    X = X[permutation]
+    assert_array_equal(np.asarray(storage), X)
+    permutation = rng.permutation(25)
+    storage.permute(permutation, indirect=True)
+    X = X[permutation]
+    storage.save(str(tmpdir), 'X')
+    restored = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir))
+    restored.restore(str(tmpdir), 'X')
+    assert_array_equal(np.asarray(restored), X)
+    restored.fill(20, lambda start, stop: np.arange(start, stop)[:, None])
+    X[20:] = np.arange(20, 25)[:, None]
+    assert_array_equal(np.asarray(restored), X)
+    storage.close()
+    restored.close()
+
+
+def test_chunked_storage_restore_links(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(25, 3)
+    storage = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir),
+                             chunk_size=7)
+    storage[:] = X
+    first, second = str(tmpdir.mkdir('first')), str(tmpdir.mkdir('second'))
+    storage.save(first, 'X')
+    storage.close()
+    restored = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir))
+    restored.restore(first, 'X')
+    # Saved files are adopted, and copied on their first write
+    assert restored._files == [None] * 4
+    assert_array_equal(np.asarray(restored), X)
+    restored[[8, 9]] = 0
+    assert restored._files[1] is not None
+    assert_array_equal(np.load(join(first, 'X_1.npy')), X[7:14])
+    X[[8, 9]] = 0
+    assert_array_equal(np.asarray(restored), X)
+    # Only the written chunk is rewritten
+    restored.save(second, 'X', previous=first)
+    for i in range(4):
+        assert (os.path.samefile(join(first, 'X_%i.npy' % i),
+                                 join(second, 'X_%i.npy' % i)) == (i != 1))
+    restored.close()
+    restored = ChunkedStorage(X.shape, X.dtype, directory=str(tmpdir))
+    restored.restore(second, 'X')
+    assert_array_equal(np.asarray(restored), X)
+    restored.close()